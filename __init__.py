@@ -4,5 +4,14 @@ from .retro_quantize import RetroQuantizeInvocation
 from .retro_getpalette import RetroGetPaletteInvocation, RetroGetPaletteAdvInvocation
 from .retro_palettize import RetroPalettizeInvocation, RetroPalettizeAdvInvocation
 from .retro_scanlines import RetroScanlinesSimpleInvocation
-# from .retro_halftone import RetroHalftoneInvocation
-from .retro_crt import RetroCRTCurvatureInvocation
\ No newline at end of file
+from .retro_halftone import RetroHalftoneInvocation
+from .retro_crt import RetroCRTCurvatureInvocation
+from .retro_batch import (
+    PixelizeBatchInvocation,
+    RetroBitizeBatchInvocation,
+    RetroQuantizeBatchInvocation,
+    RetroPalettizeBatchInvocation,
+    RetroScanlinesSimpleBatchInvocation,
+    RetroCRTCurvatureBatchInvocation,
+)
+from .retro_pipeline import RetroStageInvocation, RetroPipelineInvocation
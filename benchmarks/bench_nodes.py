@@ -0,0 +1,255 @@
+''' Throughput and peak memory of every Retroize node, invoked outside InvokeAI.
+
+Each node runs through its own invoke() against a local stand-in context (see local_context.py)
+on synthetic frames from 256x256 to 4K, over a small grid of parameters. The first run of every
+case warms the package caches (palette tables, CRT maps) and is reported on its own; the best of the
+following runs gives the throughput. Caches keyed by the input pixels, such as the learned K-Means
+palettes, are cleared before every run: a real workload brings new frames, so hitting them would time
+a lookup instead of the node. Needs the same Python environment as InvokeAI, since importing the nodes
+imports invokeai.
+
+    python benchmarks/bench_nodes.py --output results.json
+    python benchmarks/bench_nodes.py --nodes crt palettize --sizes 1024 4K --compare results.json
+'''
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import resource
+import statistics
+import sys
+import time
+from pathlib import Path
+from local_context import LocalContext
+
+ROOT = Path(__file__).resolve().parents[1]
+
+try:
+    #   Hand freed heap pages back to the kernel before each run, so the peak above the baseline
+    #   counts what the run itself needed rather than what earlier runs left resident
+    import ctypes
+    malloc_trim = ctypes.CDLL("libc.so.6").malloc_trim
+except (ImportError, OSError, AttributeError):
+    malloc_trim = None
+
+SIZES = {
+    "256": (256, 256),
+    "512": (512, 512),
+    "1024": (1024, 1024),
+    "2048": (2048, 2048),
+    "4K": (3840, 2160),
+}
+
+NES = str(ROOT / "palettes" / "NES.png")
+
+#   Node class and the parameter sets it is measured with; unset parameters keep the node's defaults
+CASES = {
+    "pixelize": ("PixelizeInvocation", [
+        {"downsample_factor": 4},
+        {"downsample_factor": 16},
+        {"downsample_factor": 4, "kernel": "Mode"},
+    ]),
+    "bitize": ("RetroBitizeInvocation", [
+        {"dither": False},
+        {"dither": True},
+        {"dither": True, "dither_mode": "Bayer 8x8"},
+        {"dither": True, "dither_mode": "Atkinson"},
+    ]),
+    "quantize": ("RetroQuantizeInvocation", [
+        {"method": "Median Cut", "dither": False},
+        {"method": "Fast Octree", "dither": False},
+        {"method": "Fast Octree", "dither": True},
+        {"method": "K-Means", "dither": False},
+    ]),
+    "palettize": ("RetroPalettizeInvocation", [
+        {"palette_path": NES},
+        {"palette_path": NES, "dither": True},
+        {"palette_path": NES, "dither": True, "dither_mode": "Bayer 8x8"},
+        {"palette_path": NES, "color_metric": "OKLab"},
+        {"palette_path": NES, "parallel": True},
+    ]),
+    "palettize_adv": ("RetroPalettizeAdvInvocation", [
+        {"palette_image": "NES.png"},
+        {"palette_image": "NES.png", "dither": True},
+    ]),
+    "get_palette": ("RetroGetPaletteInvocation", [
+        {"exact": False},
+        {"exact": True},
+    ]),
+    "scanlines": ("RetroScanlinesSimpleInvocation", [
+        {},
+        {"size_jitter": 2, "space_jitter": 2},
+    ]),
+    "crt": ("RetroCRTCurvatureInvocation", [
+        {},
+        {"low_memory": True},
+        {"parallel": True},
+    ]),
+    "halftone": ("RetroHalftoneInvocation", [
+        {"shape": "Circle"},
+        {"shape": "Square", "rotation": 15, "overlay": True},
+    ]),
+}
+
+def load_package():
+    spec = importlib.util.spec_from_file_location("retroize", ROOT / "__init__.py", submodule_search_locations = [str(ROOT)])
+    package = importlib.util.module_from_spec(spec)
+    sys.modules["retroize"] = package
+    spec.loader.exec_module(package)
+    return package
+
+def test_frame(width, height):
+    ''' A deterministic photo-like frame: smooth color fields with some noise '''
+    import numpy as np
+    from PIL import Image
+    rng = np.random.default_rng(0)
+    base = Image.fromarray(rng.integers(0, 256, (max(2, height // 64), max(2, width // 64), 3), dtype = np.uint8))
+    frame = np.asarray(base.resize((width, height), Image.BICUBIC), dtype = np.int16)
+    frame = frame + rng.integers(-8, 9, frame.shape, dtype = np.int16)
+    return Image.fromarray(np.clip(frame, 0, 255).astype(np.uint8))
+
+def reset_peak_rss():
+    ''' Reset the kernel's resident-set high-water mark; False where that is not supported '''
+    if malloc_trim is not None:
+        malloc_trim(0)
+    try:
+        with open("/proc/self/clear_refs", "w") as file:
+            file.write("5")
+        return True
+    except OSError:
+        return False
+
+def rss_mib():
+    ''' Current and peak resident set size in MiB '''
+    try:
+        with open("/proc/self/status") as file:
+            fields = dict(line.split(":", 1) for line in file if ":" in line)
+        return int(fields["VmRSS"].split()[0]) / 1024, int(fields["VmHWM"].split()[0]) / 1024
+    except (OSError, KeyError, ValueError):
+        #   ru_maxrss is in KiB on Linux and bytes on macOS, and never resets
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak = peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+        return peak, peak
+
+def clear_image_caches():
+    ''' Empty the caches whose entries belong to one input image '''
+    from retroize.retro_kmeans import kmeans_cache
+    kmeans_cache.clear()
+
+def run_case(context, node, repeat):
+    ''' Time invoke() repeat + 1 times, then run it once more for the peak memory above the baseline.
+    Returns the first time, the later times and the peak. '''
+    def invoke():
+        output = node.invoke(context)
+        image = getattr(output, "image", None)
+        if image is not None:
+            context.images.forget(image.image_name)
+
+    times = []
+    for _ in range(repeat + 1):
+        clear_image_caches()
+        start = time.perf_counter()
+        invoke()
+        times.append(time.perf_counter() - start)
+
+    #   Kept apart from the timed runs, which should not pay for the pages handed back to the kernel
+    clear_image_caches()
+    reset_peak_rss()
+    before, _ = rss_mib()
+    invoke()
+    peak = rss_mib()[1] - before
+    return times[0], times[1:], peak
+
+def case_key(result):
+    return f"{result['node']}|{result['size']}|{json.dumps(result['params'], sort_keys = True)}"
+
+def benchmark(nodes, sizes, repeat, log):
+    load_package()
+    import numpy as np
+    import PIL
+    from invokeai.invocation_api import ImageField
+    import retroize
+
+    results = []
+    for size in sizes:
+        width, height = SIZES[size] if size in SIZES else tuple(int(v) for v in size.lower().split("x"))
+        context = LocalContext()
+        name = context.images.add(test_frame(width, height))
+        megapixels = width * height / 1e6
+
+        for node_name in nodes:
+            class_name, param_sets = CASES[node_name]
+            node_class = getattr(retroize, class_name)
+            for params in param_sets:
+                node = node_class(image = ImageField(image_name = name), **params)
+                first, runs, peak = run_case(context, node, repeat)
+                best = min(runs)
+                result = {
+                    "node": node_name,
+                    "size": f"{width}x{height}",
+                    "params": {key: value for key, value in params.items() if key != "palette_path"},
+                    "first_s": first,
+                    "best_s": best,
+                    "median_s": statistics.median(runs),
+                    "megapixels_per_s": megapixels / best,
+                    "peak_rss_mib": peak,
+                }
+                results.append(result)
+                log(result)
+
+    meta = {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pillow": PIL.__version__,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "repeat": repeat,
+        "peak_rss_resets": reset_peak_rss(),
+    }
+    return {"meta": meta, "results": results}
+
+def print_result(result):
+    params = ", ".join(f"{key}={value}" for key, value in result["params"].items()) or "defaults"
+    print(f"{result['node']:<14} {result['size']:>9}  {result['best_s'] * 1000:>9.1f}ms {result['first_s'] * 1000:>9.1f}ms {result['megapixels_per_s']:>8.1f}  {result['peak_rss_mib']:>8.1f}  {params}", flush = True)
+
+def compare(current, baseline_path, tolerance):
+    ''' Print the time ratio of every case also in the baseline; returns the number of regressions '''
+    with open(baseline_path) as file:
+        baseline = {case_key(result): result for result in json.load(file)["results"]}
+
+    regressions = 0
+    print(f"\n{'node':<14} {'size':>9}  {'before':>9}   {'after':>9}   ratio")
+    for result in current["results"]:
+        old = baseline.get(case_key(result))
+        if old is None:
+            continue
+        ratio = result["best_s"] / old["best_s"]
+        flag = "  REGRESSION" if ratio > 1 + tolerance else ""
+        regressions += bool(flag)
+        print(f"{result['node']:<14} {result['size']:>9}  {old['best_s'] * 1000:>7.1f}ms   {result['best_s'] * 1000:>7.1f}ms  {ratio:>5.2f}x{flag}  {json.dumps(result['params'], sort_keys = True)}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__.splitlines()[0])
+    parser.add_argument("--nodes", nargs = "+", default = list(CASES), choices = list(CASES), help = "Nodes to measure")
+    parser.add_argument("--sizes", nargs = "+", default = list(SIZES), help = "Frame sizes: 256, 512, 1024, 2048, 4K or WIDTHxHEIGHT")
+    parser.add_argument("--repeat", type = int, default = 3, help = "Timed runs per case after the warm-up run; the best is kept")
+    parser.add_argument("--output", help = "Write the results as JSON to this file")
+    parser.add_argument("--compare", help = "JSON results of an earlier run to compare against")
+    parser.add_argument("--tolerance", type = float, default = 0.1, help = "Slowdown over the baseline reported as a regression")
+    args = parser.parse_args()
+
+    print(f"{'node':<14} {'size':>9}  {'best':>11} {'first':>11} {'MP/s':>8}  {'peak MiB':>8}  params")
+    results = benchmark(args.nodes, args.sizes, max(1, args.repeat), print_result)
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent = 1)
+
+    if args.compare and compare(results, args.compare, args.tolerance):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
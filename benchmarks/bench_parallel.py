@@ -0,0 +1,86 @@
+''' Scaling curve of the intra-image parallel mode of CRT, Halftone and LUT Palettize.
+
+Runs every effect once sequentially and then with parallel row bands on pools of 1, 2, 4, ...
+threads, checks the outputs are bit-identical and prints the speedups. Needs the same Python
+environment as InvokeAI, since importing the nodes imports invokeai.
+
+    python benchmarks/bench_parallel.py --size 4096 --threads 1 2 4 8 16 32
+'''
+import argparse
+import importlib.util
+import json
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+
+def load_package():
+    spec = importlib.util.spec_from_file_location("retroize", ROOT / "__init__.py", submodule_search_locations = [str(ROOT)])
+    package = importlib.util.module_from_spec(spec)
+    sys.modules["retroize"] = package
+    spec.loader.exec_module(package)
+    return package
+
+def best_of(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+def measure(size, repeat):
+    ''' Time each effect sequentially and in parallel on the pool sized by RETROIZE_THREADS '''
+    import numpy as np
+    load_package()
+    from retroize.retro_crt import crt_effect
+    from retroize.retro_halftone import halftone_effect
+    from retroize.retro_lut import apply_lut, get_lut
+    from retroize.retro_palettes import palette_store
+
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 256, (size, size, 3), dtype = np.uint8)
+    colors = palette_store.from_file(str(ROOT / "palettes" / "NES.png")).colors
+    lut = get_lut(colors)
+
+    effects = {
+        "crt": lambda parallel: crt_effect(image, (240, 160), 3.0, 1.0, 0.5, 5.0, 1.2, parallel = parallel),
+        "crt_low_memory": lambda parallel: crt_effect(image, (240, 160), 3.0, 1.0, 0.5, 5.0, 1.2, low_memory = True, parallel = parallel),
+        "halftone": lambda parallel: halftone_effect(image, "Square", 12, 15, True, 30, 3, False, np.random.default_rng(1), parallel = parallel),
+        "lut_palettize": lambda parallel: apply_lut(image, lut, parallel),
+    }
+
+    results = {}
+    for name, effect in effects.items():
+        #   Warm caches (CRT maps, stamps) so both runs measure the shading itself
+        effect(False)
+        sequential, expected = best_of(lambda: effect(False), repeat)
+        parallel, actual = best_of(lambda: effect(True), repeat)
+        results[name] = {"sequential": sequential, "parallel": parallel, "identical": bool(np.array_equal(expected, actual))}
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__.splitlines()[0])
+    parser.add_argument("--size", type = int, default = 4096, help = "Width and height of the test frame")
+    parser.add_argument("--threads", type = int, nargs = "+", default = [1, 2, 4, 8, 16, 32], help = "Pool sizes to measure")
+    parser.add_argument("--repeat", type = int, default = 3, help = "Runs per measurement; the best is kept")
+    parser.add_argument("--worker", action = "store_true", help = argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(measure(args.size, args.repeat)))
+        return
+
+    #   The pool size is read once at import, so every thread count runs in its own process
+    print(f"{'threads':>7}  {'effect':<15} {'sequential':>10} {'parallel':>10} {'speedup':>7}  identical")
+    for threads in args.threads:
+        env = dict(os.environ, RETROIZE_THREADS = str(threads))
+        output = subprocess.run([sys.executable, __file__, "--worker", "--size", str(args.size), "--repeat", str(args.repeat)], env = env, capture_output = True, text = True, check = True).stdout
+        for name, result in json.loads(output.splitlines()[-1]).items():
+            print(f"{threads:>7}  {name:<15} {result['sequential'] * 1000:>8.1f}ms {result['parallel'] * 1000:>8.1f}ms {result['sequential'] / result['parallel']:>6.2f}x  {result['identical']}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+''' A stand-in for InvokeAI's InvocationContext, so nodes can be invoked outside a running server.
+
+Images live in an in-memory store: nothing touches the database, the disk or the network. get_pil
+hands out a copy, as InvokeAI loads a fresh image on every call; PNG decoding and encoding are
+not modelled, so load and save times are a lower bound.
+'''
+import itertools
+import logging
+from types import SimpleNamespace
+
+class LocalImages:
+    ''' The images interface of the context: get_pil, get_dto and save '''
+
+    def __init__(self):
+        self._images = {}
+        self._names = itertools.count()
+
+    def add(self, image, name = None):
+        ''' Put an input image into the store and return its name '''
+        name = name or f"input-{next(self._names)}"
+        self._images[name] = image
+        return name
+
+    def get_pil(self, image_name, mode = None):
+        image = self._images[image_name]
+        return image.convert(mode) if mode is not None and image.mode != mode else image.copy()
+
+    def get_dto(self, image_name):
+        image = self._images[image_name]
+        return SimpleNamespace(image_name = image_name, width = image.width, height = image.height)
+
+    def save(self, image, **kwargs):
+        name = f"output-{next(self._names)}"
+        #   Pillow images are lazy about nothing here, but make sure the pixels exist before timing ends
+        image.load()
+        self._images[name] = image
+        return self.get_dto(name)
+
+    def forget(self, image_name):
+        self._images.pop(image_name, None)
+
+class LocalContext:
+    ''' Just enough of InvocationContext for the Retroize nodes '''
+
+    def __init__(self, logger = None):
+        self.images = LocalImages()
+        self.logger = logger or logging.getLogger("retroize.bench")
@@ -0,0 +1,231 @@
+from threading import Lock
+import hashlib
+import numpy as np
+from .retro_bitize import bitize
+from .retro_buffer import BIT_OUTPUT_FORMATS, OUTPUT_FORMATS, output_mode
+from .retro_color import COLOR_METRICS
+from .retro_crt import crt
+from .retro_dither import DITHER_MODES
+from .retro_helpers import PIL_QUANTIZE_MODES as QMode
+from .retro_palettes import palette_store
+from .retro_palettize import PalettizeSequence, palettize_rgb, resolve_palette
+from .retro_parallel import imap_bounded
+from .retro_pixelize import DOWNSAMPLE_KERNELS, pixelize
+from .retro_profile import Profile, current_profile, save_image, to_mode
+from .retro_quantize import QUANTIZE_METHODS, QuantizeSequence, kmeans_palette, quantize
+from .retro_resultcache import WithResultCache, output_nbytes, result_cache
+from .retro_scanlines import scanlines
+
+from invokeai.invocation_api import(
+    BaseInvocation,
+    ColorField,
+    ImageCollectionOutput,
+    ImageField,
+    InputField,
+    InvocationContext,
+    WithMetadata,
+    invocation,
+)
+
+
+def run_batch(context, images, process, with_index = False, node = None, extra = (), sequential = False):
+    ''' Load, process and save a collection of images. Frames are processed on the shared thread pool;
+    loading and saving stay on the calling thread and at most a bounded number of frames are in flight.
+    With with_index, process also receives the frame's position in the collection. When node has the
+    result cache enabled, frames already processed with the same parameters are not processed again.
+    With sequential, frames are processed one after another in order, for a process that carries state
+    from frame to frame; the result cache is then not used, as each output depends on earlier frames. '''
+    collection = [None] * len(images)
+    keys = [None] * len(images)
+    #   Every frame gets its own profile, named after the batch node
+    profiles = [Profile(type(node).__name__ if node is not None else "batch") for _ in images]
+
+    def frames():
+        for index, field in enumerate(images):
+            image = None
+            profile = profiles[index]
+            if node is not None and node.result_cache and not sequential:
+                digest, image = profile.run("hash", result_cache.input_digest, context, field)
+                #   The frame index only matters to effects that use it
+                keys[index] = result_cache.key(node, digest, (*extra, index) if with_index else extra)
+                dto = profile.run("lookup", result_cache.lookup, context, keys[index])
+                if dto is not None:
+                    collection[index] = ImageField(image_name = dto.image_name)
+                    profile.finish(context)
+                    continue
+            yield index, image if image is not None else profile.run("load", context.images.get_pil, field.image_name)
+
+    def run(frame):
+        index, image = frame
+        token = current_profile.set(profiles[index])
+        try:
+            return index, profiles[index].run("effect", process, image, index) if with_index else profiles[index].run("effect", process, image)
+        finally:
+            current_profile.reset(token)
+
+    for index, result in map(run, frames()) if sequential else imap_bounded(run, frames()):
+        dto = save_image(context, profiles[index], node, result, output_mode(node))
+        collection[index] = ImageField(image_name = dto.image_name)
+        if keys[index] is not None:
+            result_cache.store(keys[index], dto, output_nbytes(result))
+        profiles[index].finish(context)
+
+    return ImageCollectionOutput(collection = collection)
+
+
+@invocation("retro_pixelize_batch", title = "Pixelize (Batch)", tags = ["retro", "image", "pixel", "scale", "resize", "batch"], category = "image", version = "1.2.0")
+class PixelizeBatchInvocation(BaseInvocation, WithMetadata, WithResultCache):
+    ''' Pixelize a collection of images. Downsample, upsample. '''
+
+    #   Inputs
+    images:             list[ImageField] = InputField(description = "Input images for pixelization")
+    downsample_factor:  int         = InputField(default = 4, gt = 0, le = 30, description = "Image resizing factor. Higher = smaller image.")
+    upsample:           bool        = InputField(default = True, description = "Upsample to original resolution")
+    kernel:             DOWNSAMPLE_KERNELS = InputField(default = "Box", description = "How each block is reduced: Box averages it, Median takes the median of each channel, Mode keeps the most common color for crisp palettes")
+
+    def invoke(self, context: InvocationContext) -> ImageCollectionOutput:
+        return run_batch(context, self.images, lambda image: pixelize(image, self.downsample_factor, self.upsample, self.kernel), node = self)
+
+
+@invocation("retro_bitize_batch", title = "Bitize (Batch)", tags = ["retro", "image", "color", "pixel", "bit", "dither", "batch"], category = "image", version = "1.3.1")
+class RetroBitizeBatchInvocation(BaseInvocation, WithMetadata, WithResultCache):
+    ''' Crush a collection of images to one-bit pixels '''
+
+    #   Inputs
+    images: list[ImageField] = InputField(description = "Input images for pixelization")
+    dither: bool        = InputField(default = True, description = "Dither the Bitized image")
+    dither_mode: DITHER_MODES = InputField(default = "Floyd-Steinberg", description = "Dithering algorithm; ordered modes (Bayer, Blue Noise) are the fastest")
+    output_format: BIT_OUTPUT_FORMATS = InputField(default = "RGB", description = "Save as RGB, or as 1-bit PNGs that are several times smaller")
+
+    def invoke(self, context: InvocationContext) -> ImageCollectionOutput:
+        return run_batch(context, self.images, lambda image: bitize(image, self.dither, self.dither_mode), node = self)
+
+
+@invocation("retro_quantize_batch", title = "Quantize (Batch)", tags = ["retro", "image", "pixel", "quantize", "batch"], category = "image", version = "1.5.3")
+class RetroQuantizeBatchInvocation(BaseInvocation, WithMetadata, WithResultCache):
+    ''' Quantize a collection of images to 256 or less colors '''
+
+    #   Inputs
+    images:         list[ImageField] = InputField(description = "Input images for quantizing")
+    colors:         int = InputField(default = 64, gt = 0, le = 256, description = "Number of colors the image should be reduced to")
+    method:         QUANTIZE_METHODS = InputField(default = "Median Cut", description = "Quantization method")
+    kmeans:         int = InputField(default = 0, ge = 0, description = "k_means refinement passes; for K-Means, mini-batch steps (0 = 64)")
+    seed:           int = InputField(default = 0, ge = 0, description = "Seed of the K-Means sampling")
+    init_palette:   ImageField = InputField(default = None, description = "Palette K-Means starts from on every frame")
+    warm_start:     bool = InputField(default = True, description = "Without an initial palette, start K-Means on every later frame from the palette learned on the first frame, for stable colors across frames")
+    dither:         bool = InputField(default = True, description = "Dither quantized image")
+    dither_mode:    DITHER_MODES = InputField(default = "Floyd-Steinberg", description = "Dithering algorithm; ordered modes (Bayer, Blue Noise) are the fastest")
+    output_format:  OUTPUT_FORMATS = InputField(default = "RGB", description = "Save as RGB, or as palette-indexed PNGs that are several times smaller")
+    sequence:       bool = InputField(default = False, description = "Treat the images as consecutive video frames: one palette for all of them, and pixels that did not change keep their previous color, against flicker")
+    change_threshold: int = InputField(default = 0, ge = 0, le = 255, description = "In sequence mode, largest per-channel color change still treated as unchanged; raise it for noisy footage")
+    palette_update: int = InputField(default = 0, ge = 0, description = "In sequence mode with K-Means, mini-batch steps per frame that let the palette follow the footage (0 = learned once on the first frame)")
+
+    def invoke(self, context: InvocationContext) -> ImageCollectionOutput:
+        init = None
+        if self.method == "K-Means" and self.init_palette is not None:
+            init = palette_store.from_image_field(context, self.init_palette).colors
+
+        if self.sequence:
+            sequence = QuantizeSequence(self.colors, self.method, self.kmeans, self.dither, self.dither_mode, self.seed, init, self.palette_update, self.change_threshold)
+            return run_batch(context, self.images, sequence, node = self, sequential = True)
+
+        if self.method == "K-Means" and init is None and self.warm_start and len(self.images) > 1:
+            return self.invoke_warm_start(context)
+
+        extra = () if init is None else (hashlib.sha1(init.tobytes()).hexdigest(),)
+        return run_batch(context, self.images, lambda image: quantize(image, self.colors, self.method, self.kmeans, self.dither, self.dither_mode, self.seed, init), node = self, extra = extra)
+
+    def invoke_warm_start(self, context):
+        ''' K-Means with every frame after the first starting from the first frame's palette. The first frame is
+        quantized as by the single-image node, and its palette is learned once, when a frame first needs it,
+        so a batch whose frames all come from the result cache never loads or learns it. '''
+        lock = Lock()
+        learned = []
+
+        def first_palette(image = None):
+            with lock:
+                if not learned:
+                    if image is None:
+                        image = context.images.get_pil(self.images[0].image_name)
+                    learned.append(kmeans_palette(np.asarray(to_mode(image, "RGB")), self.colors, self.kmeans, self.dither, self.seed)[0])
+                return learned[0]
+
+        def process(image, index):
+            if index == 0:
+                #   Learn it here, so quantizing the first frame finds it in the K-Means cache
+                first_palette(image)
+                return quantize(image, self.colors, self.method, self.kmeans, self.dither, self.dither_mode, self.seed)
+            return quantize(image, self.colors, self.method, self.kmeans, self.dither, self.dither_mode, self.seed, first_palette())
+
+        #   Later frames depend on the first frame's pixels, which its pixel hash stands for
+        extra = (result_cache.input_digest(context, self.images[0])[0],) if self.result_cache else ()
+        return run_batch(context, self.images, process, with_index = True, node = self, extra = extra)
+
+
+@invocation("retro_palettize_batch", title = "Palettize (Batch)", tags = ["retro", "image", "color", "palette", "batch"], category = "image", version = "1.5.3")
+class RetroPalettizeBatchInvocation(BaseInvocation, WithMetadata, WithResultCache):
+    ''' Palettize a collection of images by applying a color palette '''
+
+    #   Inputs
+    images:         list[ImageField] = InputField(description = "Input images for palettizing")
+    palette_image:  ImageField = InputField(default = None, description = "Palette image")
+    palette_path:   str = InputField(default = "", description = "Palette image path, including \".png\" extension, or the name of a palette in the palettes folder")
+    dither:         bool = InputField(default = False, description = "Apply dithering to image when palettizing")
+    dither_mode:    DITHER_MODES = InputField(default = "Floyd-Steinberg", description = "Dithering algorithm; ordered modes (Bayer, Blue Noise) are the fastest")
+    color_metric:   COLOR_METRICS = InputField(default = "RGB", description = "Color distance for picking palette colors; OKLab and CIELAB match by perceived color")
+    prequantize:    bool = InputField(default = False, description = "Apply 256-color quantization with specified method prior to applying the color palette")
+    quantizer:      QMode = InputField(default = "Fast Octree", description = "Palettizer quantization method")
+    output_format:  OUTPUT_FORMATS = InputField(default = "RGB", description = "Save as RGB, or as palette-indexed PNGs that are several times smaller")
+    sequence:       bool = InputField(default = False, description = "Treat the images as consecutive video frames: pixels that did not change keep their previous color, so dithering does not flicker")
+    change_threshold: int = InputField(default = 0, ge = 0, le = 255, description = "In sequence mode, largest per-channel color change still treated as unchanged; raise it for noisy footage")
+
+    def invoke(self, context: InvocationContext) -> ImageCollectionOutput:
+        #   Resolve the palette once; its lookup table is then shared by every frame
+        palette = resolve_palette(context, self.palette_image, self.palette_path)
+
+        if self.sequence:
+            sequence = PalettizeSequence(palette, self.prequantize, self.quantizer, self.dither, self.dither_mode, self.color_metric, self.change_threshold)
+            return run_batch(context, self.images, sequence, node = self, sequential = True)
+
+        return run_batch(context, self.images, lambda image: palettize_rgb(image, palette, self.prequantize, self.quantizer, self.dither, self.dither_mode, metric = self.color_metric), node = self, extra = (palette.digest,))
+
+
+@invocation("retro_scanlines_simple_batch", title = "Scan Lines (Batch)", tags = ["retro", "image", "color", "pixel", "line", "batch"], category = "image", version = "1.1.0")
+class RetroScanlinesSimpleBatchInvocation(BaseInvocation, WithMetadata, WithResultCache):
+    """ Apply a simple scan lines effect to a collection of images """
+
+    #   Inputs
+    images:         list[ImageField] = InputField(description = "Input images to add scanlines to")
+    line_size:      int         = InputField(default = 1, gt = 0, description = "Thickness of scanlines in pixels")
+    line_spacing:   int         = InputField(default = 4, gt = 0, description = "Space between lines in pixels")
+    line_color:     ColorField  = InputField(default = ColorField(r = 0, g = 0, b = 0, a = 255), description = "Darkness of scanlines, 1.0 being black")
+    size_jitter:    int         = InputField(default = 0, ge = 0, description = "Random line position offset")
+    space_jitter:   int         = InputField(default = 0, ge = 0, description = "Random line position offset")
+    vertical:       bool        = InputField(default = False, description = "Switch scanlines to vertical")
+    seed:           int         = InputField(default = 0, ge = 0, description = "Seed for the random line size and spacing jitter; frame N uses seed + N")
+
+    def invoke(self, context: InvocationContext) -> ImageCollectionOutput:
+        line_color = (self.line_color.r, self.line_color.g, self.line_color.b, self.line_color.a)
+
+        #   Offset the seed per frame so jitter varies across the batch yet every frame stays reproducible
+        return run_batch(context, self.images, lambda image, index: scanlines(image, self.line_size, self.line_spacing, line_color, self.size_jitter, self.space_jitter, self.vertical, self.seed + index), with_index = True, node = self)
+
+
+@invocation("retro_crt_curvature_batch", title = "CRT (Batch)", tags = ["retro", "image", "distort", "batch"], category = "image", version = "1.1.0")
+class RetroCRTCurvatureBatchInvocation(BaseInvocation, WithMetadata, WithResultCache):
+    """ Distort a collection of images, simulating CRT display curvature """
+
+    #   Inputs
+    images:             list[ImageField] = InputField(description = "Input images for the CRT effect")
+    crt_width:          int         = InputField(default = 240, description = "Horizontal resolution of the CRT; smaller = more noticeable")
+    crt_height:         int         = InputField(default = 160, description = "Vertical resolution of the CRT; smaller = more noticeable")
+    crt_curvature:      float       = InputField(default = 3.0, description = "Curvature factor; smaller = stronger inward curve")
+    scanlines_opacity:  float       = InputField(default = 1.0, description = "Opacity of CRT scan lines")
+    vignette_opacity:   float       = InputField(default = 0.5, description = "Vignette opacity")
+    vignette_roundness: float       = InputField(default = 5.0, description = "Vignette opacity")
+    crt_brightness:     float       = InputField(default = 1.2, description = "Factor by which to brighten the image if using scan lines")
+    low_memory:         bool        = InputField(default = False, description = "Shade in float32 row bands to cut peak memory; output may differ by 1 level on a few pixels")
+
+    def invoke(self, context: InvocationContext) -> ImageCollectionOutput:
+        #   Frames of the same size share one set of cached warp and lighting maps
+        return run_batch(context, self.images, lambda image: crt(image, self.crt_width, self.crt_height, self.crt_curvature, self.scanlines_opacity, self.vignette_opacity, self.vignette_roundness, self.crt_brightness, self.low_memory), node = self)
@@ -1,4 +1,10 @@
 from PIL import Image
+import numpy as np
+from .retro_buffer import BIT_OUTPUT_FORMATS
+from .retro_dither import DITHER_MODES, dither_gray, is_ordered
+from .retro_profile import to_mode
+from .retro_resultcache import WithResultCache, run_cached
+from .retro_tiles import map_tiles, should_tile
 
 
 from invokeai.invocation_api import (
@@ -11,29 +17,33 @@ from invokeai.invocation_api import (
     ImageField
     )
 
-@invocation("retro_bitize", title = "Bitize", tags = ["retro", "image", "color", "pixel", "bit", "dither"], category = "image", version = "1.0.1")
-class RetroBitizeInvocation(BaseInvocation, WithMetadata):
+def bitize(image, dither, dither_mode = "Floyd-Steinberg", row_offset = 0):
+    ''' Bitize an image of any mode; returns a '1' image '''
+    #   Thresholding without dither or with an ordered dither is per pixel, so large images go band by band
+    if (not dither or is_ordered(dither_mode)) and should_tile(image):
+        return map_tiles(image, lambda tile, start, stop: bitize(tile, dither, dither_mode, start), mode = "1")
+
+    if dither and dither_mode != "Floyd-Steinberg":
+        return Image.fromarray(dither_gray(np.asarray(to_mode(image, "L")), dither_mode, row_offset) > 127)
+
+    #   Gray and one-bit images threshold the same directly as through RGB, and so do undithered
+    #   indexed ones; Pillow's Floyd-Steinberg from color needs the RGB pixels
+    if image.mode not in ("1", "L") and (dither or image.mode != "P"):
+        image = to_mode(image, "RGB")
+
+    dither = Image.Dither.FLOYDSTEINBERG if dither else Image.Dither.NONE
+
+    return image.convert("1", dither = dither)
+
+@invocation("retro_bitize", title = "Bitize", tags = ["retro", "image", "color", "pixel", "bit", "dither"], category = "image", version = "1.3.1")
+class RetroBitizeInvocation(BaseInvocation, WithMetadata, WithResultCache):
     ''' Crush an image to one-bit pixels '''
 
     #   Inputs
     image:  ImageField  = InputField(description = "Input image for pixelization")
     dither: bool        = InputField(default = True, description = "Dither the Bitized image")
+    dither_mode: DITHER_MODES = InputField(default = "Floyd-Steinberg", description = "Dithering algorithm; ordered modes (Bayer, Blue Noise) are the fastest")
+    output_format: BIT_OUTPUT_FORMATS = InputField(default = "RGB", description = "Save as RGB, or as a 1-bit PNG that is several times smaller")
 
     def invoke(self, context: InvocationContext) -> ImageOutput:
-        image = context.images.get_pil(self.image.image_name)
-        
-        dither = Image.Dither.NONE
-
-        image = image.convert("RGB") if image.mode != "RGB" else image
-        
-        dither = Image.Dither.FLOYDSTEINBERG if self.dither else Image.Dither.NONE
-        
-        image = image.convert("1", dither = dither).convert("RGB")
-
-        dto = context.images.save(image = image)
-
-        return ImageOutput(
-            image = ImageField(image_name = dto.image_name),
-            width = dto.width,
-            height = dto.height,
-        )
\ No newline at end of file
+        return run_cached(context, self, lambda image: bitize(image, self.dither, self.dither_mode))
\ No newline at end of file
@@ -0,0 +1,132 @@
+from threading import Lock
+from typing import Literal
+import numpy as np
+from PIL import Image
+from .retro_unique import distinct_inverse, pack_rgb, unpack_rgb
+
+#   Effects hand each other images in the representation they produced: 'P' with its palette after
+#   palettizing and quantizing, '1' or 'L' after bitizing, RGB otherwise. A consumer converts only to
+#   what it needs, through retro_profile.to_mode, and the RGB conversion of the output happens once,
+#   when it is saved. The helpers below let color mapping work on an indexed image's palette instead
+#   of its pixels.
+
+class BufferStats:
+    ''' Full-frame mode conversions done, and those skipped because the image was already in the
+    mode asked for, with the decoded bytes each would have produced '''
+
+    def __init__(self):
+        self.converted = 0
+        self.converted_bytes = 0
+        self.kept = 0
+        self.kept_bytes = 0
+        self._lock = Lock()
+
+    def count(self, image, mode, converted):
+        width, height = image.size
+        nbytes = width * height * (1 if mode in ("1", "L", "P") else len(mode))
+        with self._lock:
+            if converted:
+                self.converted += 1
+                self.converted_bytes += nbytes
+            else:
+                self.kept += 1
+                self.kept_bytes += nbytes
+
+    def clear(self):
+        with self._lock:
+            self.converted = self.converted_bytes = self.kept = self.kept_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "converted": self.converted,
+                "converted_bytes": self.converted_bytes,
+                "kept": self.kept,
+                "kept_bytes": self.kept_bytes,
+            }
+
+buffer_stats = BufferStats()
+
+#   Saved image formats of the nodes whose output has few colors
+OUTPUT_FORMATS = Literal[
+    "RGB",
+    "Indexed",
+]
+
+BIT_OUTPUT_FORMATS = Literal[
+    "RGB",
+    "1-bit",
+]
+
+OUTPUT_MODES = {
+    "RGB": "RGB",
+    "Indexed": "P",
+    "1-bit": "1",
+}
+
+def output_mode(node):
+    ''' Mode a node's output is saved in: its output format's, or RGB for nodes without one '''
+    return OUTPUT_MODES[getattr(node, "output_format", "RGB")]
+
+def indexed(image):
+    ''' The (height, width) palette indices and (256, 3) uint8 color table of a 'P' image, or None for
+    any other image. A transparent entry keeps its color, as it does when Pillow converts to RGB. '''
+    if image.mode != "P":
+        return None
+    palette = np.array(image.getpalette("RGB") or [], dtype = np.uint8).reshape(-1, 3)[:256]
+    #   Indices past a short palette read as black, as they do when Pillow converts the image
+    colors = np.zeros((256, 3), dtype = np.uint8)
+    colors[:len(palette)] = palette
+    return np.asarray(image), colors
+
+def map_indexed(image, mapping):
+    ''' Apply mapping, from (N, 3) uint8 colors to N uint8 values, to the color table of a 'P' image and
+    expand the result to (height, width) with one gather. Returns None when the image is not indexed. '''
+    view = indexed(image)
+    if view is None:
+        return None
+    indices, colors = view
+    return np.take(np.asarray(mapping(colors), dtype = np.uint8), indices)
+
+def used_colors(image):
+    ''' The distinct colors a 'P' image actually uses, in packed order like retro_unique.distinct_colors,
+    or None when the image is not indexed '''
+    view = indexed(image)
+    if view is None:
+        return None
+    used = [index for _, index in image.getcolors(256)]
+    return unpack_rgb(np.unique(pack_rgb(view[1][used])))
+
+def compact_palette(image):
+    ''' A 'P' image whose palette holds only the entries it uses, so that the PNG encoder can store
+    16 colors or fewer in 1, 2 or 4 bits per pixel. Images with a transparent entry are left as they are. '''
+    if "transparency" in image.info:
+        return image
+    indices, colors = indexed(image)
+    used = np.array(sorted(index for _, index in image.getcolors(256)), dtype = np.uint8)
+    palette_size = len(image.getpalette("RGB") or []) // 3
+    if len(used) == palette_size and used[-1] == len(used) - 1:
+        return image
+
+    remap = np.zeros(256, dtype = np.uint8)
+    remap[used] = np.arange(len(used), dtype = np.uint8)
+    compact = Image.fromarray(np.take(remap, indices), mode = "L")
+    compact.putpalette(colors[used].reshape(-1))
+    return compact
+
+def to_indexed(image):
+    ''' image as a compact 'P' image without changing a pixel, or None when it has more than 256 colors '''
+    if image.mode in ("1", "L"):
+        image = image.convert("P")
+    if image.mode == "P":
+        return compact_palette(image)
+    if image.mode != "RGB":
+        return None
+
+    distinct = distinct_inverse(np.asarray(image), 256)
+    if distinct is None:
+        return None
+    codes, inverse = distinct
+    output = Image.fromarray(inverse.astype(np.uint8), mode = "L")
+    output.putpalette(unpack_rgb(codes).reshape(-1))
+    return output
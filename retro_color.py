@@ -0,0 +1,62 @@
+from typing import Literal
+import numpy as np
+
+COLOR_METRICS = Literal[
+    "RGB",
+    "OKLab",
+    "CIELAB",
+]
+
+#   Linear sRGB to LMS cone response, and cube-rooted LMS to OKLab (Ottosson, 2020)
+OKLAB_M1 = np.array([
+    [0.4122214708, 0.5363325363, 0.0514459929],
+    [0.2119034982, 0.6806995451, 0.1073969566],
+    [0.0883024619, 0.2817188376, 0.6299787005],
+], dtype = np.float32)
+OKLAB_M2 = np.array([
+    [0.2104542553, 0.7936177850, -0.0040720468],
+    [1.9779984951, -2.4285922050, 0.4505937099],
+    [0.0259040371, 0.7827717662, -0.8086757660],
+], dtype = np.float32)
+
+#   Linear sRGB to CIE XYZ, scaled by the D65 white point so white maps to (1, 1, 1)
+XYZ_D65 = (np.array([
+    [0.4124564, 0.3575761, 0.1804375],
+    [0.2126729, 0.7151522, 0.0721750],
+    [0.0193339, 0.1191920, 0.9503041],
+]) / np.array([0.95047, 1.0, 1.08883])[:, None]).astype(np.float32)
+
+def srgb_to_linear(rgb):
+    ''' (..., 3) uint8 sRGB to float32 linear light in [0, 1] '''
+    c = np.asarray(rgb, dtype = np.float32) / 255.0
+    return np.where(c <= 0.04045, c / 12.92, ((c + 0.055) / 1.055) ** 2.4).astype(np.float32)
+
+def rgb_to_oklab(rgb):
+    lms = srgb_to_linear(rgb) @ OKLAB_M1.T
+    return np.cbrt(lms) @ OKLAB_M2.T
+
+def rgb_to_lab(rgb):
+    xyz = srgb_to_linear(rgb) @ XYZ_D65.T
+    f = np.where(xyz > (6 / 29) ** 3, np.cbrt(xyz), xyz / (3 * (6 / 29) ** 2) + 4 / 29)
+    return np.stack([116 * f[..., 1] - 16, 500 * (f[..., 0] - f[..., 1]), 200 * (f[..., 1] - f[..., 2])], axis = -1).astype(np.float32)
+
+def to_metric_space(rgb, metric):
+    ''' Convert (..., 3) sRGB colors into the space where Euclidean distance is the chosen metric '''
+    if metric == "OKLab":
+        return rgb_to_oklab(rgb)
+    if metric == "CIELAB":
+        return rgb_to_lab(rgb)
+    return np.asarray(rgb, dtype = np.float32)
+
+#   Colors matched against the palette per step
+MATCH_CHUNK = 1 << 16
+
+def nearest_colors(points, palette):
+    ''' Index of the nearest palette point for every point, both already in the metric space '''
+    palette_sq = (palette ** 2).sum(axis = 1)
+    nearest = np.empty(len(points), dtype = np.intp)
+    for start in range(0, len(points), MATCH_CHUNK):
+        chunk = points[start:start + MATCH_CHUNK]
+        #   |c - p|^2 without the |c|^2 term, which is the same for every palette color
+        nearest[start:start + MATCH_CHUNK] = (palette_sq - 2.0 * (chunk @ palette.T)).argmin(axis = 1)
+    return nearest
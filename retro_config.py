@@ -0,0 +1,51 @@
+import os
+
+#   Package-wide settings, overridable through RETROIZE_* environment variables
+
+def env_int(name, default):
+    try:
+        return int(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+#   Byte budget of the CRT warp/lighting map cache
+CRT_MAP_CACHE_BYTES = env_int("RETROIZE_CRT_MAP_CACHE_BYTES", 256 * 1024 * 1024)
+
+#   Rows per band in the CRT node's low-memory mode
+CRT_BAND_ROWS = max(1, env_int("RETROIZE_CRT_BAND_ROWS", 128))
+
+#   Byte budget of the cached scanline profiles and blend tables
+SCANLINE_CACHE_BYTES = env_int("RETROIZE_SCANLINE_CACHE_BYTES", 8 * 1024 * 1024)
+
+#   Bits per channel of the palette lookup tables (6 = 64x64x64 bins, as in Pillow's palette cache)
+LUT_BITS = min(max(env_int("RETROIZE_LUT_BITS", 6), 1), 8)
+
+#   Byte budget of the in-memory palette lookup table cache
+LUT_CACHE_BYTES = env_int("RETROIZE_LUT_CACHE_BYTES", 64 * 1024 * 1024)
+
+#   Byte budget of the in-memory palette store
+PALETTE_CACHE_BYTES = env_int("RETROIZE_PALETTE_CACHE_BYTES", 16 * 1024 * 1024)
+
+#   K-Means quantizing learns from an image's distinct colors instead of a pixel sample when each color covers at least this many pixels on average
+UNIQUE_MIN_PIXELS_PER_COLOR = max(1, env_int("RETROIZE_UNIQUE_MIN_PIXELS_PER_COLOR", 16))
+
+#   Node phase profiling: samples kept per node and phase for percentiles, and whether each run is also
+#   logged and stored in the saved image's metadata
+PROFILE_SAMPLES = max(1, env_int("RETROIZE_PROFILE_SAMPLES", 1024))
+PROFILE_LOG = env_int("RETROIZE_PROFILE_LOG", 0) != 0
+PROFILE_METADATA = env_int("RETROIZE_PROFILE_METADATA", 0) != 0
+
+#   Rows per band in which sequence mode looks for pixels changed since the previous frame; the changed
+#   columns of such bands are mapped again
+SEQUENCE_BAND_ROWS = max(1, env_int("RETROIZE_SEQUENCE_BAND_ROWS", 32))
+
+#   Worker threads of the shared package thread pool
+THREADS = max(1, env_int("RETROIZE_THREADS", min(32, os.cpu_count() or 1)))
+
+#   Folder holding the result cache index, and the decoded size of the outputs it may reference
+RESULT_CACHE_DIR = os.environ.get("RETROIZE_RESULT_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache"))
+RESULT_CACHE_BYTES = env_int("RETROIZE_RESULT_CACHE_BYTES", 2 * 1024 * 1024 * 1024)
+
+#   Images above this many pixels are processed in row bands of about RETROIZE_TILE_PIXELS pixels by the point-wise and local effects
+TILE_PIXELS = max(1, env_int("RETROIZE_TILE_PIXELS", 1024 * 1024))
+TILE_THRESHOLD_PIXELS = max(TILE_PIXELS, env_int("RETROIZE_TILE_THRESHOLD_PIXELS", 16 * 1024 * 1024))
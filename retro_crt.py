@@ -1,5 +1,11 @@
 from PIL import Image
 import numpy as np
+from .retro_cache import LRUCache
+from .retro_config import CRT_BAND_ROWS, CRT_MAP_CACHE_BYTES
+from .retro_parallel import run_bands
+from .retro_profile import to_mode
+from .retro_resultcache import WithResultCache, run_cached
+from .retro_tiles import map_bands, should_tile
 
 from invokeai.invocation_api import(
     BaseInvocation,
@@ -12,8 +18,183 @@ from invokeai.invocation_api import(
 )
 
 
-@invocation("retro_crt_curvature", title = "CRT", tags = ["retro", "image", "distort"], category = "image", version = "1.0.1")
-class RetroCRTCurvatureInvocation(BaseInvocation, WithMetadata):
+def scanline_intensity(uv, resolution, opacity):
+    #   Calculate intensity
+    intensity = np.sin(uv * resolution * np.pi * 2.0)
+
+    #   Remap intensity to the range (0.1, 1.0)
+    intensity = ((0.5 * intensity) + 0.5) * 0.9 + 0.1
+
+    return intensity**opacity
+
+def vignette_intensity(uvX, uvY, resolution, opacity, roundness):
+    #   Calculate the intensity for all pixels using vectorized operations
+    intensity = uvX * uvY * (1.0 - uvX) * (1.0 - uvY)
+
+    #   Clip the intensity values to be in the range [0, 1]
+    intensity = np.clip((resolution[0] / roundness) * intensity, 0.0, 1.0)
+
+    #   Apply opacity to the intensity for all pixels
+    intensity = intensity ** opacity
+
+    return intensity
+
+def crt_maps(width, height, crt_resolution, curvature, scanlines_opacity, vignette_opacity, vignette_roundness, brightness, rows = None, dtype = np.float64):
+    ''' Build the inverse warp map and per-channel lighting gain of the CRT shader.
+    Returns the flat source pixel index for every output pixel and an (height, width, 3) gain;
+    pixels that fall outside the curved screen get a gain of 0. Pass rows=(start, stop) to
+    build the maps for a band of output rows only, and dtype to choose the gain precision. '''
+    start, stop = rows if rows is not None else (0, height)
+
+    #   Create UV grid as a row and a column vector; they broadcast to the full band.
+    #   UVs stay float64 so every mode samples exactly the same source pixels
+    uvX = np.linspace(0, 1, width)[None, :]
+    uvY = np.linspace(0, 1, height)[start:stop, None]
+
+    #   Remap UVs
+    uvX = uvX * 2 - 1
+    uvY = uvY * 2 - 1
+    offsetX = np.abs(uvY) / curvature
+    offsetY = np.abs(uvX) / curvature
+    uvX = (uvX + uvX * offsetX * offsetX) * 0.5 + 0.5
+    uvY = (uvY + uvY * offsetY * offsetY) * 0.5 + 0.5
+
+    #   Map UV coords to original image
+    src_index = (uvY * (height - 1)).clip(0, height - 1).astype(np.intp) * width
+    src_index += (uvX * (width - 1)).clip(0, width - 1).astype(np.intp)
+
+    #   Fold vignette, scanlines and brightness into one gain per channel
+    gain = np.ones((stop - start, width, 3), dtype = dtype)
+    if vignette_opacity > 0:
+        gain *= vignette_intensity(uvX, uvY, crt_resolution, vignette_opacity, vignette_roundness)[..., None]
+    if scanlines_opacity > 0:
+        gain[..., 0] *= scanline_intensity(uvX, crt_resolution[1], scanlines_opacity)
+        gain[..., 1:] *= scanline_intensity(uvY, crt_resolution[0], scanlines_opacity)[..., None]
+    if brightness > 0:
+        gain *= brightness
+
+    #   Black out pixels outside UV range
+    outside = (uvX < 0.0) | (uvX > 1.0) | (uvY < 0.0) | (uvY > 1.0)
+    gain[outside] = 0.0
+
+    return src_index, gain
+
+#   Warp and lighting maps depend only on frame size and node parameters, so repeated frames share them
+crt_map_cache = LRUCache(CRT_MAP_CACHE_BYTES)
+
+def cached_crt_maps(*args):
+    def build():
+        src_index, gain = crt_maps(*args)
+        #   Compact, read-only copies; these are shared between invocations
+        width, height = args[:2]
+        src_index = src_index.astype(np.int32 if width * height < 2**31 else np.int64)
+        gain = gain.astype(np.float32)
+        src_index.flags.writeable = False
+        gain.flags.writeable = False
+        return src_index, gain
+
+    return crt_map_cache.get_or_create(args, build)
+
+def shade(source, src_index, gain):
+    ''' Gather the warped pixels from the flat source and light them, as uint8 '''
+    crt_array = source[src_index] / 255.0
+    crt_array *= gain
+    np.clip(crt_array, 0.0, 1.0, out = crt_array)
+    return (crt_array.astype(np.float32) * 255).astype(np.uint8)
+
+def shade_low_memory(source, src_index, gain, out, work = None):
+    ''' Float32 shading in 0..255, skipping the normalize/denormalize passes; writes into out '''
+    band = work[:len(gain)] if work is not None else np.empty(gain.shape, dtype = np.float32)
+    band[...] = source[src_index]
+    band *= gain
+    np.clip(band, 0.0, 255.0, out = band)
+    out[...] = band
+
+def crt_effect(image_array, crt_resolution, curvature, scanlines_opacity, vignette_opacity, vignette_roundness, brightness, low_memory = False, parallel = False):
+    ''' Apply the CRT shader to an (height, width, 3) uint8 array, returning a new uint8 array.
+    With parallel, row bands are shaded concurrently on the shared pool; the output is unchanged. '''
+    if low_memory:
+        return crt_effect_banded(image_array, crt_resolution, curvature, scanlines_opacity, vignette_opacity, vignette_roundness, brightness, parallel = parallel)
+
+    height, width = image_array.shape[:2]
+
+    src_index, gain = cached_crt_maps(width, height, crt_resolution, curvature, scanlines_opacity, vignette_opacity, vignette_roundness, brightness)
+
+    #   One gather from the source, one multiply by the lighting gain
+    source = image_array.reshape(-1, 3)
+    crt_array = np.empty_like(image_array)
+
+    def band(start, stop):
+        crt_array[start:stop] = shade(source, src_index[start:stop], gain[start:stop])
+
+    run_bands(band, height, parallel)
+    return crt_array
+
+def crt_effect_banded(image_array, crt_resolution, curvature, scanlines_opacity, vignette_opacity, vignette_roundness, brightness, band_rows = CRT_BAND_ROWS, parallel = False):
+    ''' Memory-lean CRT shader: maps are built per band of rows in float32 and the
+    band is shaded in one reused float32 buffer, written straight into the uint8 output '''
+    height, width = image_array.shape[:2]
+    source = image_array.reshape(-1, 3)
+    crt_array = np.empty_like(image_array)
+    #   Concurrent bands each need their own buffer
+    work = None if parallel else np.empty((min(band_rows, height), width, 3), dtype = np.float32)
+
+    def band(start, stop):
+        src_index, gain = crt_maps(width, height, crt_resolution, curvature, scanlines_opacity, vignette_opacity, vignette_roundness, brightness, rows = (start, stop), dtype = np.float32)
+        shade_low_memory(source, src_index, gain, crt_array[start:stop], work)
+
+    run_bands(band, height, parallel, rows = band_rows)
+    return crt_array
+
+def crt_tiled(image, crt_resolution, curvature, scanlines_opacity, vignette_opacity, vignette_roundness, brightness, low_memory = False, parallel = False):
+    ''' CRT shader for large PIL images. Maps are built per band of output rows and each band crops only
+    the source rows its inverse warp reaches, so peak memory is the input and output plus one band.
+    The shading replicates crt_effect in the chosen mode, so the output is identical. '''
+    width, height = image.size
+
+    def band(start, stop):
+        src_index, gain = crt_maps(width, height, crt_resolution, curvature, scanlines_opacity, vignette_opacity, vignette_roundness, brightness, rows = (start, stop), dtype = np.float32 if low_memory else np.float64)
+
+        #   Source rows under this band, and the band's index into them
+        first, last = src_index.min() // width, src_index.max() // width + 1
+        source = image.crop((0, first, width, last))
+        source = np.asarray(to_mode(source, "RGB")).reshape(-1, 3)
+        src_index -= first * width
+
+        if low_memory:
+            crt_array = np.empty(gain.shape, dtype = np.uint8)
+            shade_low_memory(source, src_index, gain, crt_array)
+        else:
+            #   Same float32 gain as the cached maps
+            crt_array = shade(source, src_index, gain.astype(np.float32))
+
+        return Image.fromarray(crt_array)
+
+    return map_bands(band, image.size, parallel = parallel)
+
+def crt(image, crt_width, crt_height, crt_curvature, scanlines_opacity, vignette_opacity, vignette_roundness, crt_brightness, low_memory = False, parallel = False):
+    if should_tile(image):
+        return crt_tiled(image, (crt_width, crt_height), crt_curvature, scanlines_opacity, vignette_opacity, vignette_roundness, crt_brightness, low_memory, parallel)
+
+    image = to_mode(image, "RGB")
+
+    crt_array = crt_effect(
+        np.asarray(image),
+        crt_resolution = (crt_width, crt_height),
+        curvature = crt_curvature,
+        scanlines_opacity = scanlines_opacity,
+        vignette_opacity = vignette_opacity,
+        vignette_roundness = vignette_roundness,
+        brightness = crt_brightness,
+        low_memory = low_memory,
+        parallel = parallel,
+    )
+
+    return Image.fromarray(crt_array)
+
+
+@invocation("retro_crt_curvature", title = "CRT", tags = ["retro", "image", "distort"], category = "image", version = "1.3.0")
+class RetroCRTCurvatureInvocation(BaseInvocation, WithMetadata, WithResultCache):
     """ Distort the input image, simulating CRT display curvature """
 
     #   Inputs
@@ -25,100 +206,8 @@ class RetroCRTCurvatureInvocation(BaseInvocation, WithMetadata):
     vignette_opacity:   float       = InputField(default = 0.5, description = "Vignette opacity")
     vignette_roundness: float       = InputField(default = 5.0, description = "Vignette opacity")
     crt_brightness:     float       = InputField(default = 1.2, description = "Factor by which to brighten the image if using scan lines")
+    low_memory:         bool        = InputField(default = False, description = "Shade in float32 row bands to cut peak memory; output may differ by 1 level on a few pixels")
+    parallel:           bool        = InputField(default = False, description = "Shade row bands on several CPU cores; the output is identical")
 
     def invoke(self, context: InvocationContext) -> ImageOutput:
-        
-        def scanline_intensity(uv, resolution, opacity):
-            #   Calculate intensity
-            intensity = np.sin(uv * resolution * np.pi * 2.0)
-    
-            #   Remap intensity to the range (0.1, 1.0)
-            intensity = ((0.5 * intensity) + 0.5) * 0.9 + 0.1
-    
-            return intensity**opacity
-
-        def vignette_intensity(uv, resolution, opacity, roundness):
-            uvX = uv[..., 0]    #   Extract the x-coordinates
-            uvY = uv[..., 1]    #   Extract the y-coordinates
-    
-            #   Calculate the intensity for all pixels using vectorized operations
-            intensity = uvX * uvY * (1.0 - uvX) * (1.0 - uvY)
-    
-            #   Clip the intensity values to be in the range [0, 1]
-            intensity = np.clip((resolution[0] / roundness) * intensity, 0.0, 1.0)
-    
-            #   Apply opacity to the intensity for all pixels
-            intensity = intensity ** opacity
-    
-            return intensity
-        
-        image = context.images.get_pil(self.image.image_name).convert("RGB")
-        width, height = image.size
-        
-        #   Create normalized numpy array from input image
-        image_array = np.array(image) / 255.0
-        
-        #   Define virtual CRT screen resolution and curvature factor
-        crt_resolution = (self.crt_width, self.crt_height)
-
-        #   Create UV grid
-        x, y = np.meshgrid(np.linspace(0, 1, width), np.linspace(0, 1, height))
-        uv = np.stack((x, y), axis = -1)
-        
-        #   Remap UVs
-        uv = uv * 2 - 1
-        offset = np.abs(uv[..., [1, 0]]) / self.crt_curvature
-        uv = uv + uv * offset * offset
-        uv = uv * 0.5 + 0.5
-        
-        #   Map UV coords to original image
-        remapped_uvs = (
-            (uv[..., 0] * (width - 1)).clip(0, width - 1).astype(int),
-            (uv[..., 1] * (height - 1)).clip(0, height - 1).astype(int)
-        )
-
-        #   Precompute vignette and scanlines
-        vignette_effect = vignette_intensity(uv, crt_resolution, self.vignette_opacity, self.vignette_roundness) if self.vignette_opacity > 0 else 0
-        scanline_x_intensity = scanline_intensity(uv[..., 0], crt_resolution[1], self.scanlines_opacity) if self.scanlines_opacity > 0 else 0
-        scanline_y_intensity = scanline_intensity(uv[..., 1], crt_resolution[0], self.scanlines_opacity) if self.scanlines_opacity > 0 else 0        
-
-        #   Create an array for manipulation of pixels using the input image's dimensions
-        crt_array = np.zeros((height, width, 3), dtype=np.float32)
-        
-        # Iterate over each pixel and apply the GLSL shader operations
-        for y in range(height):
-            for x in range(width):
-                # Fetch pixel color from the original image_array
-                base_color = image_array[remapped_uvs[1][y, x], remapped_uvs[0][y, x]]
-        
-                # Apply vignetteIntensity as a scaling factor
-                if self.vignette_opacity > 0:
-                    base_color *= vignette_effect[y, x]
-
-                # Apply scanLineIntensity separately to x and y components
-                if self.scanlines_opacity > 0:
-                    base_color[0] *= scanline_x_intensity[y, x]
-                    base_color[1] *= scanline_y_intensity[y, x]
-                    base_color[2] *= scanline_y_intensity[y, x]
-
-                #   Adjust brightness
-                if self.crt_brightness > 0:
-                    base_color *= self.crt_brightness
-
-                #   Clip pixels outside UV range
-                if any(uv[y, x] < 0.0) or any(uv[y, x] > 1.0):
-                    final_color = np.array([0.0, 0.0, 0.0])
-                else:
-                    final_color = np.clip(base_color, 0.0, 1.0)
-
-                crt_array[y, x] = final_color
-
-        image = Image.fromarray((crt_array * 255).astype(np.uint8)).convert("RGB")
-        
-        dto = context.images.save(image = image)
-
-        return ImageOutput(
-            image = ImageField(image_name = dto.image_name),
-            width = dto.width,
-            height = dto.height,
-        )
\ No newline at end of file
+        return run_cached(context, self, lambda image: crt(image, self.crt_width, self.crt_height, self.crt_curvature, self.scanlines_opacity, self.vignette_opacity, self.vignette_roundness, self.crt_brightness, self.low_memory, self.parallel))
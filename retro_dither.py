@@ -0,0 +1,225 @@
+from typing import Literal
+import numpy as np
+from .retro_cache import LRUCache
+from .retro_lut import apply_lut, get_lut
+from .retro_parallel import run_bands
+
+DITHER_MODES = Literal[
+    "Floyd-Steinberg",
+    "Bayer 2x2",
+    "Bayer 4x4",
+    "Bayer 8x8",
+    "Bayer 16x16",
+    "Blue Noise",
+    "Atkinson",
+    "Sierra",
+    "Jarvis",
+]
+
+#   Threshold map size of the ordered modes
+ORDERED_SIZES = {
+    "Bayer 2x2": 2,
+    "Bayer 4x4": 4,
+    "Bayer 8x8": 8,
+    "Bayer 16x16": 16,
+    "Blue Noise": 64,
+}
+
+#   Error diffusion kernels as (divisor, [(row, column, weight), ...]) relative to the current pixel
+KERNELS = {
+    #   Floyd-Steinberg natively, for matching under a perceptual metric
+    "Floyd-Steinberg": (16, [(0, 1, 7), (1, -1, 3), (1, 0, 5), (1, 1, 1)]),
+    "Atkinson": (8, [(0, 1, 1), (0, 2, 1), (1, -1, 1), (1, 0, 1), (1, 1, 1), (2, 0, 1)]),
+    "Sierra": (32, [(0, 1, 5), (0, 2, 3), (1, -2, 2), (1, -1, 4), (1, 0, 5), (1, 1, 4), (1, 2, 2), (2, -1, 2), (2, 0, 3), (2, 1, 2)]),
+    "Jarvis": (48, [(0, 1, 7), (0, 2, 5), (1, -2, 3), (1, -1, 5), (1, 0, 7), (1, 1, 5), (1, 2, 3), (2, -2, 1), (2, -1, 3), (2, 0, 5), (2, 1, 3), (2, 2, 1)]),
+}
+
+#   Threshold maps only depend on the mode, so they are built once
+dither_cache = LRUCache(4 * 1024 * 1024)
+
+def is_ordered(mode):
+    return mode in ORDERED_SIZES
+
+def bayer_matrix(size):
+    ''' Ranks of the recursive Bayer matrix of a power-of-two size '''
+    matrix = np.zeros((1, 1), dtype = np.int64)
+    while len(matrix) < size:
+        matrix = np.block([[4 * matrix, 4 * matrix + 2], [4 * matrix + 3, 4 * matrix + 1]])
+    return matrix
+
+def blue_noise_matrix(size, sigma = 1.5, seed = 0):
+    ''' Ranks of a tileable blue-noise threshold map, built with Ulichney's void-and-cluster method.
+    Energy is the toroidal Gaussian-filtered pattern, updated incrementally as points move. '''
+    offsets = np.minimum(np.arange(size), size - np.arange(size))
+    kernel = np.exp(-(offsets[:, None] ** 2 + offsets[None, :] ** 2) / (2 * sigma ** 2))
+
+    def splat(energy, position, sign):
+        y, x = divmod(position, size)
+        energy += sign * np.roll(kernel, (y, x), axis = (0, 1)).reshape(-1)
+
+    #   Initial pattern: a tenth of the cells, then swap the tightest cluster into the largest void until stable
+    pattern = np.zeros(size * size, dtype = bool)
+    pattern[np.random.default_rng(seed).choice(size * size, size * size // 10, replace = False)] = True
+    energy = np.real(np.fft.ifft2(np.fft.fft2(pattern.reshape(size, size)) * np.fft.fft2(kernel))).reshape(-1)
+    while True:
+        cluster = np.where(pattern, energy, -np.inf).argmax()
+        pattern[cluster] = False
+        splat(energy, cluster, -1)
+        void = np.where(pattern, np.inf, energy).argmin()
+        pattern[void] = True
+        splat(energy, void, 1)
+        if void == cluster:
+            break
+
+    ranks = np.zeros(size * size, dtype = np.int64)
+    count = int(pattern.sum())
+
+    #   Rank the initial points by removing the tightest clusters first
+    ones, ones_energy = pattern.copy(), energy.copy()
+    for rank in range(count - 1, -1, -1):
+        cluster = np.where(ones, ones_energy, -np.inf).argmax()
+        ones[cluster] = False
+        splat(ones_energy, cluster, -1)
+        ranks[cluster] = rank
+
+    #   Then fill the largest voids; past half full this is also the tightest cluster of the remaining zeros
+    for rank in range(count, size * size):
+        void = np.where(pattern, np.inf, energy).argmin()
+        pattern[void] = True
+        splat(energy, void, 1)
+        ranks[void] = rank
+
+    return ranks.reshape(size, size)
+
+def threshold_matrix(mode):
+    ''' Threshold offsets of an ordered mode, evenly spread over [-0.5, 0.5) '''
+    def build():
+        size = ORDERED_SIZES[mode]
+        ranks = blue_noise_matrix(size) if mode == "Blue Noise" else bayer_matrix(size)
+        matrix = (ranks + 0.5) / ranks.size - 0.5
+        matrix.flags.writeable = False
+        return matrix
+
+    return dither_cache.get_or_create(("threshold", mode), build)
+
+def palette_spread(colors):
+    ''' Typical per-channel gap between neighbouring palette colors: the amplitude of ordered dithering '''
+    if len(colors) < 2:
+        return 0.0
+    palette = colors.astype(np.float64)
+    distance = np.sqrt(((palette[:, None] - palette[None]) ** 2).sum(axis = -1))
+    np.fill_diagonal(distance, np.inf)
+    distance[distance == 0] = np.inf
+    nearest = distance.min(axis = 1)
+    nearest = nearest[np.isfinite(nearest)]
+    return float(np.median(nearest)) / np.sqrt(3) if len(nearest) else 0.0
+
+def threshold_rows(mode, spread, start, stop, width):
+    ''' The integer offsets of an ordered mode for rows start..stop of an image of the given width '''
+    matrix = np.rint(threshold_matrix(mode) * spread).astype(np.int16)
+    size = len(matrix)
+    rows = matrix[np.arange(start, stop) % size]
+    return np.tile(rows, (1, -(-width // size)))[:, :width]
+
+def ordered_indices(image_array, colors, mode, row_offset = 0, parallel = False, metric = "RGB"):
+    ''' Ordered dithering of an (height, width, 3) uint8 array onto a palette: every pixel is shifted by
+    its threshold and looked up in the palette table. Returns (height, width) palette indices.
+    row_offset is the row of the first line within the whole image, so bands line up. '''
+    height, width = image_array.shape[:2]
+    lut = get_lut(colors, metric = metric)
+    spread = palette_spread(colors)
+    indices = np.empty((height, width), dtype = lut.dtype)
+
+    def band(start, stop):
+        block = image_array[start:stop].astype(np.int16)
+        block += threshold_rows(mode, spread, row_offset + start, row_offset + stop, width)[..., None]
+        np.clip(block, 0, 255, out = block)
+        indices[start:stop] = apply_lut(block.astype(np.uint8), lut)
+
+    run_bands(band, height, parallel)
+    return indices
+
+def ordered_gray(gray, mode, row_offset = 0):
+    ''' Ordered dithering of an (height, width) uint8 array to black and white '''
+    height, width = gray.shape
+    shifted = gray.astype(np.int16) + threshold_rows(mode, 255, row_offset, row_offset + height, width)
+    return np.where(shifted >= 128, 255, 0).astype(np.uint8)
+
+def diffuse(values, mode, nearest):
+    ''' Error diffusion of a (height, width, channels) float32 array in raster order. nearest maps an
+    (n, channels) array of values to their palette indices and colors. Pixels on the anti-diagonal
+    x + k*y = t receive no error from each other, so each diagonal is processed as one vector step.
+    k also orders every pixel's sources the way a raster scan meets them, so each pixel sums its
+    errors in the same order and the result is bit-identical to a pixel-by-pixel raster scan. '''
+    divisor, taps = KERNELS[mode]
+    height, width, channels = values.shape
+
+    #   A source reaching a pixel through tap a comes before one reaching it through tap b in raster order
+    #   when dy_a > dy_b; its diagonal must then come first too. The current pixel counts as tap (0, 0).
+    reach = [(0, 0)] + [(dy, dx) for dy, dx, _ in taps]
+    k = max([(dx_b - dx_a) // (dy_a - dy_b) + 1 for dy_a, dx_a in reach for dy_b, dx_b in reach if dy_a > dy_b] + [1])
+    pad = max(abs(dx) for _, dx, _ in taps)
+    depth = max(dy for dy, _, _ in taps)
+    #   A diagonal steps stride - k elements through the flat working copy, so that must stay positive
+    stride = max(width + 2 * pad, k + 1)
+    step = stride - k
+
+    #   Padded working copies; error pushed into the padding is dropped
+    work = np.zeros((height + depth, stride, channels), dtype = np.float32)
+    work[:height, pad:pad + width] = values
+    flat = work.reshape(-1, channels)
+    indices = np.zeros((height + depth, stride), dtype = np.uint8)
+    flat_indices = indices.reshape(-1)
+    steps = [(dy * stride + dx, weight / divisor) for dy, dx, weight in taps]
+
+    for t in range(width + k * (height - 1)):
+        first = max(0, -(-(t - width + 1) // k))
+        last = min(height - 1, t // k)
+        #   The diagonal's pixels are evenly spaced in the flat arrays, so every access is a strided view
+        start = first * step + t + pad
+        stop = last * step + t + pad + 1
+
+        pixel = np.clip(flat[start:stop:step], 0.0, 255.0)
+        index, color = nearest(pixel)
+        flat_indices[start:stop:step] = index
+        error = pixel - color
+        for offset, weight in steps:
+            flat[start + offset:stop + offset:step] += error * weight
+
+    return np.ascontiguousarray(indices[:height, pad:pad + width])
+
+def diffuse_indices(image_array, colors, mode, metric = "RGB"):
+    ''' Error-diffuse an (height, width, 3) uint8 array onto a palette, returning palette indices.
+    Errors are diffused in RGB; only the nearest-color choice uses the metric. '''
+    lut = get_lut(colors, metric = metric)
+    table = lut.reshape(-1)
+    bits = lut.shape[0].bit_length() - 1
+    palette = colors.astype(np.float32)
+
+    def nearest(pixel):
+        #   The same bin lookup as apply_lut, without its per-call setup
+        bins = np.rint(pixel).astype(np.uint32) >> (8 - bits)
+        index = table[(bins[:, 0] << (2 * bits)) | (bins[:, 1] << bits) | bins[:, 2]]
+        return index, palette[index]
+
+    return diffuse(image_array.astype(np.float32), mode, nearest)
+
+def diffuse_gray(gray, mode):
+    ''' Error-diffuse an (height, width) uint8 array to black and white '''
+    def nearest(pixel):
+        index = (pixel[:, 0] >= 128).astype(np.uint8)
+        return index, index[:, None] * np.float32(255)
+
+    return diffuse(gray[..., None].astype(np.float32), mode, nearest) * np.uint8(255)
+
+def dither_indices(image_array, colors, mode, row_offset = 0, parallel = False, metric = "RGB"):
+    ''' Dither an (height, width, 3) uint8 array onto a palette with any native mode '''
+    if is_ordered(mode):
+        return ordered_indices(image_array, colors, mode, row_offset, parallel, metric)
+    return diffuse_indices(image_array, colors, mode, metric)
+
+def dither_gray(gray, mode, row_offset = 0):
+    ''' Dither an (height, width) uint8 array to black and white with any native mode '''
+    if is_ordered(mode):
+        return ordered_gray(gray, mode, row_offset)
+    return diffuse_gray(gray, mode)
@@ -1,6 +1,7 @@
 from pathlib import Path
 from .retro_helpers import get_palette, numberize_filename, increment_filename
-from .retro_palettize import UpdatePalettes
+from .retro_palettes import palette_registry
+from .retro_profile import profiling, save_image
 
 from invokeai.invocation_api import (
     BaseInvocation,
@@ -24,29 +25,28 @@ class PaletteOutput(BaseInvocationOutput):
     class Config:
         json_schema_extra = {"required": ["type", "palette"]}
 
-@invocation("get_palette", title = "Get Palette", tags = ["retro", "image", "pixel", "palette"], category = "image", version = "1.0.1")
+@invocation("get_palette", title = "Get Palette", tags = ["retro", "image", "pixel", "palette"], category = "image", version = "1.1.0")
 class RetroGetPaletteInvocation(BaseInvocation, WithMetadata):
     ''' Get palette from an image, 256 colors max. '''
 
     #   Inputs
     image:          ImageField  = InputField(default = None, description = "Input image to grab a palette from")
+    exact:          bool        = InputField(default = False, description = "Use the image's exact colors when it has 256 or fewer")
     
     def invoke(self, context: InvocationContext) -> ImageOutput:
-        image_out = context.images.get_pil(self.image.image_name)
-        
-        if image_out.mode != 'RGB':
-            image_out = image_out.convert('RGB')
-        
-        image_out = get_palette(image_out)
-        
-        #   Do NOT convert palette image to RGB; it needs to be indexed color, not RGB, to be used as a palette
-        dto = context.images.save(image = image_out)
+        with profiling(context, self) as profile:
+            image_out = profile.run("load", context.images.get_pil, self.image.image_name)
+
+            image_out = profile.run("effect", get_palette, image_out, self.exact)
+
+            #   Do NOT convert palette image to RGB; it needs to be indexed color, not RGB, to be used as a palette
+            dto = save_image(context, profile, self, image_out, mode = None)
 
         return PaletteOutput(
             image = ImageField(image_name = dto.image_name)
         )
         
-@invocation("get_palette_adv", title = "Get Palette (Advanced)", tags = ["retro", "image", "pixel", "palette"], category = "image", version = "1.0.1")
+@invocation("get_palette_adv", title = "Get Palette (Advanced)", tags = ["retro", "image", "pixel", "palette"], category = "image", version = "1.1.0")
 class RetroGetPaletteAdvInvocation(BaseInvocation, WithMetadata):
     ''' Get palette from an image, 256 colors max. Optionally export to a user-defined location. '''
     #   Inputs
@@ -54,23 +54,27 @@ class RetroGetPaletteAdvInvocation(BaseInvocation, WithMetadata):
     export:         bool = InputField(default = True, description = "Save palette PNG to specified path with optional name")
     subfolder:      str = InputField(default="", description = "Subfolder for the palette in nodes/Retroize/palettes/ folder")
     name:           str = InputField(default="", description = "Name for the palette image")
+    exact:          bool = InputField(default = False, description = "Use the image's exact colors when it has 256 or fewer")
 
     def invoke(self, context: InvocationContext) -> ImageOutput:
-        image_out = context.images.get_pil(self.image.image_name)
-        
-        if image_out.mode != 'RGB':
-            image_out = image_out.convert('RGB')
-        
+        with profiling(context, self) as profile:
+            image_out = profile.run("load", context.images.get_pil, self.image.image_name)
+            image_out = profile.run("effect", self.make_palette, image_out)
+            dto = save_image(context, profile, self, image_out, mode = None)
+
+        return PaletteOutput(
+            image = ImageField(image_name = dto.image_name)
+        )
+
+    def make_palette(self, image_out):
         if self.export:
-            palettes_dir = "nodes/Retroize/palettes/"
-            out_path = palettes_dir
+            out_path = Path(palette_registry.root)
             if self.subfolder != "":
-                out_path = palettes_dir + self.subfolder
-            out_path = Path(out_path).resolve()
-            print(f"out_path = {out_path}")
-            Path(out_path).mkdir(parents=True, exist_ok=True)
+                out_path = out_path / self.subfolder
+            out_path = out_path.resolve()
+            out_path.mkdir(parents=True, exist_ok=True)
             
-            palette_image = get_palette(image_out)
+            palette_image = get_palette(image_out, self.exact)
             name = self.name
             if name == "":
                     name = self.image.image_name
@@ -81,15 +85,13 @@ class RetroGetPaletteAdvInvocation(BaseInvocation, WithMetadata):
                 name = numberize_filename(out_path, name)
             if (out_path / name).is_file():
                 name = increment_filename(out_path, name)
-            palette_image.save(out_path / name)
+            palette_image.save(out_path / name, optimize = True)
+            #   Index the new palette so Palettize finds it by name before the next restart
+            palette_registry.add(out_path / name)
             image_out = palette_image
                 
         else:
-            image_out = get_palette(image_out)
+            image_out = get_palette(image_out, self.exact)
 
         #   Do NOT convert palette image to RGB; it needs to be indexed color, not RGB, to be used as a palette
-        dto = context.images.save(image = image_out)
-
-        return PaletteOutput(
-            image = ImageField(image_name = dto.image_name)
-        )
\ No newline at end of file
+        return image_out
\ No newline at end of file
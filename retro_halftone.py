@@ -2,7 +2,10 @@ from typing import Literal
 from PIL import Image
 import numpy as np
 import cv2
-import random
+from .retro_config import THREADS
+from .retro_parallel import run_bands
+from .retro_profile import to_mode
+from .retro_resultcache import WithResultCache, run_cached
 
 from invokeai.invocation_api import(
     BaseInvocation,
@@ -20,101 +23,177 @@ SHAPES = Literal[
     "Triangle",
 ]
 
-@invocation("retro_halftone", title = "Halftone", tags = ["retro", "image", "color"], category = "image", version = "1.0.1")
-class RetroHalftoneInvocation(BaseInvocation, WithMetadata):
+def halftone_cells(gray, size, rotation, random_rotation, rotation_threshold, jitter, rng):
+    ''' Compute the per-cell mean intensity, jittered shape size and rotation angle of the halftone grid '''
+    height, width = gray.shape
+    rows, cols = -(-height // size), -(-width // size)
+
+    #   Draw every random offset for the grid in one call each
+    if jitter > 0:
+        sizes = np.maximum(size + rng.integers(-jitter, jitter, size = (rows, cols), endpoint = True), 0)
+    else:
+        sizes = np.full((rows, cols), size)
+    if random_rotation:
+        angles = rng.integers(-rotation_threshold, rotation_threshold, size = (rows, cols), endpoint = True)
+    else:
+        angles = np.full((rows, cols), rotation)
+
+    #   Mean of each (jittered) cell from a summed-area table
+    sat = np.zeros((height + 1, width + 1), dtype = np.int64)
+    np.cumsum(np.cumsum(gray, axis = 0, dtype = np.int64), axis = 1, out = sat[1:, 1:])
+    y0 = (np.arange(rows) * size)[:, None]
+    x0 = (np.arange(cols) * size)[None, :]
+    y1 = np.minimum(y0 + sizes, height)
+    x1 = np.minimum(x0 + sizes, width)
+    total = sat[y1, x1] - sat[y0, x1] - sat[y1, x0] + sat[y0, x0]
+    count = (y1 - y0) * (x1 - x0)
+    means = np.rint(np.divide(total, count, out = np.zeros(total.shape), where = count > 0)).astype(np.uint8)
+
+    return means, sizes, angles
+
+#   Pixels of every shape test temporary while rasterising stamps
+STAMP_CHUNK_PIXELS = 1 << 20
+
+def shape_stamps(shape, size, sizes, angles):
+    ''' Find the distinct (size, angle) shapes of the grid. Returns the stamp index of every cell, the
+    size and angle of every stamp and the offsets of the neighbouring cells whose shape can reach into
+    a cell. '''
+    if shape == "Circle":
+        angles = np.zeros_like(angles)
+
+    #   Pack (size, angle) into one integer key so the distinct shapes come from a 1D unique
+    angle_min = angles.min()
+    angle_span = angles.max() - angle_min + 1
+    keys, stamp_index = np.unique(sizes * angle_span + (angles - angle_min), return_inverse = True)
+    stamp_index = stamp_index.reshape(sizes.shape)
+    stamp_sizes, stamp_angles = np.divmod(keys, angle_span)
+    stamp_angles += angle_min
+
+    #   Which neighbouring cells a rotated or enlarged shape can reach into
+    center = size / 2
+    if shape == "Circle":
+        reach = sizes.max() // 2 + 1
+    else:
+        reach = np.sqrt(2) * max(center, sizes.max() - center) + 1
+    offsets = np.arange(int(np.ceil((-center - reach) / size)), int(np.floor((size - center + reach) / size)) + 1)
+
+    return stamp_index, stamp_sizes, stamp_angles, offsets
+
+def stamp_masks(shape, size, stamp_sizes, stamp_angles, dy, dx):
+    ''' Rasterise every stamp as drawn by the neighbouring cell at offset (dy, dx): a boolean
+    (stamps, size, size) array telling which pixels of a cell that cell's shape covers. Stamps are
+    tested a chunk at a time in float32, so the temporaries stay small however many there are. '''
+    masks = np.empty((len(stamp_sizes), size, size), dtype = bool)
+    #   Pixel coordinates relative to the origin of the neighbouring cell
+    py = (np.arange(size) - dy * size)[None, :, None]
+    px = (np.arange(size) - dx * size)[None, None, :]
+    center = np.float32(size / 2)
+    chunk = max(1, STAMP_CHUNK_PIXELS // (size * size))
+
+    for start in range(0, len(stamp_sizes), chunk):
+        a = stamp_sizes[start:start + chunk].reshape(-1, 1, 1)
+        if shape == "Circle":
+            r = a // 2
+            covered = (px - size // 2) ** 2 + (py - size // 2) ** 2 <= r * r
+        else:
+            #   Undo the rotation about the cell center, then test against the unrotated shape
+            theta = np.deg2rad(stamp_angles[start:start + chunk]).reshape(-1, 1, 1)
+            cos, sin = np.cos(theta).astype(np.float32), np.sin(theta).astype(np.float32)
+            x, y = (px - center).astype(np.float32), (py - center).astype(np.float32)
+            u = cos * x - sin * y + center
+            v = sin * x + cos * y + center
+            #   Absorbs float32 rounding on edges that pass exactly through a pixel
+            eps = np.float32(1e-4)
+            covered = (u >= -eps) & (v >= -eps)
+            if shape == "Square":
+                covered &= (u <= a + eps) & (v <= a + eps)
+            else:
+                covered &= u + v <= a + eps
+        masks[start:start + chunk] = covered & (a > 0)
+
+    return masks
+
+def render_halftone(overlay, padded, masks, dy, dx, cell_rows):
+    ''' Draw into a band of cell rows of the (rows, size, cols, size) overlay the part of every shape
+    that reaches in from the neighbouring cell at offset (dy, dx). padded holds the cell means, stamp
+    indices and a validity mask, padded so shifted neighbours can be sliced; padded cells draw nothing. '''
+    padded_means, padded_index, padded_valid, pad = padded
+    start, stop = cell_rows
+    grid_cols = overlay.shape[2]
+
+    rows = slice(start + dy + pad, stop + dy + pad)
+    cols = slice(dx + pad, grid_cols + dx + pad)
+    covered = masks[padded_index[rows, cols]] & padded_valid[rows, cols][..., None, None]
+    np.copyto(overlay[start:stop], padded_means[rows, cols][:, None, :, None], where = covered.transpose(0, 2, 1, 3))
+
+def halftone_effect(image_array, shape, size, rotation, random_rotation, rotation_threshold, jitter, overlay, rng, parallel = False):
+    ''' Apply the halftone effect to an (height, width, 3) uint8 RGB array. With parallel, bands of
+    cell rows are rendered concurrently on the shared pool; the output is unchanged. '''
+    height, width = image_array.shape[:2]
+    gray = cv2.cvtColor(image_array, cv2.COLOR_RGB2GRAY)
+
+    #   Random draws stay on this thread, so the seeded grid does not depend on scheduling
+    means, sizes, angles = halftone_cells(gray, size, rotation, random_rotation, rotation_threshold, jitter, rng)
+    stamp_index, stamp_sizes, stamp_angles, offsets = shape_stamps(shape, size, sizes, angles)
+
+    grid_rows, grid_cols = means.shape
+    pad = np.abs(offsets).max()
+    padded = (np.pad(means, pad), np.pad(stamp_index, pad), np.pad(np.ones(means.shape, dtype = bool), pad), pad)
+    halftone_overlay = np.zeros((grid_rows, size, grid_cols, size), dtype = np.uint8)
+
+    #   Neighbour offsets in row-major order, so the last cell covering a pixel wins. Stamps are
+    #   rasterised for one offset at a time, which bounds them to about a frame's worth of cells.
+    for dy in offsets:
+        for dx in offsets:
+            masks = stamp_masks(shape, size, stamp_sizes, stamp_angles, dy, dx)
+            if not masks.any():
+                continue
+            band = lambda start, stop: render_halftone(halftone_overlay, padded, masks, dy, dx, (start, stop))
+            run_bands(band, grid_rows, parallel, rows = max(1, -(-grid_rows // (4 * THREADS))))
+
+    halftone_overlay = np.ascontiguousarray(halftone_overlay.reshape(grid_rows * size, grid_cols * size)[:height, :width])
+    halftone_overlay = cv2.cvtColor(halftone_overlay, cv2.COLOR_GRAY2RGB)
+
+    #   Apply overlay on original image
+    if overlay:
+        return cv2.addWeighted(image_array, 0.5, halftone_overlay, 0.5, 0)
+    return halftone_overlay
+
+def halftone(image, shape, size, rotation, random_rotation, rotation_threshold, jitter, overlay, seed, parallel = False):
+    image = to_mode(image, "RGB")
+
+    halftone_array = halftone_effect(
+        np.asarray(image),
+        shape = shape,
+        size = size,
+        rotation = rotation,
+        random_rotation = random_rotation,
+        rotation_threshold = rotation_threshold,
+        jitter = jitter,
+        overlay = overlay,
+        rng = np.random.default_rng(seed),
+        parallel = parallel,
+    )
+
+    return Image.fromarray(halftone_array)
+
+
+@invocation("retro_halftone", title = "Halftone", tags = ["retro", "image", "color"], category = "image", version = "1.3.1")
+class RetroHalftoneInvocation(BaseInvocation, WithMetadata, WithResultCache):
     ''' Apply a halftone-like effect to images '''
 
     #   Inputs
     image:              ImageField  = InputField(default = None, description = "Input image for pixelization")
     shape:              SHAPES      = InputField(default = "Circle", description = "Halftone shape")
-    size:               int         = InputField(default = 16, description = "Size of halftone shape")
+    size:               int         = InputField(default = 16, gt = 0, le = 512, description = "Size of halftone shape")
     rotation:           int         = InputField(default = 0, description = "Rotation in degrees of the halftone shape when Shape != Circle")
     random_rotation:    bool        = InputField(default = False, description = "Rotate the shape with randomly with a threshold")
-    rotation_threshold: int         = InputField(default = 0, description = "Threshold for random rotation of the halftone shape")
-    jitter:             int         = InputField(default = 0, description = "Random size jitter threshold for the halftone shape")
+    rotation_threshold: int         = InputField(default = 0, ge = 0, le = 180, description = "Threshold for random rotation of the halftone shape")
+    jitter:             int         = InputField(default = 0, ge = 0, le = 512, description = "Random size jitter threshold for the halftone shape")
     overlay:            bool        = InputField(default = False, description = "Overlay the halftone on the original image, creating a color halftone image")
+    seed:               int         = InputField(default = 0, ge = 0, description = "Seed for random size jitter and rotation")
+    parallel:           bool        = InputField(default = False, description = "Render bands of cells on several CPU cores; the output is identical")
     #fmt: on
 
     def invoke(self, context: InvocationContext) -> ImageOutput:
-        image = context.images.get_pil(self.image.image_name)
-        
-        image = image.convert("RGB")
-        
-        np_image = np.array(image)
-        
-        np_image = cv2.cvtColor(np_image, cv2.COLOR_RGB2BGR)
-
-        gray = cv2.cvtColor(np_image, cv2.COLOR_BGR2GRAY)
-        
-        jitter = self.jitter
-        shape_size = self.size
-        rotation = self.rotation
-        rotation_threshold = self.rotation_threshold
-        
-        halftone_overlay = np.zeros_like(gray)
-
-        for i in range(0, gray.shape[0], shape_size):
-          for j in range(0, gray.shape[1], shape_size):
-            
-            # Adjust size randomly if jitter is enabled
-            if jitter > 0:
-              jitter_amount = random.randint(-jitter, jitter)
-              shape_size_adjusted = max(shape_size + jitter_amount, 0)
-            else:
-              shape_size_adjusted = shape_size
-              
-            # Skip iteration if shape size ended up 0
-            if shape_size_adjusted == 0:
-              continue 
-            
-            x1 = i
-            x2 = min(i + shape_size_adjusted, gray.shape[0])
-            y1 = j
-            y2 = min(j + shape_size_adjusted, gray.shape[1])
-            
-            roi = gray[x1:x2, y1:y2]
-            color = np.mean(roi)
-
-            if self.shape == "Circle":
-              cv2.circle(halftone_overlay, (j+shape_size//2, i+shape_size//2),  
-                         shape_size_adjusted//2, color, -1)
-                         
-            elif self.shape == "Square":
-              if self.random_rotation:
-                angle = random.randint(-rotation_threshold, rotation_threshold)
-                M = cv2.getRotationMatrix2D((j+shape_size/2, i+shape_size/2), angle, 1)
-                cv2.fillPoly(halftone_overlay, cv2.transform(np.array([[[j,i], [j+shape_size_adjusted, i], [j+shape_size_adjusted, i+shape_size_adjusted], [j, i+shape_size_adjusted]]]), M), color)
-              else:
-                M = cv2.getRotationMatrix2D((j+shape_size/2, i+shape_size/2), rotation, 1)
-                cv2.fillPoly(halftone_overlay, cv2.transform(np.array([[[j,i], [j+shape_size_adjusted, i], [j+shape_size_adjusted, i+shape_size_adjusted], [j, i+shape_size_adjusted]]]), M), color)
-                
-            elif self.shape == "Triangle":
-              if self.random_rotation:
-                angle = random.randint(-rotation_threshold, rotation_threshold)
-                M = cv2.getRotationMatrix2D((j+shape_size/2, i+shape_size/2), angle, 1)
-                cv2.fillPoly(halftone_overlay, cv2.transform(np.array([[[j, i], [j+shape_size_adjusted, i], [j, i+shape_size_adjusted]]]), M), color)
-              else:
-                M = cv2.getRotationMatrix2D((j+shape_size/2, i+shape_size/2), rotation, 1)
-                cv2.fillPoly(halftone_overlay, cv2.transform(np.array([[[j, i], [j+shape_size_adjusted, i], [j, i+shape_size_adjusted]]]), M), color)
-                
-        # Convert overlay to 3 channels         
-        halftone_overlay = cv2.cvtColor(halftone_overlay, cv2.COLOR_GRAY2BGR)
-
-        # Apply overlay on original image
-        if self.overlay:
-          halftone = cv2.addWeighted(np_image, 0.5, halftone_overlay, 0.5, 0)   
-        else:
-          halftone = halftone_overlay
-
-        # Convert back to RGB for Pillow 
-        halftone = cv2.cvtColor(halftone, cv2.COLOR_BGR2RGB)
-        
-        halftone_image = Image.fromarray(halftone)
-
-        dto = context.images.save(image = halftone_image)
-
-        return ImageOutput(
-            image = ImageField(image_name = dto.image_name),
-            width = dto.width,
-            height = dto.height,
-        )
\ No newline at end of file
+        return run_cached(context, self, lambda image: halftone(image, self.shape, self.size, self.rotation, self.random_rotation, self.rotation_threshold, self.jitter, self.overlay, self.seed, self.parallel))
\ No newline at end of file
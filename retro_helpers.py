@@ -1,6 +1,12 @@
 from pathlib import Path
 from PIL import Image
 from typing import Literal
+import numpy as np
+from .retro_buffer import used_colors
+from .retro_dither import dither_indices
+from .retro_lut import indexed_image, lut_palettize
+from .retro_profile import to_mode
+from .retro_unique import pack_rgb, unpack_rgb
 
 #   Define Quantize methods list
 PIL_QUANTIZE_MODES = Literal[
@@ -16,38 +22,38 @@ PIL_QUANTIZE_MAP = {
     "Fast Octree": Image.Quantize.FASTOCTREE
 }
 
-def get_palette(image):
-    #   Get palette from the image
-    palette = image.convert("P", palette=Image.ADAPTIVE, colors=256).getpalette()
+def get_palette(image, exact = False):
+    colors = None
 
-    #   Create a set to store unique colors
-    unique_colors = set()
+    #   Use the image's own colors when it has few enough of them
+    if exact:
+        #   An indexed image's colors are read from its palette
+        colors = used_colors(image)
 
-    new_palette = []
+    if exact and colors is None:
+        packed = pack_rgb(np.asarray(to_mode(image, "RGB"))).reshape(-1)
+        #   A strided sample rules out most many-colored images before the full unique pass
+        if len(np.unique(packed[::max(1, len(packed) >> 16)])) <= 256:
+            unique = np.unique(packed)
+            if len(unique) <= 256:
+                colors = unpack_rgb(unique)
 
-    for i in range(0, len(palette), 3):
-        r = palette[i]
-        g = palette[i+1]
-        b = palette[i+2]
+    if colors is None:
+        #   Get palette from the image and keep the first occurrence of every color
+        palette = np.array(to_mode(image, "RGB").convert("P", palette=Image.ADAPTIVE, colors=256).getpalette(), dtype = np.uint8).reshape(-1, 3)
+        _, first = np.unique(pack_rgb(palette), return_index = True)
+        colors = palette[np.sort(first)]
 
-        color = (r,g,b)
+    return palette_image(colors)
 
-        # Add unique colors to set
-        if color not in unique_colors:
-            unique_colors.add(color)
-            new_palette.extend(color)
+def palette_image(colors):
+    #   One pixel per color of an (N, 3) uint8 color table
+    num_colors = len(colors)
 
-    num_colors = len(new_palette) // 3
+    image = Image.frombuffer("P", (num_colors, 1), np.arange(num_colors, dtype = np.uint8).tobytes(), "raw", "P", 0, 1)
+    image.putpalette(colors.tobytes())
 
-    palette_image = Image.new("P", (num_colors, 1))
-
-    for i in range(num_colors):
-        r = new_palette[i*3]
-        g = new_palette[i*3+1]
-        b = new_palette[i*3+2]
-        palette_image.putpixel((i,0), (r,g,b))
-
-    return palette_image
+    return image
 
 def increment_filename(path, name):
     increment = 0
@@ -70,13 +76,21 @@ def numberize_filename(path, name):
             else:
                 return new_name
 
-def palettize(image, palette_image, prequantize, method, dither):
+def palettize(image, palette, prequantize, method, dither, dither_mode = "Floyd-Steinberg", parallel = False, row_offset = 0, metric = "RGB"):
     palettized = image
 
     if prequantize:
-        palettized = palettized.quantize(colors = 256, method=method, dither=Image.Dither.NONE).convert('RGB')
+        palettized = palettized.quantize(colors = 256, method=method, dither=Image.Dither.NONE)
+        #   Undithered, the quantized image is mapped through its palette; dithering needs its pixels
+        if dither:
+            palettized = to_mode(palettized, 'RGB')
+
+    #   Without dithering every pixel maps independently, so a precomputed lookup table does the job
+    if not dither:
+        return lut_palettize(palettized, palette.colors, parallel, metric)
 
-    if palette_image.mode != 'P':
-        palette_image = palette_image.convert('P')
+    #   Pillow's Floyd-Steinberg only matches in RGB; everything else uses the native engine
+    if dither_mode != "Floyd-Steinberg" or metric != "RGB":
+        return indexed_image(dither_indices(np.asarray(palettized), palette.colors, dither_mode, row_offset, parallel, metric), palette.colors)
 
-    return palettized.quantize(palette=palette_image, method=method, dither = Image.Dither.FLOYDSTEINBERG if dither else Image.Dither.NONE)
\ No newline at end of file
+    return palettized.quantize(palette=palette.image, method=method, dither = Image.Dither.FLOYDSTEINBERG)
\ No newline at end of file
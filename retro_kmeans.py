@@ -0,0 +1,115 @@
+import hashlib
+import numpy as np
+from .retro_cache import LRUCache
+from .retro_color import nearest_colors
+from .retro_unique import pack_rgb, unpack_rgb
+
+#   Pixels drawn from the image to build the color histogram the palette is learned from
+SAMPLE_PIXELS = 1 << 16
+
+#   Histogram colors per mini-batch step
+BATCH_SIZE = 4096
+
+#   Mini-batch steps when none are given
+ITERATIONS = 64
+
+#   Learned palettes are small; the key is the image's pixel hash plus the learning parameters
+kmeans_cache = LRUCache(8 * 1024 * 1024)
+
+def color_histogram(image_array, rng):
+    ''' Distinct colors and their pixel counts, over a random subsample of large images '''
+    pixels = image_array.reshape(-1, 3)
+    if len(pixels) > SAMPLE_PIXELS:
+        pixels = pixels[rng.choice(len(pixels), SAMPLE_PIXELS, replace = False)]
+    packed, counts = np.unique(pack_rgb(pixels), return_counts = True)
+    return unpack_rgb(packed).astype(np.float32), counts.astype(np.float64)
+
+def weighted_choice(cumulative, size, rng):
+    #   Indices drawn with probability proportional to the weights whose running sum is cumulative
+    return np.minimum(np.searchsorted(cumulative, rng.random(size) * cumulative[-1], side = "right"), len(cumulative) - 1)
+
+def seed_centers(points, weights, count, rng, init = None):
+    ''' Start from init, topped up by k-means++ when it has too few colors. k-means++ runs on one
+    weighted draw of BATCH_SIZE colors from the histogram, which keeps seeding cheap. '''
+    points = points[weighted_choice(np.cumsum(weights), min(BATCH_SIZE, len(points)), rng)]
+    weights = np.ones(len(points))
+    centers = [] if init is None else list(np.asarray(init, dtype = np.float32)[:count])
+    if not centers:
+        centers.append(points[rng.integers(len(points))])
+
+    distance = np.full(len(points), np.inf, dtype = np.float32)
+    for center in centers:
+        distance = np.minimum(distance, ((points - center) ** 2).sum(axis = -1))
+    while len(centers) < count:
+        mass = distance * weights
+        if mass.sum() <= 0:
+            #   Every color is already a center; repeat the last one rather than invent colors
+            centers.append(centers[-1])
+            continue
+        center = points[weighted_choice(np.cumsum(mass), 1, rng)[0]]
+        centers.append(center)
+        distance = np.minimum(distance, ((points - center) ** 2).sum(axis = -1))
+
+    return np.array(centers, dtype = np.float32)
+
+def minibatch_kmeans(points, weights, centers, iterations, rng, absorbed = None):
+    ''' Mini-batch k-means (Sculley, 2010) over weighted points. Each center moves towards the mean of its
+    batch points at a rate that falls with the number of points it has absorbed so far, which starts
+    from absorbed when centers were already learned. '''
+    centers = centers.copy()
+    absorbed = np.zeros(len(centers)) if absorbed is None else np.array(absorbed, dtype = np.float64)
+    cumulative = np.cumsum(weights)
+
+    for _ in range(iterations):
+        batch = points[weighted_choice(cumulative, min(BATCH_SIZE, len(points)), rng)]
+        nearest = nearest_colors(batch, centers)
+        counts = np.bincount(nearest, minlength = len(centers))
+        sums = np.stack([np.bincount(nearest, batch[:, channel], len(centers)) for channel in range(3)], axis = -1)
+
+        moved = counts > 0
+        absorbed[moved] += counts[moved]
+        centers[moved] += (sums[moved] - counts[moved, None] * centers[moved]) / absorbed[moved, None]
+
+    return centers
+
+def learn_palette(image_array, colors, iterations = ITERATIONS, seed = 0, init = None, histogram = None):
+    ''' Learn a palette of at most colors entries for an (height, width, 3) uint8 array with mini-batch
+    k-means. The same image, parameters and seed always give the same palette. init, an (N, 3) palette
+    such as the previous frame's, warm-starts the centers for temporally stable video. histogram, the
+    image's (N, 3) distinct colors and their pixel counts, replaces the sampled histogram. '''
+    init = None if init is None or len(init) == 0 else np.asarray(init, dtype = np.uint8)
+    hasher = hashlib.blake2b(digest_size = 20)
+    hasher.update(f"{image_array.shape}:{colors}:{iterations}:{seed}:{histogram is not None}:".encode())
+    hasher.update(np.ascontiguousarray(image_array).tobytes())
+    hasher.update(b"" if init is None else init.tobytes())
+
+    def learn():
+        rng = np.random.default_rng(seed)
+        if histogram is None:
+            points, weights = color_histogram(image_array, rng)
+        else:
+            points, weights = histogram[0].astype(np.float32), histogram[1].astype(np.float64)
+        if len(points) <= colors:
+            #   Nothing to learn: the image's own colors are the best palette
+            palette = points.astype(np.uint8)
+        else:
+            centers = seed_centers(points, weights, colors, rng, init)
+            centers = minibatch_kmeans(points, weights, centers, iterations, rng)
+            palette = np.clip(np.rint(centers), 0, 255).astype(np.uint8)
+            #   Centers that converged onto the same color are kept once
+            _, first = np.unique(pack_rgb(palette), return_index = True)
+            palette = palette[np.sort(first)]
+        palette.flags.writeable = False
+        return palette
+
+    return kmeans_cache.get_or_create(hasher.hexdigest(), learn)
+
+def refine_palette(centers, image_array, iterations, seed = 0):
+    ''' Move (N, 3) float32 centers learned on earlier frames a few mini-batch steps towards the colors
+    of an (height, width, 3) uint8 array. The centers count as already trained on ITERATIONS batches,
+    so they drift with the footage instead of being relearned. Returns the new float centers; the
+    palette is their rounded value. Centers are never merged, so palette indices stay valid. '''
+    rng = np.random.default_rng(seed)
+    points, weights = color_histogram(image_array, rng)
+    prior = np.full(len(centers), ITERATIONS * BATCH_SIZE / len(centers))
+    return minibatch_kmeans(points, weights, np.asarray(centers, dtype = np.float32), iterations, rng, prior)
@@ -0,0 +1,108 @@
+import hashlib
+import numpy as np
+from PIL import Image
+from .retro_buffer import map_indexed
+from .retro_cache import LRUCache
+from .retro_color import nearest_colors, to_metric_space
+from .retro_config import LUT_BITS, LUT_CACHE_BYTES
+from .retro_parallel import run_bands
+from .retro_profile import to_mode
+from .retro_unique import map_distinct
+
+lut_cache = LRUCache(LUT_CACHE_BYTES)
+
+def palette_colors(palette_image):
+    ''' The (N, 3) uint8 color table of a palette image, as used by Image.quantize(palette=...) '''
+    if palette_image.mode != 'P':
+        palette_image = palette_image.convert('P')
+    return np.array(palette_image.getpalette(), dtype = np.uint8).reshape(-1, 3)
+
+def build_lut(colors, bits = LUT_BITS, metric = "RGB"):
+    ''' Map the center of every RGB bin to the index of its nearest palette color under the metric '''
+    levels = 1 << bits
+    step = 256 >> bits
+    centers = np.arange(levels, dtype = np.float32) * step + (step - 1) / 2
+    grid = np.stack(np.meshgrid(centers, centers, centers, indexing = "ij"), axis = -1).reshape(-1, 3)
+
+    lut = nearest_colors(to_metric_space(grid, metric), to_metric_space(colors, metric)).astype(np.uint8)
+    return lut.reshape(levels, levels, levels)
+
+def get_lut(colors, bits = LUT_BITS, metric = "RGB"):
+    ''' Fetch the lookup table for a palette from memory, or build it '''
+    key = (hashlib.sha1(colors.tobytes()).hexdigest(), bits, metric)
+
+    def create():
+        lut = build_lut(colors, bits, metric)
+        lut.flags.writeable = False
+        return lut
+
+    return lut_cache.get_or_create(key, create)
+
+def apply_lut(image_array, lut, parallel = False):
+    ''' Look up the palette index of every pixel of an (height, width, 3) uint8 array.
+    With parallel, row bands are looked up concurrently on the shared pool. '''
+    bits = lut.shape[0].bit_length() - 1
+    shift = 8 - bits
+    table = lut.reshape(-1)
+    indices = np.empty(image_array.shape[:2], dtype = lut.dtype)
+
+    def band(start, stop):
+        block = image_array[start:stop] >> shift
+        packed = (block[..., 0].astype(np.uint32) << (2 * bits)) | (block[..., 1].astype(np.uint32) << bits) | block[..., 2]
+        np.take(table, packed, out = indices[start:stop])
+
+    run_bands(band, len(indices), parallel)
+    return indices
+
+def indexed_image(indices, colors):
+    ''' 'P' image from an array of palette indices and its color table '''
+    palettized = Image.fromarray(indices, mode = "L")
+    palettized.putpalette(colors.reshape(-1))
+    return palettized
+
+def pillow_palettize(image, colors, parallel = False):
+    ''' Pillow's undithered quantize of an RGB image onto an (N, 3) uint8 palette, which maps a frame
+    faster than a table lookup in numpy; returns a 'P' image. With parallel, row bands are mapped
+    concurrently on the shared pool. '''
+    palette = Image.new("P", (1, 1))
+    palette.putpalette(colors.reshape(-1))
+    if not parallel:
+        return image.quantize(palette = palette, dither = Image.Dither.NONE)
+
+    width, height = image.size
+    indices = np.empty((height, width), dtype = np.uint8)
+
+    def band(start, stop):
+        indices[start:stop] = np.asarray(image.crop((0, start, width, stop)).quantize(palette = palette, dither = Image.Dither.NONE))
+
+    run_bands(band, height)
+    return indexed_image(indices, colors)
+
+def lut_palettize(image, colors, parallel = False, metric = "RGB"):
+    ''' Non-dithered palettization of an RGB or 'P' image; returns a 'P' image. RGB matching is Pillow's
+    quantize. Perceptual metrics match the distinct colors of an image exactly when that costs less than
+    a table lookup, and use a table built in the metric's space otherwise. A 'P' image has its color
+    table matched the same way, and its pixels are only gathered. '''
+    if metric != "RGB":
+        palette = to_metric_space(colors, metric)
+        match = lambda unique: nearest_colors(to_metric_space(unique, metric), palette)
+    else:
+        match = lambda unique: np.asarray(pillow_palettize(Image.fromarray(unique[None]), colors))[0]
+
+    indices = map_indexed(image, match)
+    if indices is not None:
+        return indexed_image(indices, colors)
+
+    image = to_mode(image, "RGB")
+    if metric == "RGB":
+        return pillow_palettize(image, colors, parallel)
+
+    #   Matching a color against one palette entry costs about as much as looking a pixel up in a table
+    #   (some 7 ns each here), and the distinct-color pass over the pixels is no slower than the table's.
+    #   It is taken while matching its colors costs at most a quarter of that pass.
+    image_array = np.asarray(image)
+    height, width = image_array.shape[:2]
+    indices = map_distinct(image_array, match, height * width // (4 * len(colors)))
+    if indices is not None:
+        return indexed_image(indices, colors)
+    return indexed_image(apply_lut(image_array, get_lut(colors, metric = metric), parallel), colors)
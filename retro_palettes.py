@@ -0,0 +1,188 @@
+from threading import Lock
+from typing import Literal
+import hashlib
+import json
+import os
+from PIL import Image
+from .retro_cache import LRUCache
+from .retro_config import PALETTE_CACHE_BYTES
+from .retro_lut import palette_colors
+
+
+class Palette:
+    ''' A palette normalised for palettizing: its color table and a ready-to-use 'P' image '''
+
+    def __init__(self, image, path = None):
+        if image.mode != 'P':
+            image = image.convert('P')
+        image.load()
+        self.image = image
+        self.colors = palette_colors(image)
+        self.colors.flags.writeable = False
+        self.path = path
+        self.digest = hashlib.sha1(self.colors.tobytes()).hexdigest()
+
+    @property
+    def nbytes(self):
+        width, height = self.image.size
+        return self.colors.nbytes + width * height + 768
+
+class PaletteStore:
+    ''' Loads each palette once and serves it from memory. Files are reloaded only when their
+    mtime or size changes; gallery images are immutable, so they are keyed by image name alone. '''
+
+    def __init__(self, max_bytes = PALETTE_CACHE_BYTES):
+        self._cache = LRUCache(max_bytes)
+
+    def from_file(self, path):
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        signature = (stat.st_mtime_ns, stat.st_size)
+
+        entry = self._cache.get(("file", path))
+        if entry is not None and entry[0] == signature:
+            return entry[1]
+
+        with Image.open(path) as image:
+            palette = Palette(image, path)
+        self._cache.put(("file", path), (signature, palette), palette.nbytes)
+        return palette
+
+    def from_image_field(self, context, image_field):
+        key = ("image", image_field.image_name)
+        entry = self._cache.get(key)
+        if entry is not None:
+            return entry[1]
+
+        palette = Palette(context.images.get_pil(image_field.image_name))
+        self._cache.put(key, (None, palette), palette.nbytes)
+        return palette
+
+    def stats(self):
+        return self._cache.stats()
+
+palette_store = PaletteStore()
+
+class PaletteRegistry:
+    ''' Index of the palette PNGs under a folder. The folder is scanned lazily on first use and
+    rescanned incrementally: directories whose mtime matches the cached manifest are not listed
+    again, so a refresh costs one stat per directory. '''
+
+    #   Kept in a hidden subfolder, so writing it does not touch the mtime of the palettes folder itself
+    MANIFEST = os.path.join(".cache", "manifest.json")
+
+    def __init__(self, root):
+        self.root = root
+        self._dirs = None
+        self._names = None
+        self._lock = Lock()
+
+    def _manifest_path(self):
+        return os.path.join(self.root, self.MANIFEST)
+
+    def _load_manifest(self):
+        try:
+            with open(self._manifest_path(), "r", encoding = "utf-8") as file:
+                manifest = json.load(file)
+            if manifest.get("version") == 1:
+                return manifest["dirs"]
+        except (OSError, ValueError, KeyError):
+            pass
+        return {}
+
+    def _save_manifest(self):
+        temp = f"{self._manifest_path()}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(temp), exist_ok = True)
+            with open(temp, "w", encoding = "utf-8") as file:
+                json.dump({"version": 1, "dirs": self._dirs}, file)
+            os.replace(temp, self._manifest_path())
+        except OSError:
+            try:
+                os.remove(temp)
+            except OSError:
+                pass
+
+    def _scan(self):
+        previous = self._dirs if self._dirs is not None else self._load_manifest()
+        current = {}
+        changed = False
+        pending = [""]
+
+        while pending:
+            relative = pending.pop()
+            directory = os.path.join(self.root, relative)
+            try:
+                mtime = os.stat(directory).st_mtime_ns
+            except OSError:
+                continue
+
+            entry = previous.get(relative)
+            if entry is None or entry["mtime_ns"] != mtime:
+                files, subdirs = [], []
+                try:
+                    with os.scandir(directory) as listing:
+                        for item in listing:
+                            if item.name.startswith("."):
+                                continue
+                            if item.is_dir():
+                                subdirs.append(item.name)
+                            elif item.name.lower().endswith(".png"):
+                                files.append(item.name)
+                except OSError:
+                    continue
+                entry = {"mtime_ns": mtime, "files": sorted(files), "subdirs": sorted(subdirs)}
+                changed = True
+
+            current[relative] = entry
+            pending.extend(os.path.join(relative, name) for name in entry["subdirs"])
+
+        if changed or current.keys() != previous.keys():
+            self._dirs = current
+            self._save_manifest()
+        self._dirs = current
+
+        names = [os.path.join(relative, name) for relative, entry in current.items() for name in entry["files"]]
+        names = sorted(names, key = lambda x: x.lower())
+        changed, self._names = names != self._names, names
+        return changed
+
+    def names(self):
+        with self._lock:
+            if self._names is None:
+                self._scan()
+            return list(self._names)
+
+    def refresh(self):
+        ''' Rescan the directories whose mtime changed; returns whether the palette names changed '''
+        with self._lock:
+            return self._scan()
+
+    def add(self, path):
+        ''' Register a palette written by this package without rescanning '''
+        relative = os.path.relpath(os.path.abspath(path), os.path.abspath(self.root))
+        if relative.startswith(os.pardir):
+            return
+        with self._lock:
+            if self._names is None:
+                self._scan()
+            elif relative not in self._names:
+                self._names = sorted(self._names + [relative], key = lambda x: x.lower())
+
+    def path(self, name):
+        ''' Full path of a palette by name. A name missing from the index triggers a rescan first, so
+        palettes copied into the folder are found without a restart. Returns None for unknown names. '''
+        name = os.path.normpath(name)
+        with self._lock:
+            if self._names is None or name not in self._names:
+                self._scan()
+            if name not in self._names:
+                return None
+        return os.path.join(self.root, name)
+
+    def literal(self):
+        return Literal[("None", *self.names())]
+
+palettes_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "palettes")
+os.makedirs(palettes_dir, exist_ok = True)
+palette_registry = PaletteRegistry(palettes_dir)
@@ -1,9 +1,18 @@
-from typing import Literal, Optional
+import os
 from PIL import Image
+import numpy as np
+from .retro_buffer import OUTPUT_FORMATS, indexed
+from .retro_color import COLOR_METRICS
+from .retro_dither import DITHER_MODES, is_ordered
 from .retro_helpers import palettize
+from .retro_lut import indexed_image, lut_palettize
+from .retro_palettes import palette_registry, palette_store
+from .retro_profile import to_mode
+from .retro_resultcache import WithResultCache, run_cached
+from .retro_sequence import FrameSequence
+from .retro_tiles import map_tiles, should_tile
 from .retro_helpers import PIL_QUANTIZE_MAP as QMap
 from .retro_helpers import PIL_QUANTIZE_MODES as QMode
-import os
 
 from invokeai.invocation_api import(
     BaseInvocation,
@@ -15,123 +24,109 @@ from invokeai.invocation_api import(
     invocation
 )
 
-# Palette cache
-palettes_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "palettes")
-os.makedirs(palettes_dir, exist_ok=True)
-print(f"palettes_dir = {palettes_dir}")
-
-def list_palettes() -> list:
-    palettes = []
-    for root, _, files in os.walk(palettes_dir):
-        for file in files:
-            if file.lower().endswith(".png"):
-                relative_path = os.path.relpath(os.path.join(root, file), palettes_dir)
-                palettes.append(relative_path)
-    return sorted(palettes, key=lambda x: x.lower())
-
-available_palettes = list_palettes()
-
-if available_palettes:
-    palettes_str = ", ".join([repr(f) for f in available_palettes])
-    PaletteLiteral = eval(f'Literal["None", {palettes_str}]')
-else:
-    PaletteLiteral = Literal["None"]
-
-print(f"[RETROIZE] Available palettes: {available_palettes}")
-
-def UpdatePalettes():
-    def list_palettes() -> list:
-        if not os.path.exists(palettes_dir):
-            return []
-        palettes = [f for f in os.listdir(palettes_dir) if f.lower().endswith((".png"))]
-        return sorted(palettes, key = lambda x: x.lower())
-
-    available_palettes = list_palettes()
-
-    if available_palettes:
-        palettes_str = ", ".join([repr(f) for f in available_palettes])
-        PaletteLiteral = eval(f'Literal["None", {palettes_str}]')
-    else:
-        PaletteLiteral = Literal["None"]
-
-
-@invocation("retro_palettize_adv", title = "Palettize Advanced", tags = ["retro", "image", "color", "palette"], category = "image", version = "1.0.1")
-class RetroPalettizeAdvInvocation(BaseInvocation, WithMetadata):
+#   Palette names offered by Palettize Advanced. A Literal needs its choices when the class is defined, so
+#   the folder is indexed at import; the manifest keeps that to one stat per unchanged directory. InvokeAI
+#   builds the UI schema from it once, at startup, so palettes added later are reached by name through
+#   Palettize's Palette Path until the next restart
+PaletteLiteral = palette_registry.literal()
+
+def resolve_palette(context, palette_image, palette_path):
+    ''' Palette from a file path if one is given, otherwise from a gallery image '''
+    if palette_path == '':
+        if palette_image == None:
+            raise ValueError("No palette image or path was specified.")
+        return palette_store.from_image_field(context, palette_image)
+
+    #   Trim " from file path for lazy users like me (:
+    palette_path = palette_path.replace('"', '')
+    #   A name relative to the palettes folder is looked up in the registry, which rescans for palettes added since startup
+    if not os.path.isfile(palette_path):
+        palette_path = palette_registry.path(palette_path) or palette_path
+    return palette_store.from_file(palette_path)
+
+def palettize_rgb(image, palette, prequantize, quantizer, dither, dither_mode = "Floyd-Steinberg", parallel = False, row_offset = 0, metric = "RGB"):
+    ''' Palettize an image of any mode; returns a 'P' image with the palette's colors '''
+    #   An indexed input that is only mapped has its palette matched, not its pixels, and is never converted
+    if not prequantize and not dither and indexed(image) is not None:
+        return lut_palettize(image, palette.colors, metric = metric)
+
+    #   Without prequantization, undithered and ordered-dithered pixels map on their own, so large images go band by band
+    if not prequantize and (not dither or is_ordered(dither_mode)) and should_tile(image):
+        palettized = map_tiles(image, lambda tile, start, stop: palettize_rgb(tile, palette, False, quantizer, dither, dither_mode, row_offset = start, metric = metric), mode = "P", parallel = parallel)
+        palettized.putpalette(palette.colors.reshape(-1))
+        return palettized
+
+    image = to_mode(image, 'RGB')
+    return palettize(image, palette, prequantize, QMap[quantizer], dither, dither_mode, parallel, row_offset, metric)
+
+
+class PalettizeSequence:
+    ''' Palettize consecutive frames, keeping the previous index of every pixel that did not change
+    (see retro_sequence.FrameSequence), so static areas do not flicker under dithering '''
+
+    def __init__(self, palette, prequantize, quantizer, dither, dither_mode = "Floyd-Steinberg", metric = "RGB", threshold = 0):
+        self.palette = palette
+        self.prequantize = prequantize
+        self.quantizer = quantizer
+        self.dither = dither
+        self.dither_mode = dither_mode
+        self.metric = metric
+        self.frames = FrameSequence(threshold)
+
+    def map_region(self, region, top):
+        palettized = palettize_rgb(Image.fromarray(region), self.palette, self.prequantize, self.quantizer, self.dither, self.dither_mode, row_offset = top, metric = self.metric)
+        return np.asarray(palettized)
+
+    def __call__(self, image):
+        indices = self.frames.map(np.asarray(to_mode(image, "RGB")), self.map_region)
+        return indexed_image(indices, self.palette.colors)
+
+
+@invocation("retro_palettize_adv", title = "Palettize Advanced", tags = ["retro", "image", "color", "palette"], category = "image", version = "1.6.3")
+class RetroPalettizeAdvInvocation(BaseInvocation, WithMetadata, WithResultCache):
     ''' Palettize an image by applying a color palette '''
 
     #   Inputs
     image:          ImageField = InputField(default = None, description = "Input image for pixelization")
     palette_image:  PaletteLiteral = InputField(default = None, description = "Palette image")
     dither:         bool = InputField(default = False, description = "Apply dithering to image when palettizing")
+    dither_mode:    DITHER_MODES = InputField(default = "Floyd-Steinberg", description = "Dithering algorithm; ordered modes (Bayer, Blue Noise) are the fastest")
+    color_metric:   COLOR_METRICS = InputField(default = "RGB", description = "Color distance for picking palette colors; OKLab and CIELAB match by perceived color")
     prequantize:    bool = InputField(default = False, description = "Apply 256-color quantization with specified method prior to applying the color palette")
     quantizer:      QMode = InputField(default = "Fast Octree", description = "Palettizer quantization method")
+    parallel:       bool = InputField(default = False, description = "Process row bands on several CPU cores when not dithering or with an ordered dither; the output is identical")
+    output_format:  OUTPUT_FORMATS = InputField(default = "RGB", description = "Save as RGB, or as a palette-indexed PNG that is several times smaller")
 
     def invoke(self, context: InvocationContext) -> ImageOutput:
-        image = context.images.get_pil(self.image.image_name)
-        
-        palettized_image = image
-        if palettized_image.mode != 'RGB':
-            palettized_image = palettized_image.convert('RGB')
-
-        if self.palette_image == None:
+        if self.palette_image in (None, "None"):
                 raise ValueError("No palette image or path was specified.")
         else:
-            # print("Using input image as palette.")
-            palette_image = Image.open(os.path.join(palettes_dir, self.palette_image))
-            palettized_image = palettize(palettized_image, palette_image, self.prequantize, QMap[self.quantizer], self.dither)
+            path = palette_registry.path(self.palette_image)
+            if path is None:
+                raise ValueError(f"Palette {self.palette_image} is no longer in the palettes folder.")
+            palette = palette_store.from_file(path)
 
-        palettized_image = palettized_image.convert('RGB')
+        #   Palettes are keyed by their colors, so editing a palette file invalidates its cached results
+        return run_cached(context, self, lambda image: palettize_rgb(image, palette, self.prequantize, self.quantizer, self.dither, self.dither_mode, self.parallel, metric = self.color_metric), extra = (palette.digest,))
 
-        dto = context.images.save(image = palettized_image)
-        
-        return ImageOutput(
-            image = ImageField(image_name = dto.image_name),
-            width = dto.width,
-            height = dto.height,
-        )
 
-
-@invocation("retro_palettize", title = "Palettize", tags = ["retro", "image", "color", "palette"], category = "image", version = "1.0.1")
-class RetroPalettizeInvocation(BaseInvocation, WithMetadata):
+@invocation("retro_palettize", title = "Palettize", tags = ["retro", "image", "color", "palette"], category = "image", version = "1.6.3")
+class RetroPalettizeInvocation(BaseInvocation, WithMetadata, WithResultCache):
     ''' Palettize an image by applying a color palette '''
 
     #   Inputs
     image:          ImageField = InputField(default = None, description = "Input image for pixelization")
     palette_image:  ImageField = InputField(default = None, description = "Palette image")
-    palette_path:   str = InputField(default = "", description = "Palette image path, including \".png\" extension")
+    palette_path:   str = InputField(default = "", description = "Palette image path, including \".png\" extension, or the name of a palette in the palettes folder")
     dither:         bool = InputField(default = False, description = "Apply dithering to image when palettizing")
+    dither_mode:    DITHER_MODES = InputField(default = "Floyd-Steinberg", description = "Dithering algorithm; ordered modes (Bayer, Blue Noise) are the fastest")
+    color_metric:   COLOR_METRICS = InputField(default = "RGB", description = "Color distance for picking palette colors; OKLab and CIELAB match by perceived color")
     prequantize:    bool = InputField(default = False, description = "Apply 256-color quantization with specified method prior to applying the color palette")
     quantizer:      QMode = InputField(default = "Fast Octree", description = "Palettizer quantization method")
+    parallel:       bool = InputField(default = False, description = "Process row bands on several CPU cores when not dithering or with an ordered dither; the output is identical")
+    output_format:  OUTPUT_FORMATS = InputField(default = "RGB", description = "Save as RGB, or as a palette-indexed PNG that is several times smaller")
 
     def invoke(self, context: InvocationContext) -> ImageOutput:
-        image = context.images.get_pil(self.image.image_name)
-        
-        palettized_image = image
-        if palettized_image.mode != 'RGB':
-            palettized_image = palettized_image.convert('RGB')
-
-        if self.palette_path == '':
-            # print("Palette path is empty.")
-            if self.palette_image == None:
-                raise ValueError("No palette image or path was specified.")
-            else:
-                # print("Using input image as palette.")
-                palette_image = context.images.get_pil(self.palette_image.image_name)
-                palettized_image = palettize(palettized_image, palette_image, self.prequantize, QMap[self.quantizer], self.dither)
-        else:
-            # print("Palette path is " + self.palette_path)
-            palette = self.palette_path
-            #   Trim " from file path for lazy users like me (:
-            palette = palette.replace('"', '')
-            palette_image = Image.open(palette)
-            palettized_image = palettize(palettized_image, palette_image, self.prequantize, QMap[self.quantizer], self.dither)
-
-        palettized_image = palettized_image.convert('RGB')
-
-        dto = context.images.save(image = palettized_image)
-
-        return ImageOutput(
-            image = ImageField(image_name = dto.image_name),
-            width = dto.width,
-            height = dto.height,
-        )
\ No newline at end of file
+        palette = resolve_palette(context, self.palette_image, self.palette_path)
+
+        return run_cached(context, self, lambda image: palettize_rgb(image, palette, self.prequantize, self.quantizer, self.dither, self.dither_mode, self.parallel, metric = self.color_metric), extra = (palette.digest,))
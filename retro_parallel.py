@@ -0,0 +1,56 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, current_thread
+from .retro_config import THREADS
+
+#   One thread pool shared by every node in the package, created on first use
+_executor = None
+_executor_lock = Lock()
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers = THREADS, thread_name_prefix = "retroize")
+        return _executor
+
+def in_worker():
+    ''' Whether the calling thread belongs to the shared pool. Work started from a pool thread runs
+    inline: waiting on the pool from inside it can deadlock once every worker is waiting. '''
+    return current_thread().name.startswith("retroize")
+
+def imap_bounded(fn, items, max_in_flight = None):
+    ''' Map fn over items on the shared pool, yielding results in input order. Items are pulled
+    lazily and at most max_in_flight of them are pending at once, which bounds memory. '''
+    if in_worker():
+        yield from map(fn, items)
+        return
+
+    executor = get_executor()
+    limit = max_in_flight or 2 * THREADS
+    pending = deque()
+    try:
+        for item in items:
+            pending.append(executor.submit(fn, item))
+            if len(pending) >= limit:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+def run_bands(fn, height, parallel = True, rows = None):
+    ''' Call fn(start, stop) for row bands covering height, on the shared pool when parallel.
+    fn must only write its own rows; the bands then combine to the single-threaded result. '''
+    rows = rows or max(16, -(-height // (4 * THREADS)))
+    bands = [(start, min(start + rows, height)) for start in range(0, height, rows)]
+
+    if not parallel or THREADS == 1 or len(bands) == 1 or in_worker():
+        for start, stop in bands:
+            fn(start, stop)
+        return
+
+    futures = [get_executor().submit(fn, start, stop) for start, stop in bands]
+    for future in futures:
+        future.result()
@@ -0,0 +1,145 @@
+import json
+from typing import Any, Literal
+from pydantic import BaseModel, Field
+from .retro_bitize import RetroBitizeInvocation, bitize
+from .retro_buffer import output_mode
+from .retro_crt import RetroCRTCurvatureInvocation, crt
+from .retro_halftone import RetroHalftoneInvocation, halftone
+from .retro_palettes import palette_store
+from .retro_palettize import RetroPalettizeInvocation, palettize_rgb, resolve_palette
+from .retro_pixelize import PixelizeInvocation, pixelize
+from .retro_profile import output_image, profiling, save_image
+from .retro_quantize import RetroQuantizeInvocation, quantize
+from .retro_scanlines import RetroScanlinesSimpleInvocation, scanlines
+
+from invokeai.invocation_api import(
+    BaseInvocation,
+    BaseInvocationOutput,
+    ImageField,
+    InputField,
+    InvocationContext,
+    OutputField,
+    WithMetadata,
+    invocation,
+    invocation_output,
+)
+
+STAGE_NAMES = Literal[
+    "Pixelize",
+    "Bitize",
+    "Quantize",
+    "Palettize",
+    "Scan Lines",
+    "CRT",
+    "Halftone",
+]
+
+def _palettize(node, context, image):
+    palette = resolve_palette(context, node.palette_image, node.palette_path)
+    return palettize_rgb(image, palette, node.prequantize, node.quantizer, node.dither, node.dither_mode, node.parallel, metric = node.color_metric)
+
+def _quantize(node, context, image):
+    init = palette_store.from_image_field(context, node.init_palette).colors if node.method == "K-Means" and node.init_palette is not None else None
+    return quantize(image, node.colors, node.method, node.kmeans, node.dither, node.dither_mode, node.seed, init)
+
+def _scanlines(node, context, image):
+    line_color = (node.line_color.r, node.line_color.g, node.line_color.b, node.line_color.a)
+    return scanlines(image, node.line_size, node.line_spacing, line_color, node.size_jitter, node.space_jitter, node.vertical, node.seed)
+
+#   Each stage reuses the parameters, defaults and validation of its standalone node
+STAGES = {
+    "Pixelize": (PixelizeInvocation, lambda node, context, image: pixelize(image, node.downsample_factor, node.upsample, node.kernel)),
+    "Bitize": (RetroBitizeInvocation, lambda node, context, image: bitize(image, node.dither, node.dither_mode)),
+    "Quantize": (RetroQuantizeInvocation, _quantize),
+    "Palettize": (RetroPalettizeInvocation, _palettize),
+    "Scan Lines": (RetroScanlinesSimpleInvocation, _scanlines),
+    "CRT": (RetroCRTCurvatureInvocation, lambda node, context, image: crt(image, node.crt_width, node.crt_height, node.crt_curvature, node.scanlines_opacity, node.vignette_opacity, node.vignette_roundness, node.crt_brightness, node.low_memory, node.parallel)),
+    "Halftone": (RetroHalftoneInvocation, lambda node, context, image: halftone(image, node.shape, node.size, node.rotation, node.random_rotation, node.rotation_threshold, node.jitter, node.overlay, node.seed, node.parallel)),
+}
+
+class RetroStageField(BaseModel):
+    ''' One stage of a Retro Pipeline: an effect and the parameters of its node '''
+    stage: STAGE_NAMES = Field(description = "Effect to apply")
+    params: dict[str, Any] = Field(default_factory = dict, description = "Parameters, named as on the effect's own node")
+    emit: bool = Field(default = False, description = "Also save this stage's output as an image")
+
+def build_stage(stage):
+    ''' Validate a stage's parameters through its node class and return the node and effect '''
+    node_class, effect = STAGES[stage.stage]
+    unknown = set(stage.params) - set(node_class.model_fields) - {"image"}
+    if unknown:
+        raise ValueError(f"Unknown parameters for {stage.stage} stage: {', '.join(sorted(unknown))}")
+    #   The placeholder image is never loaded; the pipeline feeds each stage from memory
+    node = node_class(**{**stage.params, "image": ImageField(image_name = "")})
+    return node, effect
+
+
+@invocation_output("retro_stage_output")
+class RetroStageOutput(BaseInvocationOutput):
+    ''' A Retro Pipeline stage '''
+    stage: RetroStageField = OutputField(description = "The pipeline stage")
+
+@invocation("retro_stage", title = "Retro Stage", tags = ["retro", "image", "pipeline"], category = "image", version = "1.0.0")
+class RetroStageInvocation(BaseInvocation):
+    ''' Configure one stage of a Retro Pipeline '''
+
+    #   Inputs
+    stage:      STAGE_NAMES = InputField(default = "Pixelize", description = "Effect to apply")
+    params:     str = InputField(default = "{}", description = "Stage parameters as JSON, using the field names of the effect's own node")
+    emit:       bool = InputField(default = False, description = "Also save this stage's output as an image")
+
+    def invoke(self, context: InvocationContext) -> RetroStageOutput:
+        stage = RetroStageField(stage = self.stage, params = json.loads(self.params or "{}"), emit = self.emit)
+        #   Fail early on bad parameters instead of when the pipeline runs
+        build_stage(stage)
+        return RetroStageOutput(stage = stage)
+
+
+@invocation_output("retro_pipeline_output")
+class RetroPipelineOutput(BaseInvocationOutput):
+    ''' Final image of a Retro Pipeline, plus any emitted intermediate images '''
+    image:          ImageField = OutputField(description = "The final image")
+    width:          int = OutputField(description = "The width of the image in pixels")
+    height:         int = OutputField(description = "The height of the image in pixels")
+    intermediates:  list[ImageField] = OutputField(description = "Images saved by stages with emit enabled")
+
+@invocation("retro_pipeline", title = "Retro Pipeline", tags = ["retro", "image", "pipeline"], category = "image", version = "1.0.0")
+class RetroPipelineInvocation(BaseInvocation, WithMetadata):
+    ''' Run several Retroize effects in memory, saving only the final image '''
+
+    #   Inputs
+    image:      ImageField = InputField(description = "Input image")
+    stages:     list[RetroStageField] = InputField(description = "Ordered stages to apply")
+    timing:     bool = InputField(default = False, description = "Log the time spent in each stage")
+
+    def invoke(self, context: InvocationContext) -> RetroPipelineOutput:
+        #   Validate every stage before doing any work
+        stages = [(stage, *build_stage(stage)) for stage in self.stages]
+
+        with profiling(context, self) as profile:
+            image = profile.run("load", context.images.get_pil, self.image.image_name)
+
+            intermediates = []
+            for index, (stage, node, effect) in enumerate(stages):
+                image = profile.run(f"{index}:{stage.stage}", effect, node, context, image)
+
+                #   Stages hand the next one their native mode; only saved images are converted, to the stage's output format
+                if stage.emit and index < len(stages) - 1:
+                    emitted = output_image(image, output_mode(node))
+                    dto = profile.run("save", lambda: context.images.save(image = emitted))
+                    intermediates.append(ImageField(image_name = dto.image_name))
+
+            #   A stage's phase excludes the mode conversions it ran; those are summed in the profile's own phases
+            if self.timing:
+                names = [f"{index}:{stage.stage}" for index, (stage, _, _) in enumerate(stages)]
+                context.logger.info("[RETROIZE] Pipeline stage timings: " + ", ".join(f"{name} {profile.phases[name]['seconds'] * 1000:.1f} ms" for name in names))
+
+            #   The final image is saved in the output format of the last stage
+            dto = save_image(context, profile, self, image, output_mode(stages[-1][1]) if stages else "RGB")
+
+        return RetroPipelineOutput(
+            image = ImageField(image_name = dto.image_name),
+            width = dto.width,
+            height = dto.height,
+            intermediates = intermediates,
+        )
@@ -1,4 +1,11 @@
+from typing import Literal
 from PIL import Image
+import numpy as np
+from .retro_buffer import indexed
+from .retro_profile import to_mode
+from .retro_resultcache import WithResultCache, run_cached
+from .retro_tiles import band_height, row_bands, should_tile
+from .retro_unique import pack_rgb, unpack_rgb
 
 from invokeai.invocation_api import(
     BaseInvocation,
@@ -10,30 +17,122 @@ from invokeai.invocation_api import(
     ImageOutput
 )
 
+#   How a block of pixels is reduced to one
+DOWNSAMPLE_KERNELS = Literal[
+    "Box",
+    "Median",
+    "Mode",
+]
 
-@invocation("retro_pixelize", title = "Pixelize", tags = ["retro", "image", "pixel", "scale", "resize"], category = "image", version="1.0.1")
-class PixelizeInvocation(BaseInvocation, WithMetadata):
+
+def block_median(blocks):
+    #   Lower median per channel, so the result is always a value present in the block
+    middle = (blocks.shape[2] - 1) // 2
+    return np.partition(blocks, middle, axis = 2)[:, :, middle]
+
+def most_common(blocks):
+    #   Most common value per block of (rows, columns, pixels) values; ties go to the lowest value
+    ordered = np.sort(blocks, axis = 2)
+    count = ordered.shape[2]
+    positions = np.arange(count)
+    starts = np.ones(ordered.shape, dtype = bool)
+    starts[:, :, 1:] = ordered[:, :, 1:] != ordered[:, :, :-1]
+    #   Length of the run of equal values up to every position
+    runs = positions + 1 - np.maximum.accumulate(np.where(starts, positions, 0), axis = 2)
+    longest = runs.argmax(axis = 2)
+    return np.take_along_axis(ordered, longest[:, :, None], axis = 2)[:, :, 0]
+
+def block_mode(blocks):
+    #   Most common color per block; ties go to the lowest packed color
+    return unpack_rgb(most_common(pack_rgb(blocks)))
+
+BLOCK_REDUCERS = {
+    "Median": block_median,
+    "Mode": block_mode,
+}
+
+def reduce_blocks(array, factor, reducer):
+    ''' Reduce every factor x factor block of an (height, width, ...) array to one pixel with reducer,
+    which maps (rows, columns, pixels, ...) blocks to (rows, columns, ...). Blocks on the right and
+    bottom edges hold only the pixels that remain. '''
+    height, width = array.shape[:2]
+    channels = array.shape[2:]
+    output = np.empty((-(-height // factor), -(-width // factor), *channels), dtype = array.dtype)
+
+    #   Whole blocks, then the partial column, row and corner, each reshaped into blocks of one size
+    rows = [(0, height - height % factor), (height - height % factor, height)]
+    columns = [(0, width - width % factor), (width - width % factor, width)]
+    for top, bottom in rows:
+        for left, right in columns:
+            if bottom == top or right == left:
+                continue
+            block_rows, block_columns = min(factor, bottom - top), min(factor, right - left)
+            count_rows, count_columns = (bottom - top) // block_rows, (right - left) // block_columns
+            region = array[top:bottom, left:right].reshape(count_rows, block_rows, count_columns, block_columns, *channels)
+            blocks = region.swapaxes(1, 2).reshape(count_rows, count_columns, block_rows * block_columns, *channels)
+            output[top // factor:top // factor + count_rows, left // factor:left // factor + count_columns] = reducer(blocks)
+
+    return output
+
+def downsample_indexed(image, factor):
+    ''' Mode downsample of a 'P' image on the ranks of its palette colors in packed order, which picks
+    the same colors as on its RGB pixels; returns a 'P' image of those colors '''
+    indices, colors = indexed(image)
+    codes, ranks = np.unique(pack_rgb(colors), return_inverse = True)
+    reduced = reduce_blocks(np.take(ranks.astype(np.uint8), indices), factor, most_common)
+    output = Image.fromarray(reduced, mode = "L")
+    output.putpalette(unpack_rgb(codes).reshape(-1))
+    return output
+
+def downsample(image, factor, kernel):
+    ''' One pixel per factor x factor block, the last row and column of blocks reduced from what remains '''
+    #   The most common color of an indexed image's blocks needs no conversion
+    if kernel == "Mode" and image.mode == "P":
+        return downsample_indexed(image, factor)
+    image = to_mode(image, "RGB")
+    if kernel == "Box":
+        #   Pillow's integer block mean handles the partial edge blocks the same way
+        return image.reduce(factor)
+    return Image.fromarray(reduce_blocks(np.asarray(image), factor, BLOCK_REDUCERS[kernel]))
+
+def downsample_tiled(image, factor, kernel):
+    ''' Downsample one band of whole pixel blocks at a time. Bands are full width and start on block
+    boundaries, so the result matches a whole-frame downsample. '''
+    width, height = image.size
+    mode = "P" if kernel == "Mode" and image.mode == "P" else "RGB"
+    output = Image.new(mode, (-(-width // factor), -(-height // factor)))
+
+    for start, stop in row_bands(height, band_height(width, factor)):
+        band = downsample(image.crop((0, start, width, stop)), factor, kernel)
+        output.paste(band, (0, start // factor))
+
+    #   Every band of an indexed image has the same palette
+    if mode == "P":
+        output.putpalette(band.getpalette())
+    return output
+
+def pixelize(image, downsample_factor, upsample, kernel = "Box"):
+    width, height = image.size
+    factor = downsample_factor
+
+    #   Only the small image is materialised before upsampling
+    image = downsample_tiled(image, factor, kernel) if should_tile(image) else downsample(image, factor, kernel)
+
+    if not upsample:
+        return image
+    #   Scale by exactly factor from the top left, cutting the partial edge blocks to size
+    return image.resize((width, height), Image.NEAREST, box = (0, 0, width / factor, height / factor))
+
+
+@invocation("retro_pixelize", title = "Pixelize", tags = ["retro", "image", "pixel", "scale", "resize"], category = "image", version = "1.2.0")
+class PixelizeInvocation(BaseInvocation, WithMetadata, WithResultCache):
     ''' Pixelize an image. Downsample, upsample. '''
 
     #   Inputs
     image:              ImageField  = InputField(default = None, description = "Input image for pixelization")
     downsample_factor:  int         = InputField(default = 4, gt = 0, le = 30, description = "Image resizing factor. Higher = smaller image.")
     upsample:           bool        = InputField(default = True, description = "Upsample to original resolution")
+    kernel:             DOWNSAMPLE_KERNELS = InputField(default = "Box", description = "How each block is reduced: Box averages it, Median takes the median of each channel, Mode keeps the most common color for crisp palettes")
 
     def invoke(self, context: InvocationContext) -> ImageOutput:
-        image = context.images.get_pil(self.image.image_name)
-        width, height = image.size
-        factor = self.downsample_factor
-
-        image = image.convert("RGB") if image.mode != "RGB" else image
-
-        image = image.resize((width // factor, height // factor), Image.BOX)
-
-        image = image.resize((width, height), Image.NEAREST) if self.upsample else image
-        dto = context.images.save(image = image)
-
-        return ImageOutput(
-            image = ImageField(image_name = dto.image_name),
-            width = dto.width,
-            height = dto.height,
-        )
\ No newline at end of file
+        return run_cached(context, self, lambda image: pixelize(image, self.downsample_factor, self.upsample, self.kernel))
\ No newline at end of file
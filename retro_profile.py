@@ -0,0 +1,148 @@
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from threading import Lock
+import json
+import time
+import numpy as np
+from .retro_buffer import buffer_stats, to_indexed
+from .retro_config import PROFILE_LOG, PROFILE_METADATA, PROFILE_SAMPLES
+
+#   Profile of the node run in progress on this thread, if any
+current_profile = ContextVar("retroize_profile", default = None)
+
+def image_nbytes(value):
+    ''' Decoded size of a PIL image or array, or 0 for anything else '''
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if hasattr(value, "getbands") and hasattr(value, "size"):
+        width, height = value.size
+        return width * height * len(value.getbands())
+    return 0
+
+class Profile:
+    ''' Wall time, output bytes and image size of each phase of one node run. Phases may nest; a phase's
+    time excludes the phases run inside it, so an effect's time does not include its mode conversions. '''
+
+    def __init__(self, node):
+        self.node = node
+        self.phases = {}
+        self._nested = []
+
+    def run(self, name, fn, *args):
+        ''' Call fn(*args) as phase name. When it returns an image, its size and decoded bytes are recorded. '''
+        self._nested.append(0.0)
+        start = time.perf_counter()
+        try:
+            result = fn(*args)
+        finally:
+            elapsed = time.perf_counter() - start
+            nested = self._nested.pop()
+            if self._nested:
+                self._nested[-1] += elapsed
+            phase = self.phases.setdefault(name, {"seconds": 0.0, "bytes": 0, "size": None})
+            phase["seconds"] += elapsed - nested
+        if image_nbytes(result):
+            phase["bytes"] += image_nbytes(result)
+            phase["size"] = list(result.size) if hasattr(result, "getbands") else list(result.shape[1::-1])
+        return result
+
+    def summary(self):
+        return {
+            "node": self.node,
+            "phases": {name: {"ms": round(phase["seconds"] * 1000, 3), "bytes": phase["bytes"], "size": phase["size"]} for name, phase in self.phases.items()},
+        }
+
+    def metadata(self, node):
+        ''' The node's own metadata plus this profile, for the saved image; None when not enabled '''
+        if not PROFILE_METADATA:
+            return None
+        from invokeai.invocation_api import MetadataField
+        existing = getattr(getattr(node, "metadata", None), "root", None) or {}
+        return MetadataField({**existing, "retroize_profile": self.summary()})
+
+    def finish(self, context):
+        profile_stats.record(self)
+        if PROFILE_LOG:
+            context.logger.info("[RETROIZE] profile " + json.dumps(self.summary(), separators = (",", ":")))
+
+class ProfileStats:
+    ''' In-process registry of the latest phase timings per node, for percentiles '''
+
+    def __init__(self, samples = PROFILE_SAMPLES):
+        self.samples = samples
+        self._phases = {}
+        self._lock = Lock()
+
+    def record(self, profile):
+        with self._lock:
+            for name, phase in profile.phases.items():
+                key = (profile.node, name)
+                if key not in self._phases:
+                    self._phases[key] = deque(maxlen = self.samples)
+                self._phases[key].append((phase["seconds"], phase["bytes"]))
+
+    def clear(self):
+        with self._lock:
+            self._phases.clear()
+
+    def stats(self):
+        ''' {node: {phase: count, mean, p50, p90 and p99 milliseconds, mean bytes}} over the kept samples '''
+        with self._lock:
+            phases = {key: np.array(samples, dtype = np.float64) for key, samples in self._phases.items()}
+
+        result = {}
+        for (node, name), samples in phases.items():
+            p50, p90, p99 = np.percentile(samples[:, 0] * 1000, [50, 90, 99])
+            result.setdefault(node, {})[name] = {
+                "count": len(samples),
+                "mean_ms": float(samples[:, 0].mean() * 1000),
+                "p50_ms": float(p50),
+                "p90_ms": float(p90),
+                "p99_ms": float(p99),
+                "mean_bytes": float(samples[:, 1].mean()),
+            }
+        return result
+
+profile_stats = ProfileStats()
+
+@contextmanager
+def profiling(context, node):
+    ''' Profile one run of node: code inside the block, and effects it calls on this thread, record
+    their phases into it. The profile is registered (and logged) when the block completes. '''
+    profile = Profile(type(node).__name__)
+    token = current_profile.set(profile)
+    try:
+        yield profile
+        profile.finish(context)
+    finally:
+        current_profile.reset(token)
+
+def profiled(name, fn, *args):
+    ''' Run fn(*args) as a phase of the current node's profile, or just run it outside a node '''
+    profile = current_profile.get()
+    return fn(*args) if profile is None else profile.run(name, fn, *args)
+
+def output_image(image, mode):
+    ''' Effects return their native mode; this converts an output to the mode it is saved in. 'P'
+    indexes the image losslessly, and falls back to RGB for an image with more than 256 colors. '''
+    if mode == "P":
+        return profiled("convert", to_indexed, image) or to_mode(image, "RGB")
+    return to_mode(image, mode)
+
+def save_image(context, profile, node, image, mode = "RGB"):
+    ''' Save image in mode as the save phase, with the profile in its metadata when that is enabled.
+    A mode of None saves the image as it is. '''
+    if mode is not None:
+        image = output_image(image, mode)
+    metadata = profile.metadata(node)
+    if metadata is None:
+        return profile.run("save", lambda: context.images.save(image = image))
+    return profile.run("save", lambda: context.images.save(image = image, metadata = metadata))
+
+def to_mode(image, mode):
+    ''' image in the given mode, converting (as a profiled phase) only when needed '''
+    buffer_stats.count(image, mode, image.mode != mode)
+    if image.mode == mode:
+        return image
+    return profiled("convert", image.convert, mode)
@@ -1,8 +1,18 @@
 from typing import Literal
 from PIL import Image
-from .retro_helpers import get_palette
+import numpy as np
+from .retro_buffer import OUTPUT_FORMATS, indexed, to_indexed, used_colors
+from .retro_color import nearest_colors
+from .retro_dither import DITHER_MODES, dither_indices
+from .retro_helpers import palette_image
 from .retro_helpers import PIL_QUANTIZE_MAP as QMap
-from .retro_helpers import PIL_QUANTIZE_MODES as QMode
+from .retro_kmeans import ITERATIONS, learn_palette, refine_palette
+from .retro_lut import indexed_image, lut_palettize, palette_colors
+from .retro_palettes import palette_store
+from .retro_profile import to_mode
+from .retro_resultcache import WithResultCache, run_cached
+from .retro_sequence import FrameSequence
+from .retro_unique import distinct_colors, distinct_histogram
 
 from invokeai.invocation_api import (
     BaseInvocation,
@@ -15,47 +25,138 @@ from invokeai.invocation_api import (
     )
 
 
-#   Define Quantize methods list
-PIL_QUANTIZE_MODES = Literal[
+#   Pillow's methods, plus the native palette learner
+QUANTIZE_METHODS = Literal[
     "Median Cut",
     "Max Coverage",
     "Fast Octree",
+    "K-Means",
 ]
 
-#   Define Quantize methods map
-PIL_QUANTIZE_MAP = {
-    "Median Cut": Image.Quantize.MEDIANCUT,
-    "Max Coverage": Image.Quantize.MAXCOVERAGE,
-    "Fast Octree": Image.Quantize.FASTOCTREE
-}
 
+def map_palette(image, palette, dither, dither_mode, row_offset = 0):
+    ''' Map an RGB image onto an (N, 3) uint8 palette in a single pass; returns a 'P' image '''
+    if not dither:
+        return lut_palettize(image, palette)
+    if dither_mode != "Floyd-Steinberg":
+        return indexed_image(dither_indices(np.asarray(image), palette, dither_mode, row_offset = row_offset), palette)
+    return image.quantize(palette = palette_image(palette), dither = Image.FLOYDSTEINBERG)
 
-@invocation("retro_quantize", title = "Quantize", tags = ["retro", "image", "pixel", "quantize"], category = "image", version="1.0.1")
-class RetroQuantizeInvocation(BaseInvocation, WithMetadata):
+def kmeans_palette(image_array, colors, iterations, dither, seed = 0, init = None):
+    ''' The palette K-Means quantizing learns for an (height, width, 3) uint8 array, and the distinct-color
+    histogram it learned from, or None when it learned from a pixel sample. Without dither, an image with
+    few distinct colors for its size is learned from all of them, weighted by their pixel counts. '''
+    #   Dithering works on every pixel, so it learns from the sampled histogram
+    histogram = distinct_histogram(image_array) if not dither else None
+    palette = learn_palette(image_array, colors, iterations or ITERATIONS, seed, init, None if histogram is None else histogram[:2])
+    return palette, histogram
+
+def quantize_kmeans(image, colors, iterations, dither, dither_mode, seed, init):
+    ''' Learn the palette once with mini-batch k-means, then map the image onto it in a single pass. When
+    the palette was learned from the image's distinct colors, only those are matched, then expanded with
+    one gather. '''
+    palette, histogram = kmeans_palette(np.asarray(image), colors, iterations, dither, seed, init)
+
+    if histogram is not None:
+        unique, _, inverse = histogram
+        mapping = nearest_colors(unique.astype(np.float32), palette.astype(np.float32)).astype(np.uint8)
+        return indexed_image(np.take(mapping, inverse), palette)
+    return map_palette(image, palette, dither, dither_mode)
+
+def quantize(image, colors, method, kmeans, dither, dither_mode = "Floyd-Steinberg", seed = 0, init = None):
+    ''' Quantize an image of any mode; returns a 'P' image, or the input itself when it is already exact '''
+    #   Median Cut and Max Coverage keep every color of an image that already has few enough of them,
+    #   so the palette is known without quantizing; an indexed input lists its colors without converting
+    exact = used_colors(image) if method not in ("Fast Octree", "K-Means") else None
+    if exact is not None and len(exact) > colors:
+        exact = None
+    if exact is not None and not dither:
+        return image
+
+    image = to_mode(image, "RGB")
+
+    if method == "K-Means":
+        return quantize_kmeans(image, colors, kmeans, dither, dither_mode, seed, init)
+
+    if dither and dither_mode != "Floyd-Steinberg":
+        #   Quantize once for the palette, then dither onto it natively
+        palette = palette_colors(image.quantize(colors = colors, method = QMap[method], kmeans = kmeans))[:colors]
+        return indexed_image(dither_indices(np.asarray(image), palette, dither_mode), palette)
+
+    if exact is None and method != "Fast Octree":
+        exact = distinct_colors(np.asarray(image), colors)
+
+    if dither:
+        #   The colors the quantized image uses, read from its palette, as Get Palette's exact mode would
+        palette = palette_image(exact if exact is not None else used_colors(image.quantize(colors, method = QMap[method])))
+        return image.quantize(colors = colors, palette = palette, method = QMap[method], kmeans = kmeans, dither = Image.FLOYDSTEINBERG)
+
+    if exact is not None:
+        return image
+
+    return image.quantize(colors = colors, method = QMap[method], kmeans = kmeans)
+
+
+class QuantizeSequence:
+    ''' Quantize consecutive frames onto one palette, learned on the first frame with the given method.
+    With K-Means and update steps, the palette then follows the footage a few mini-batch steps per
+    frame. Pixels that did not change keep their previous index (see retro_sequence.FrameSequence). '''
+
+    def __init__(self, colors, method, kmeans, dither, dither_mode, seed = 0, init = None, update = 0, threshold = 0):
+        self.colors = colors
+        self.method = method
+        self.kmeans = kmeans
+        self.dither = dither
+        self.dither_mode = dither_mode
+        self.seed = seed
+        self.init = init
+        self.update = update if method == "K-Means" else 0
+        self.frames = FrameSequence(threshold)
+        self.centers = None
+        self.count = 0
+
+    def first(self, image):
+        ''' Quantize the first frame as the single-frame node does, and keep its indices and the colors they use '''
+        quantized = to_indexed(quantize(image, self.colors, self.method, self.kmeans, self.dither, self.dither_mode, self.seed, self.init))
+        indices, colors = indexed(quantized)
+        palette = colors[:len(quantized.getpalette("RGB")) // 3]
+        self.centers = palette.astype(np.float32)
+        self.count += 1
+        return indexed_image(self.frames.start(np.asarray(image), indices), palette)
+
+    def __call__(self, image):
+        image = to_mode(image, "RGB")
+        if self.centers is None:
+            return self.first(image)
+        if self.update:
+            self.centers = refine_palette(self.centers, np.asarray(image), self.update, self.seed + self.count)
+        self.count += 1
+
+        palette = np.clip(np.rint(self.centers), 0, 255).astype(np.uint8)
+        indices = self.frames.map(np.asarray(image), lambda region, top: np.asarray(map_palette(Image.fromarray(region), palette, self.dither, self.dither_mode, top)))
+        return indexed_image(indices, palette)
+
+
+@invocation("retro_quantize", title = "Quantize", tags = ["retro", "image", "pixel", "quantize"], category = "image", version = "1.4.3")
+class RetroQuantizeInvocation(BaseInvocation, WithMetadata, WithResultCache):
     ''' Quantize an image to 256 or less colors '''
 
     #   Inputs
     image:          ImageField = InputField(default = None, description = "Input image for quantizing")
     colors:         int = InputField(default = 64, gt = 0, le = 256, description = "Number of colors the image should be reduced to")
-    method:         QMode = InputField(default = "Median Cut", description = "Quantization method")
-    kmeans:         int = InputField(default = 0, ge = 0, description = "k_means")
+    method:         QUANTIZE_METHODS = InputField(default = "Median Cut", description = "Quantization method")
+    kmeans:         int = InputField(default = 0, ge = 0, description = "k_means refinement passes; for K-Means, mini-batch steps (0 = 64)")
+    seed:           int = InputField(default = 0, ge = 0, description = "Seed of the K-Means sampling")
+    init_palette:   ImageField = InputField(default = None, description = "Palette K-Means starts from, such as the previous frame's, for stable colors across frames")
     dither:         bool = InputField(default = True, description = "Dither quantized image")
+    dither_mode:    DITHER_MODES = InputField(default = "Floyd-Steinberg", description = "Dithering algorithm; ordered modes (Bayer, Blue Noise) are the fastest")
+    output_format:  OUTPUT_FORMATS = InputField(default = "RGB", description = "Save as RGB, or as a palette-indexed PNG that is several times smaller")
 
     def invoke(self, context: InvocationContext) -> ImageOutput:
-        image = context.images.get_pil(self.image.image_name)
-
-        image = image.convert("RGB") if image.mode != "RGB" else image
-
-        if self.dither:
-            palette = get_palette(image.quantize(self.colors, method = QMap[self.method]).convert('RGB'))
-            image = image.quantize(colors = self.colors, palette = palette, method = QMap[self.method], kmeans = self.kmeans, dither = Image.FLOYDSTEINBERG).convert('RGB')
-        else:
-            image = image.quantize(colors = self.colors, method = QMap[self.method], kmeans = self.kmeans).convert('RGB')
-
-        dto = context.images.save(image = image)
-
-        return ImageOutput(
-            image = ImageField(image_name = dto.image_name),
-            width = dto.width,
-            height = dto.height,
+        init = palette_store.from_image_field(context, self.init_palette) if self.method == "K-Means" and self.init_palette is not None else None
+        return run_cached(
+            context,
+            self,
+            lambda image: quantize(image, self.colors, self.method, self.kmeans, self.dither, self.dither_mode, self.seed, None if init is None else init.colors),
+            extra = () if init is None else (init.digest,),
         )
\ No newline at end of file
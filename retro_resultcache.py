@@ -0,0 +1,179 @@
+from threading import Lock
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from pydantic import BaseModel
+from .retro_buffer import output_mode
+from .retro_cache import LRUCache
+from .retro_config import RESULT_CACHE_BYTES, RESULT_CACHE_DIR
+from .retro_profile import profiling, save_image
+
+from invokeai.invocation_api import(
+    ImageField,
+    ImageOutput,
+    InputField,
+)
+
+
+class WithResultCache(BaseModel):
+    ''' Adds the opt-in result cache toggle to a node '''
+    result_cache: bool = InputField(default = False, description = "Reuse the saved output of an earlier run with identical input pixels and parameters")
+
+#   Node fields that never change what a node computes
+IGNORED_FIELDS = {"id", "is_intermediate", "use_cache", "metadata", "board", "image", "images", "result_cache", "parallel"}
+
+class ResultCache:
+    ''' Disk-backed map from a content hash of a node's input pixels and parameters to the output image
+    saved by an earlier run. The index is a small sqlite database; once the outputs it references exceed
+    the byte budget (counted at their decoded size), the least recently used entries are forgotten.
+    Output images themselves belong to InvokeAI and are never deleted here. '''
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._db = None
+        self._lock = Lock()
+        #   Gallery images are immutable, so the pixel hash of an image name never changes
+        self._digests = LRUCache(1024 * 1024)
+
+    def _connect(self):
+        if self._db is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok = True)
+            db = sqlite3.connect(self.path, timeout = 30, check_same_thread = False)
+            db.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, image_name TEXT NOT NULL, nbytes INTEGER NOT NULL, used REAL NOT NULL)")
+            db.execute("CREATE INDEX IF NOT EXISTS results_used ON results (used)")
+            db.commit()
+            self._db = db
+        return self._db
+
+    def input_digest(self, context, image_field):
+        ''' Pixel hash of a gallery image; also returns the image when it had to be loaded '''
+        digest = self._digests.get(image_field.image_name)
+        if digest is not None:
+            return digest, None
+
+        image = context.images.get_pil(image_field.image_name)
+        hasher = hashlib.blake2b(digest_size = 20)
+        hasher.update(f"{image.mode}:{image.width}x{image.height}:".encode())
+        hasher.update(image.tobytes())
+        digest = hasher.hexdigest()
+        self._digests.put(image_field.image_name, digest, nbytes = 128)
+        return digest, image
+
+    def key(self, node, input_digest, extra = ()):
+        ''' Cache key of running node on an input with the given pixel hash. extra carries anything
+        the parameters do not capture, such as the content hash of a palette file. '''
+        version = getattr(getattr(type(node), "UIConfig", None), "version", None)
+        params = node.model_dump(mode = "json", exclude = IGNORED_FIELDS)
+        payload = json.dumps([type(node).__qualname__, str(version), params, input_digest, list(extra)], sort_keys = True, default = str)
+        return hashlib.blake2b(payload.encode(), digest_size = 20).hexdigest()
+
+    def lookup(self, context, key):
+        ''' The saved output for key, or None. Entries whose image has since been deleted are dropped. '''
+        try:
+            with self._lock:
+                db = self._connect()
+                row = db.execute("SELECT image_name FROM results WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    db.execute("UPDATE results SET used = ? WHERE key = ?", (time.time(), key))
+                    db.commit()
+        except sqlite3.Error:
+            row = None
+
+        dto = None
+        if row is not None:
+            try:
+                dto = context.images.get_dto(row[0])
+            except Exception:
+                self.forget(key)
+
+        with self._lock:
+            if dto is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return dto
+
+    def store(self, key, dto, nbytes):
+        try:
+            with self._lock:
+                db = self._connect()
+                db.execute("INSERT OR REPLACE INTO results (key, image_name, nbytes, used) VALUES (?, ?, ?, ?)", (key, dto.image_name, nbytes, time.time()))
+                total = db.execute("SELECT COALESCE(SUM(nbytes), 0) FROM results").fetchone()[0]
+                if total > self.max_bytes:
+                    evicted = []
+                    for old_key, old_bytes in db.execute("SELECT key, nbytes FROM results ORDER BY used"):
+                        if total <= self.max_bytes:
+                            break
+                        evicted.append((old_key,))
+                        total -= old_bytes
+                    db.executemany("DELETE FROM results WHERE key = ?", evicted)
+                db.commit()
+        except sqlite3.Error:
+            pass
+
+    def forget(self, key):
+        try:
+            with self._lock:
+                db = self._connect()
+                db.execute("DELETE FROM results WHERE key = ?", (key,))
+                db.commit()
+        except sqlite3.Error:
+            pass
+
+    def clear(self):
+        try:
+            with self._lock:
+                db = self._connect()
+                db.execute("DELETE FROM results")
+                db.commit()
+        except sqlite3.Error:
+            pass
+
+    def stats(self):
+        try:
+            with self._lock:
+                entries, total = self._connect().execute("SELECT COUNT(*), COALESCE(SUM(nbytes), 0) FROM results").fetchone()
+        except sqlite3.Error:
+            entries, total = 0, 0
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": entries,
+            "bytes": total,
+            "max_bytes": self.max_bytes,
+        }
+
+result_cache = ResultCache(os.path.join(RESULT_CACHE_DIR, "results.sqlite"), RESULT_CACHE_BYTES)
+
+def output_nbytes(image):
+    return image.width * image.height * len(image.getbands())
+
+def run_cached(context, node, process, extra = ()):
+    ''' Run process on the node's input image and save the result, unless the node opted into the
+    result cache and an earlier run with the same input pixels and parameters already saved it.
+    Every phase is recorded in the node's profile. '''
+    with profiling(context, node) as profile:
+        if not node.result_cache:
+            image = profile.run("load", context.images.get_pil, node.image.image_name)
+            image = profile.run("effect", process, image)
+            dto = save_image(context, profile, node, image, output_mode(node))
+        else:
+            digest, image = profile.run("hash", result_cache.input_digest, context, node.image)
+            key = result_cache.key(node, digest, extra)
+            dto = profile.run("lookup", result_cache.lookup, context, key)
+            if dto is None:
+                image = image if image is not None else profile.run("load", context.images.get_pil, node.image.image_name)
+                image = profile.run("effect", process, image)
+                dto = save_image(context, profile, node, image, output_mode(node))
+                result_cache.store(key, dto, output_nbytes(image))
+
+    return ImageOutput(
+        image = ImageField(image_name = dto.image_name),
+        width = dto.width,
+        height = dto.height,
+    )
@@ -1,5 +1,11 @@
-import random
-from PIL import Image, ImageDraw
+from PIL import Image
+import numpy as np
+import cv2
+from .retro_cache import LRUCache
+from .retro_config import SCANLINE_CACHE_BYTES
+from .retro_profile import to_mode
+from .retro_resultcache import WithResultCache, run_cached
+from .retro_tiles import map_tiles, should_tile
 
 from invokeai.invocation_api import(
     BaseInvocation,
@@ -12,8 +18,107 @@ from invokeai.invocation_api import(
     ColorField
 )
 
-@invocation("retro_scanlines_simple", title="Scan Lines", tags=["retro", "image", "color", "pixel", "line"], category="image", version = "1.0.1")
-class RetroScanlinesSimpleInvocation(BaseInvocation, WithMetadata):
+#   Jitter-free line profiles and blend tables depend only on their parameters
+scanline_cache = LRUCache(SCANLINE_CACHE_BYTES)
+
+def line_profile(length, line_size, line_spacing):
+    ''' 1D mask of the rows (or columns) covered by evenly spaced lines. A line drawn at p covers p..p+line_size,
+    matching the inclusive rectangles of the original ImageDraw renderer. '''
+    def build():
+        profile = np.zeros(length, dtype = bool)
+        starts = np.arange(line_spacing, length, line_spacing)
+        covered = (starts[:, None] + np.arange(line_size + 1)).reshape(-1)
+        profile[covered[covered < length]] = True
+        profile.flags.writeable = False
+        return profile
+
+    return scanline_cache.get_or_create(("profile", length, line_size, line_spacing), build)
+
+def jittered_line_profile(length, line_size, line_spacing, size_jitter, space_jitter, rng):
+    ''' 1D line mask with randomly sized and spaced lines. Offsets are drawn from rng in array calls,
+    a chunk of lines at a time, until the lines run past the end. '''
+    profile = np.zeros(length, dtype = bool)
+    chunk = length // max(line_spacing - space_jitter, 1) + 16
+    position = 0
+
+    while position < length:
+        sizes = line_size + (rng.uniform(-size_jitter, size_jitter, chunk) if size_jitter > 0 else np.zeros(chunk))
+        steps = line_spacing + (rng.uniform(-space_jitter, space_jitter, chunk) if space_jitter > 0 else np.zeros(chunk))
+        starts = position + np.cumsum(steps.astype(np.int64))
+
+        #   Lines after the first start past the end are never drawn
+        past = np.flatnonzero(starts >= length)
+        count = past[0] if len(past) else chunk
+        position = starts[count] if len(past) else starts[-1]
+
+        starts, sizes = starts[:count], np.maximum(sizes[:count], 0).astype(np.int64)
+        visible = starts >= 0
+        starts, sizes = starts[visible], sizes[visible]
+
+        #   Mark [start, start + size] for every line with a difference array
+        edges = np.zeros(length + 1, dtype = np.int64)
+        np.add.at(edges, starts, 1)
+        np.add.at(edges, np.minimum(starts + sizes + 1, length), -1)
+        profile |= np.cumsum(edges[:length]) > 0
+
+    return profile
+
+def blend_table(line_color):
+    ''' (1, 256, 3) per-channel lookup table of Image.alpha_composite for the line color over opaque pixels '''
+    def build():
+        levels = np.repeat(np.arange(256, dtype = np.uint8)[:, None], 4, axis = 1)
+        levels[:, 3] = 255
+        base = Image.fromarray(levels[None], mode = "RGBA")
+        lines = Image.new("RGBA", base.size, tuple(line_color))
+        table = np.ascontiguousarray(np.asarray(Image.alpha_composite(base, lines))[:, :, :3])
+        table.flags.writeable = False
+        return table
+
+    return scanline_cache.get_or_create(("blend", tuple(line_color)), build)
+
+def blend_lines(image_array, profile, table, vertical):
+    ''' Blend the covered rows (or columns) of an RGB array in place, one contiguous run at a time '''
+    edges = np.diff(np.concatenate(([0], profile.view(np.int8), [0])))
+    for start, stop in zip(np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)):
+        run = image_array[:, start:stop] if vertical else image_array[start:stop]
+        cv2.LUT(run, table, dst = run)
+
+def draw_lines(image, profile, line_color, vertical):
+    ''' Draw the lines of a profile over an image, returning a new RGB image '''
+    width, height = image.size
+
+    if "A" in image.getbands() or "transparency" in image.info:
+        #   Translucent pixels need the full compositing formula; leave that to Pillow
+        overlay = np.zeros((height, width, 4), dtype = np.uint8)
+        if vertical:
+            overlay[:, profile] = line_color
+        else:
+            overlay[profile] = line_color
+        return to_mode(Image.alpha_composite(to_mode(image, "RGBA"), Image.fromarray(overlay, mode = "RGBA")), "RGB")
+
+    #   Opaque pixels: blend each run of covered rows or columns in place through the lookup table
+    image_array = np.array(to_mode(image, "RGB"))
+    blend_lines(image_array, profile, blend_table(line_color), vertical)
+
+    return Image.fromarray(image_array)
+
+def scanlines(image, line_size, line_spacing, line_color, size_jitter, space_jitter, vertical, seed = 0):
+    width, height = image.size
+    length = width if vertical else height
+
+    if size_jitter > 0 or space_jitter > 0:
+        profile = jittered_line_profile(length, line_size, line_spacing, size_jitter, space_jitter, np.random.default_rng(seed))
+    else:
+        profile = line_profile(length, line_size, line_spacing)
+
+    #   Lines only depend on the profile, so large images are drawn band by band
+    if should_tile(image):
+        return map_tiles(image, lambda tile, start, stop: draw_lines(tile, profile if vertical else profile[start:stop], line_color, vertical))
+
+    return draw_lines(image, profile, line_color, vertical)
+
+@invocation("retro_scanlines_simple", title="Scan Lines", tags=["retro", "image", "color", "pixel", "line"], category="image", version = "1.2.0")
+class RetroScanlinesSimpleInvocation(BaseInvocation, WithMetadata, WithResultCache):
     """ Apply a simple scan lines effect to the input image """
 
     #   Inputs
@@ -24,38 +129,9 @@ class RetroScanlinesSimpleInvocation(BaseInvocation, WithMetadata):
     size_jitter:    int         = InputField(default = 0, ge = 0, description = "Random line position offset")
     space_jitter:   int         = InputField(default = 0, ge = 0, description = "Random line position offset")
     vertical:       bool        = InputField(default = False, description = "Switch scanlines to vertical")
+    seed:           int         = InputField(default = 0, ge = 0, description = "Seed for the random line size and spacing jitter")
 
     def invoke(self, context: InvocationContext) -> ImageOutput:
-        image = context.images.get_pil(self.image.image_name).convert("RGBA")
-        width, height = image.size
         line_color = (self.line_color.r, self.line_color.g, self.line_color.b, self.line_color.a)
-        
-        scanlines_image = Image.new("RGBA", (width, height))
-        draw = ImageDraw.Draw(scanlines_image)
-
-        if self.vertical:  # Create vertical scanlines
-            x = 0
-            while x < width:
-                line_width = self.line_size + random.uniform(-self.size_jitter, self.size_jitter)  # Random size adjustment
-                x += int(self.line_spacing + random.uniform(-self.space_jitter, self.space_jitter))  # Random spacing adjustment
-                if 0 <= x < width:  # Check if the line is within the image bounds
-                    draw.rectangle([(x, 0), (x + int(line_width), height)], fill = line_color)
-        else:  # Create horizontal scanlines
-            y = 0
-            while y < height:
-                line_height = self.line_size + random.uniform(-self.size_jitter, self.size_jitter)  # Random size adjustment
-                if line_height < 0:
-                    line_height = 0  # Ensure line height is not negative
-                y += int(self.line_spacing + random.uniform(-self.space_jitter, self.space_jitter))  # Random spacing adjustment
-                if 0 <= y < height:  # Check if the line is within the image bounds
-                    draw.rectangle([(0, y), (width, y + int(line_height))], fill = line_color)
-        
-        scanlines_image = Image.alpha_composite(image, scanlines_image).convert("RGB")
-        
-        dto = context.images.save(image = scanlines_image)
-
-        return ImageOutput(
-            image = ImageField(image_name = dto.image_name),
-            width = dto.width,
-            height = dto.height,
-        )
\ No newline at end of file
+
+        return run_cached(context, self, lambda image: scanlines(image, self.line_size, self.line_spacing, line_color, self.size_jitter, self.space_jitter, self.vertical, self.seed))
\ No newline at end of file
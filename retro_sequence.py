@@ -0,0 +1,107 @@
+from threading import Lock
+import numpy as np
+from .retro_config import SEQUENCE_BAND_ROWS
+from .retro_dither import ORDERED_SIZES
+
+#   Changed regions start on a multiple of every ordered threshold map's width, so their dither pattern
+#   lines up with the whole frame's
+COLUMN_ALIGN = max(ORDERED_SIZES.values())
+
+class SequenceStats:
+    ''' Frames mapped in sequence mode, the pixels of the regions mapped again, and the pixels that changed '''
+
+    def __init__(self):
+        self.frames = 0
+        self.pixels = 0
+        self.recomputed = 0
+        self.changed = 0
+        self._lock = Lock()
+
+    def count(self, pixels, recomputed, changed):
+        with self._lock:
+            self.frames += 1
+            self.pixels += pixels
+            self.recomputed += recomputed
+            self.changed += changed
+
+    def stats(self):
+        with self._lock:
+            return {
+                "frames": self.frames,
+                "pixels": self.pixels,
+                "recomputed": self.recomputed,
+                "changed": self.changed,
+            }
+
+sequence_stats = SequenceStats()
+
+def changed_pixels(reference, image_array, threshold = 0):
+    ''' (height, width) mask of the pixels of an RGB array whose color differs from the reference by
+    more than threshold in any channel '''
+    changed = np.zeros(image_array.shape[:2], dtype = bool)
+    #   One channel at a time: reducing a (height, width, 3) mask over its last axis is several times slower
+    for channel in range(3):
+        old, new = reference[..., channel], image_array[..., channel]
+        if threshold <= 0:
+            changed |= old != new
+        else:
+            #   Absolute difference without widening: the larger minus the smaller value never wraps
+            changed |= np.maximum(old, new) - np.minimum(old, new) > threshold
+    return changed
+
+def changed_regions(changed, rows = SEQUENCE_BAND_ROWS, align = COLUMN_ALIGN):
+    ''' (top, bottom, left, right) boxes covering the changes of a mask: runs of adjacent row bands that
+    hold any change, each narrowed to its changed columns rounded out to multiples of align '''
+    height, width = changed.shape
+    flags = np.zeros(-(-height // rows) * rows, dtype = bool)
+    flags[:height] = changed.any(axis = 1)
+    flags = flags.reshape(-1, rows).any(axis = 1)
+
+    regions = []
+    edges = np.diff(np.concatenate(([0], flags.view(np.int8), [0])))
+    for start, stop in zip(np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)):
+        top, bottom = start * rows, min(stop * rows, height)
+        columns = np.flatnonzero(changed[top:bottom].any(axis = 0))
+        left, right = columns[0] - columns[0] % align, min(columns[-1] + align - columns[-1] % align, width)
+        regions.append((top, bottom, left, right))
+    return regions
+
+class FrameSequence:
+    ''' Temporal coherence for consecutive frames mapped onto one palette. Each frame is compared with
+    the colors its predecessors' indices were computed from; pixels within threshold of them keep
+    their index, so static areas neither flicker nor grow dither noise. Only the regions holding
+    changes are mapped again, and of those only the changed pixels take the new indices. '''
+
+    def __init__(self, threshold = 0):
+        self.threshold = threshold
+        self.reference = None
+        self.indices = None
+
+    def start(self, image_array, indices):
+        ''' Begin the sequence with a frame and its (height, width) palette indices, computed by the caller '''
+        height, width = image_array.shape[:2]
+        self.reference = np.array(image_array)
+        self.indices = np.array(indices, dtype = np.uint8)
+        sequence_stats.count(height * width, height * width, height * width)
+        return self.indices.copy()
+
+    def map(self, image_array, compute):
+        ''' Palette indices of an (height, width, 3) uint8 frame. compute(region, top) maps a region of
+        the frame whose first row is top, and whose first column is a multiple of COLUMN_ALIGN, and
+        returns its (rows, columns) indices. '''
+        height, width = image_array.shape[:2]
+        if self.reference is None or self.reference.shape != image_array.shape:
+            #   First frame, or a new size: nothing to reuse
+            return self.start(image_array, compute(image_array, 0))
+
+        changed = changed_pixels(self.reference, image_array, self.threshold)
+        regions = changed_regions(changed)
+        for top, bottom, left, right in regions:
+            mask = changed[top:bottom, left:right]
+            region = image_array[top:bottom, left:right]
+            self.indices[top:bottom, left:right][mask] = np.asarray(compute(region, top))[mask]
+            self.reference[top:bottom, left:right][mask] = region[mask]
+
+        recomputed = sum((bottom - top) * (right - left) for top, bottom, left, right in regions)
+        sequence_stats.count(height * width, recomputed, int(np.count_nonzero(changed)))
+        return self.indices.copy()
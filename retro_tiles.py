@@ -0,0 +1,38 @@
+from PIL import Image
+from .retro_config import THREADS, TILE_PIXELS, TILE_THRESHOLD_PIXELS
+from .retro_parallel import imap_bounded
+
+
+def should_tile(image):
+    ''' Whether an image is large enough to be processed band by band '''
+    return image.width * image.height > TILE_THRESHOLD_PIXELS
+
+def band_height(width, align = 1):
+    ''' Rows per band for images of the given width: about TILE_PIXELS pixels, a multiple of align '''
+    rows = TILE_PIXELS // max(width, 1)
+    return max(align, rows - rows % align)
+
+def row_bands(height, rows):
+    for start in range(0, height, rows):
+        yield start, min(start + rows, height)
+
+def map_bands(effect, size, mode = "RGB", align = 1, parallel = False):
+    ''' Assemble an image of the given size from full-width bands: effect(start, stop) returns the
+    band of rows start..stop, which is pasted into the output. With parallel, up to THREADS bands
+    are computed at once on the shared pool and pasted in order. '''
+    width, height = size
+    output = Image.new(mode, size)
+    bands = row_bands(height, band_height(width, align))
+
+    def process(band):
+        return band[0], effect(*band)
+
+    for start, tile in imap_bounded(process, bands, THREADS) if parallel else map(process, bands):
+        output.paste(tile, (0, start))
+    return output
+
+def map_tiles(image, effect, mode = "RGB", align = 1, parallel = False):
+    ''' Apply a row-local effect to an image one full-width band at a time. effect(tile, start, stop)
+    gets the cropped band and its row range and returns the processed band; peak memory is the
+    input and output plus a few bands. '''
+    return map_bands(lambda start, stop: effect(image.crop((0, start, image.width, stop)), start, stop), image.size, mode, align, parallel)
@@ -0,0 +1,149 @@
+from threading import Lock, local
+import numpy as np
+from .retro_config import UNIQUE_MIN_PIXELS_PER_COLOR
+
+#   Pixels sampled to rule out many-colored images before the full pass
+SAMPLE_PIXELS = 1 << 14
+
+#   Pixels packed and looked up per step of the full pass
+BAND_PIXELS = 1 << 16
+
+def pack_rgb(array):
+    #   Pack (..., 3) uint8 colors into 24-bit integers
+    array = np.asarray(array, dtype = np.uint8)
+    #   Shifted in place, so only the result is allocated
+    packed = array[..., 0].astype(np.uint32)
+    packed <<= 8
+    packed |= array[..., 1]
+    packed <<= 8
+    packed |= array[..., 2]
+    return packed
+
+def unpack_rgb(packed):
+    packed = np.asarray(packed, dtype = np.uint32)
+    return np.stack([packed >> 16, packed >> 8, packed], axis = -1).astype(np.uint8)
+
+class UniqueStats:
+    ''' How often the distinct-color fast path was taken or skipped '''
+
+    def __init__(self):
+        self.taken = 0
+        self.skipped = 0
+        self._lock = Lock()
+
+    def count(self, taken):
+        with self._lock:
+            if taken:
+                self.taken += 1
+            else:
+                self.skipped += 1
+
+    def stats(self):
+        return {
+            "taken": self.taken,
+            "skipped": self.skipped,
+        }
+
+unique_stats = UniqueStats()
+
+_tables = local()
+
+def color_budget(pixels):
+    ''' Most distinct colors an image of this many pixels may have for the fast path to pay off '''
+    return pixels // UNIQUE_MIN_PIXELS_PER_COLOR
+
+def color_table():
+    ''' This thread's dense 24-bit table from packed color to a uint16 entry plus one, all zero between uses.
+    Allocating and zeroing 32 MB on every call cost more than the lookup it serves. '''
+    table = getattr(_tables, "table", None)
+    if table is None:
+        table = _tables.table = np.zeros(1 << 24, dtype = np.uint16)
+    return table
+
+def sample_colors(image_array, max_colors):
+    ''' The packed distinct colors of a strided sample of an (height, width, 3) uint8 array, or None when
+    the sample already has more than max_colors. Without max_colors the limit follows the pixels per color
+    ratio. A sample made mostly of distinct colors is taken as a photo and skipped as well. '''
+    pixels = image_array.reshape(-1, 3)
+    sample = np.unique(pack_rgb(pixels[::max(1, len(pixels) // SAMPLE_PIXELS)]))
+    if max_colors is None:
+        max_colors = color_budget(len(pixels))
+    return sample if len(sample) <= min(max_colors, SAMPLE_PIXELS // 2) else None
+
+def lookup_colors(image_array, max_colors, entries):
+    ''' Look every pixel of an (height, width, 3) uint8 array up by its color: entries(codes, count) gives
+    the uint16 values of new packed colors, count being the number of colors met before them. Returns the
+    distinct packed colors in the order they were met and the (height, width) uint16 values, or None when
+    the array has more colors than max_colors, or by default than the pixels per color ratio allows. '''
+    codes = sample_colors(image_array, max_colors)
+    if codes is None:
+        unique_stats.count(False)
+        return None
+    height, width = image_array.shape[:2]
+    limit = min(max_colors if max_colors is not None else color_budget(height * width), (1 << 16) - 1)
+
+    #   The sample's colors go into the table first; a color it missed is added when a band meets it.
+    #   Entries are stored plus one, so zero marks a color not seen yet. Bands keep the packed temporaries
+    #   in cache.
+    rows = max(1, BAND_PIXELS // max(width, 1))
+    values = np.empty((height, width), dtype = np.uint16)
+    table = color_table()
+    table[codes] = entries(codes, 0) + 1
+    try:
+        for start in range(0, height, rows):
+            packed = pack_rgb(image_array[start:start + rows])
+            block = np.take(table, packed, out = values[start:start + rows])
+            if block.min() == 0:
+                missed = np.unique(packed[block == 0])
+                if len(codes) + len(missed) > limit:
+                    unique_stats.count(False)
+                    return None
+                table[missed] = entries(missed, len(codes)) + 1
+                codes = np.concatenate((codes, missed))
+                np.take(table, packed, out = block)
+            block -= 1
+    finally:
+        table[codes] = 0
+
+    unique_stats.count(True)
+    return codes, values
+
+def distinct_inverse(image_array, max_colors = None):
+    ''' The distinct colors of an (height, width, 3) uint8 array as packed 24-bit codes in ascending order,
+    and the (height, width) uint16 position of every pixel's color among them. Returns None when the array
+    has too many colors: more than max_colors, or by default more than the pixels per color ratio allows. '''
+    found = lookup_colors(image_array, max_colors, lambda codes, count: np.arange(count, count + len(codes), dtype = np.uint16))
+    if found is None:
+        return None
+    codes, inverse = found
+    if np.any(codes[1:] < codes[:-1]):
+        #   Colors the sample missed were appended after it; sort them in and renumber the pixels
+        order = np.argsort(codes)
+        rank = np.empty(len(codes), dtype = np.uint16)
+        rank[order] = np.arange(len(codes), dtype = np.uint16)
+        codes, inverse = codes[order], np.take(rank, inverse)
+    return codes, inverse
+
+def distinct_colors(image_array, max_colors = None):
+    ''' The distinct colors of an (height, width, 3) uint8 array as (N, 3) uint8 in packed order, or None
+    when it has too many of them, as for distinct_inverse '''
+    distinct = distinct_inverse(image_array, max_colors)
+    return unpack_rgb(distinct[0]) if distinct is not None else None
+
+def map_distinct(image_array, mapping, max_colors = None):
+    ''' Apply mapping, from (N, 3) uint8 colors to N uint8 values, to the distinct colors of an
+    (height, width, 3) uint8 array only; each pixel then takes its color's value in the same pass.
+    Returns None when the image has too many distinct colors, as for distinct_inverse. '''
+    found = lookup_colors(image_array, max_colors, lambda codes, count: np.asarray(mapping(unpack_rgb(codes)), dtype = np.uint16))
+    return found[1].astype(np.uint8) if found is not None else None
+
+def distinct_histogram(image_array):
+    ''' The distinct colors of an (height, width, 3) uint8 array as (N, 3) uint8, the number of pixels of
+    each and the (height, width) index of every pixel's color among them. Returns None when the image has
+    too many distinct colors for this to pay off, as map_distinct does. '''
+    distinct = distinct_inverse(image_array)
+    if distinct is None:
+        return None
+    codes, inverse = distinct
+    counts = np.bincount(inverse.reshape(-1), minlength = len(codes))
+    return unpack_rgb(codes), counts, inverse
@@ -0,0 +1,13 @@
+''' The nodes import invokeai, so the package is only loaded, under the name retroize, where invokeai is
+installed; test modules skip themselves otherwise '''
+import importlib.util
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+
+if importlib.util.find_spec("invokeai") is not None and "retroize" not in sys.modules:
+    spec = importlib.util.spec_from_file_location("retroize", ROOT / "__init__.py", submodule_search_locations = [str(ROOT)])
+    package = importlib.util.module_from_spec(spec)
+    sys.modules["retroize"] = package
+    spec.loader.exec_module(package)
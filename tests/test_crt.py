@@ -0,0 +1,87 @@
+''' The vectorized CRT shader against the per-pixel loop it replaced.
+
+The nodes import invokeai, so this runs in the same Python environment as InvokeAI:
+
+    python -m pytest tests
+'''
+import numpy as np
+import pytest
+
+pytest.importorskip("invokeai")
+
+from retroize.retro_crt import crt_effect, scanline_intensity
+
+def vignette_intensity(uv, resolution, opacity, roundness):
+    uvX = uv[..., 0]
+    uvY = uv[..., 1]
+    intensity = uvX * uvY * (1.0 - uvX) * (1.0 - uvY)
+    intensity = np.clip((resolution[0] / roundness) * intensity, 0.0, 1.0)
+    return intensity ** opacity
+
+def crt_loop(image, crt_resolution, curvature, scanlines_opacity, vignette_opacity, vignette_roundness, brightness):
+    ''' The original shader: one Python iteration per output pixel '''
+    image_array = image / 255.0
+    height, width = image.shape[:2]
+
+    x, y = np.meshgrid(np.linspace(0, 1, width), np.linspace(0, 1, height))
+    uv = np.stack((x, y), axis = -1)
+    uv = uv * 2 - 1
+    offset = np.abs(uv[..., [1, 0]]) / curvature
+    uv = uv + uv * offset * offset
+    uv = uv * 0.5 + 0.5
+
+    remapped_uvs = (
+        (uv[..., 0] * (width - 1)).clip(0, width - 1).astype(int),
+        (uv[..., 1] * (height - 1)).clip(0, height - 1).astype(int)
+    )
+
+    vignette_effect = vignette_intensity(uv, crt_resolution, vignette_opacity, vignette_roundness) if vignette_opacity > 0 else 0
+    scanline_x_intensity = scanline_intensity(uv[..., 0], crt_resolution[1], scanlines_opacity) if scanlines_opacity > 0 else 0
+    scanline_y_intensity = scanline_intensity(uv[..., 1], crt_resolution[0], scanlines_opacity) if scanlines_opacity > 0 else 0
+
+    crt_array = np.zeros((height, width, 3), dtype = np.float32)
+    for y in range(height):
+        for x in range(width):
+            #   A copy: the original shaded a view and wrote the gain back into its source pixel
+            base_color = image_array[remapped_uvs[1][y, x], remapped_uvs[0][y, x]].copy()
+
+            if vignette_opacity > 0:
+                base_color *= vignette_effect[y, x]
+
+            if scanlines_opacity > 0:
+                base_color[0] *= scanline_x_intensity[y, x]
+                base_color[1] *= scanline_y_intensity[y, x]
+                base_color[2] *= scanline_y_intensity[y, x]
+
+            if brightness > 0:
+                base_color *= brightness
+
+            if any(uv[y, x] < 0.0) or any(uv[y, x] > 1.0):
+                final_color = np.array([0.0, 0.0, 0.0])
+            else:
+                final_color = np.clip(base_color, 0.0, 1.0)
+
+            crt_array[y, x] = final_color
+
+    return (crt_array * 255).astype(np.uint8)
+
+SIZES = [(37, 53), (64, 64), (17, 90)]
+
+PARAMETERS = [
+    ((240, 160), 3.0, 1.0, 0.5, 5.0, 1.2),
+    ((40, 30), 2.0, 0.0, 0.0, 5.0, 0.0),
+    ((100, 80), 6.0, 0.7, 1.2, 2.0, 1.5),
+]
+
+@pytest.mark.parametrize("size", SIZES)
+@pytest.mark.parametrize("parameters", PARAMETERS)
+@pytest.mark.parametrize("mode", ["default", "low_memory", "parallel"])
+def test_crt_matches_loop(size, parameters, mode):
+    image = np.random.default_rng(0).integers(0, 256, size + (3,), dtype = np.uint8)
+
+    expected = crt_loop(image, *parameters)
+    actual = crt_effect(image, *parameters, low_memory = mode == "low_memory", parallel = mode == "parallel")
+
+    assert actual.shape == expected.shape and actual.dtype == np.uint8
+    #   Float rounding may move a channel by one level
+    assert np.abs(actual.astype(int) - expected).max() <= 1
@@ -0,0 +1,81 @@
+''' The vectorized error diffusion against a plain raster scan, one pixel at a time.
+
+diffuse processes whole anti-diagonals at once. It must still hand every pixel the same errors in the
+same order as the raster scan, since float32 sums depend on their order. The tests pick nearest
+colors from the low bits of each value, so any difference in the sums shows up in the output.
+'''
+from pathlib import Path
+import numpy as np
+import pytest
+
+pytest.importorskip("invokeai")
+
+from retroize.retro_dither import KERNELS, diffuse, diffuse_gray, diffuse_indices
+from retroize.retro_lut import get_lut
+from retroize.retro_palettes import palette_store
+
+ROOT = Path(__file__).resolve().parents[1]
+
+#   Odd sizes, including single rows and columns that the kernels reach past
+SIZES = [(13, 7), (31, 17), (5, 40), (1, 9), (9, 1)]
+
+def diffuse_loop(values, mode, nearest):
+    ''' Error diffusion in raster order, one Python iteration per pixel '''
+    divisor, taps = KERNELS[mode]
+    height, width = values.shape[:2]
+    work = values.copy()
+    indices = np.empty((height, width), dtype = np.uint8)
+    for y in range(height):
+        for x in range(width):
+            pixel = np.clip(work[y, x], 0.0, 255.0)
+            index, color = nearest(pixel[None])
+            indices[y, x] = index[0]
+            error = pixel - color[0]
+            for dy, dx, weight in taps:
+                if 0 <= y + dy < height and 0 <= x + dx < width:
+                    work[y + dy, x + dx] += error * np.float32(weight / divisor)
+    return indices
+
+def bit_nearest(pixel):
+    ''' Index from the low bits of the first channel, color from a coarse quantization '''
+    index = (np.ascontiguousarray(pixel[:, 0]).view(np.uint32) & 255).astype(np.uint8)
+    return index, np.floor(pixel / 85) * 85
+
+def make_values(size, channels = 3):
+    width, height = size
+    return np.random.default_rng(0).integers(0, 256, (height, width, channels)).astype(np.float32)
+
+@pytest.mark.parametrize("size", SIZES)
+@pytest.mark.parametrize("mode", KERNELS)
+def test_diffuse_matches_raster_scan(size, mode):
+    values = make_values(size)
+
+    assert np.array_equal(diffuse(values, mode, bit_nearest), diffuse_loop(values, mode, bit_nearest))
+
+@pytest.mark.parametrize("size", SIZES)
+@pytest.mark.parametrize("mode", KERNELS)
+def test_diffuse_indices_matches_raster_scan(size, mode):
+    values = make_values(size)
+    colors = palette_store.from_file(str(ROOT / "palettes" / "NES.png")).colors
+    lut = get_lut(colors)
+    table, shift = lut.reshape(-1), 8 - (lut.shape[0].bit_length() - 1)
+
+    def nearest(pixel):
+        bins = np.rint(pixel).astype(np.uint32) >> shift
+        index = table[(bins[:, 0] << (2 * (8 - shift))) | (bins[:, 1] << (8 - shift)) | bins[:, 2]]
+        return index, colors[index].astype(np.float32)
+
+    expected = diffuse_loop(values, mode, nearest)
+    assert np.array_equal(diffuse_indices(values.astype(np.uint8), colors, mode), expected)
+
+@pytest.mark.parametrize("size", SIZES)
+@pytest.mark.parametrize("mode", KERNELS)
+def test_diffuse_gray_matches_raster_scan(size, mode):
+    gray = make_values(size, 1)
+
+    def nearest(pixel):
+        index = (pixel[:, 0] >= 128).astype(np.uint8)
+        return index, index[:, None] * np.float32(255)
+
+    expected = diffuse_loop(gray, mode, nearest) * np.uint8(255)
+    assert np.array_equal(diffuse_gray(gray[..., 0].astype(np.uint8), mode), expected)
@@ -0,0 +1,73 @@
+''' The parallel mode of the LUT lookup, ordered dithering, Palettize and the halftone renderer against
+the single-threaded result. Every band must be bit-identical, so the whole frame is compared exactly.
+
+The pool size is read at import; the tests raise the value retro_parallel holds so that frames are
+split into several bands even on a single-core machine.
+'''
+from pathlib import Path
+import numpy as np
+import pytest
+from PIL import Image
+
+pytest.importorskip("invokeai")
+
+from retroize import retro_halftone, retro_parallel
+from retroize.retro_dither import ordered_indices
+from retroize.retro_halftone import halftone_effect
+from retroize.retro_lut import apply_lut, get_lut, pillow_palettize
+from retroize.retro_palettes import palette_store
+
+ROOT = Path(__file__).resolve().parents[1]
+
+SIZES = [(97, 61), (64, 131), (300, 203)]
+
+@pytest.fixture(autouse = True)
+def threads(monkeypatch):
+    monkeypatch.setattr(retro_parallel, "THREADS", 4)
+    monkeypatch.setattr(retro_halftone, "THREADS", 4)
+
+def make_image(size, seed = 0):
+    width, height = size
+    return np.random.default_rng(seed).integers(0, 256, (height, width, 3), dtype = np.uint8)
+
+def nes_colors():
+    return palette_store.from_file(str(ROOT / "palettes" / "NES.png")).colors
+
+@pytest.mark.parametrize("size", SIZES)
+@pytest.mark.parametrize("metric", ["RGB", "OKLab"])
+def test_apply_lut_parallel(size, metric):
+    image = make_image(size)
+    lut = get_lut(nes_colors(), metric = metric)
+
+    assert np.array_equal(apply_lut(image, lut, parallel = True), apply_lut(image, lut))
+
+@pytest.mark.parametrize("size", SIZES)
+@pytest.mark.parametrize("mode", ["Bayer 2x2", "Bayer 16x16", "Blue Noise"])
+@pytest.mark.parametrize("row_offset", [0, 37])
+def test_ordered_indices_parallel(size, mode, row_offset):
+    image = make_image(size)
+    colors = nes_colors()
+
+    expected = ordered_indices(image, colors, mode, row_offset)
+    actual = ordered_indices(image, colors, mode, row_offset, parallel = True)
+    assert np.array_equal(actual, expected)
+
+@pytest.mark.parametrize("size", SIZES)
+def test_pillow_palettize_parallel(size):
+    image = Image.fromarray(make_image(size))
+    colors = nes_colors()
+
+    expected = np.asarray(pillow_palettize(image, colors))
+    actual = np.asarray(pillow_palettize(image, colors, parallel = True))
+    assert np.array_equal(actual, expected)
+
+@pytest.mark.parametrize("size", SIZES)
+@pytest.mark.parametrize("shape", ["Circle", "Square", "Triangle"])
+@pytest.mark.parametrize("random_rotation, jitter, overlay", [(False, 0, False), (True, 3, True)])
+def test_halftone_parallel(size, shape, random_rotation, jitter, overlay):
+    image = make_image(size)
+
+    #   Equal seeds, so both runs draw the same jitter and rotations
+    expected = halftone_effect(image, shape, 7, 20, random_rotation, 30, jitter, overlay, np.random.default_rng(1))
+    actual = halftone_effect(image, shape, 7, 20, random_rotation, 30, jitter, overlay, np.random.default_rng(1), parallel = True)
+    assert np.array_equal(actual, expected)
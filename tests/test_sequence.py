@@ -0,0 +1,113 @@
+''' Sequence mode of Quantize and Palettize (Batch): the first frame comes out as the single-image
+node makes it, and pixels that did not change keep the palette index they had.
+'''
+from pathlib import Path
+import numpy as np
+import pytest
+from PIL import Image
+
+pytest.importorskip("invokeai")
+
+from retroize.retro_palettes import palette_store
+from retroize.retro_palettize import PalettizeSequence, palettize_rgb
+from retroize.retro_quantize import QuantizeSequence, quantize
+from retroize.retro_sequence import FrameSequence
+
+ROOT = Path(__file__).resolve().parents[1]
+
+def make_frames(width = 83, height = 71, count = 3):
+    ''' A noisy gradient with a bright box moving right across it '''
+    rng = np.random.default_rng(0)
+    y, x = np.mgrid[0:height, 0:width]
+    background = np.stack([x * 255 // width, y * 255 // height, (x + y) * 127 // (width + height)], axis = -1)
+    background = np.clip(background + rng.integers(-20, 21, background.shape), 0, 255).astype(np.uint8)
+    frames = []
+    for index in range(count):
+        frame = background.copy()
+        frame[20:40, 10 + 9 * index:30 + 9 * index] = (250, 240, 40)
+        frames.append(frame)
+    return frames
+
+def rgb(image):
+    return np.asarray(image.convert("RGB"))
+
+QUANTIZE_CASES = [
+    ("Median Cut", False, "Floyd-Steinberg", 0),
+    ("Fast Octree", True, "Floyd-Steinberg", 0),
+    ("Max Coverage", True, "Bayer 4x4", 0),
+    ("K-Means", False, "Floyd-Steinberg", 0),
+    ("K-Means", True, "Blue Noise", 2),
+]
+
+PALETTIZE_CASES = [
+    (False, "Floyd-Steinberg", "RGB"),
+    (False, "Floyd-Steinberg", "OKLab"),
+    (True, "Floyd-Steinberg", "RGB"),
+    (True, "Bayer 8x8", "RGB"),
+    (True, "Atkinson", "CIELAB"),
+]
+
+@pytest.mark.parametrize("method, dither, dither_mode, update", QUANTIZE_CASES)
+def test_quantize_first_frame_matches_single_image(method, dither, dither_mode, update):
+    frame = Image.fromarray(make_frames()[0])
+    sequence = QuantizeSequence(16, method, 0, dither, dither_mode, seed = 5, update = update)
+
+    assert np.array_equal(rgb(sequence(frame)), rgb(quantize(frame, 16, method, 0, dither, dither_mode, seed = 5)))
+
+@pytest.mark.parametrize("dither, dither_mode, metric", PALETTIZE_CASES)
+def test_palettize_first_frame_matches_single_image(dither, dither_mode, metric):
+    frame = Image.fromarray(make_frames()[0])
+    palette = palette_store.from_file(str(ROOT / "palettes" / "NES.png"))
+    sequence = PalettizeSequence(palette, False, "Fast Octree", dither, dither_mode, metric)
+
+    assert np.array_equal(rgb(sequence(frame)), rgb(palettize_rgb(frame, palette, False, "Fast Octree", dither, dither_mode, metric = metric)))
+
+def unchanged_keep_index(sequence, frames, threshold = 0):
+    previous = None
+    for frame in frames:
+        indices = np.asarray(sequence(Image.fromarray(frame)))
+        if previous is not None:
+            kept = np.abs(frame.astype(int) - reference.astype(int)).max(axis = -1) <= threshold
+            assert kept.any() and not kept.all()
+            assert np.array_equal(indices[kept], previous[kept])
+            reference[~kept] = frame[~kept]
+        else:
+            reference = frame.copy()
+        previous = indices
+
+@pytest.mark.parametrize("method, dither, dither_mode, update", QUANTIZE_CASES)
+def test_quantize_unchanged_pixels_keep_index(method, dither, dither_mode, update):
+    unchanged_keep_index(QuantizeSequence(16, method, 0, dither, dither_mode, seed = 5, update = update), make_frames())
+
+@pytest.mark.parametrize("dither, dither_mode, metric", PALETTIZE_CASES)
+def test_palettize_unchanged_pixels_keep_index(dither, dither_mode, metric):
+    palette = palette_store.from_file(str(ROOT / "palettes" / "NES.png"))
+    unchanged_keep_index(PalettizeSequence(palette, False, "Fast Octree", dither, dither_mode, metric), make_frames())
+
+def test_threshold_keeps_small_changes():
+    frames = make_frames(count = 2)
+    #   Nudge the whole second frame by less than the threshold
+    frames[1] = np.clip(frames[1].astype(int) + np.random.default_rng(1).integers(-3, 4, frames[1].shape), 0, 255).astype(np.uint8)
+    palette = palette_store.from_file(str(ROOT / "palettes" / "NES.png"))
+    unchanged_keep_index(PalettizeSequence(palette, False, "Fast Octree", True, "Bayer 4x4", threshold = 3), frames, threshold = 3)
+
+def test_changed_regions_match_full_frame_ordered_dither():
+    ''' Regions mapped again line up with the whole frame's threshold map '''
+    frames = make_frames(count = 2)
+    palette = palette_store.from_file(str(ROOT / "palettes" / "NES.png"))
+    sequence = PalettizeSequence(palette, False, "Fast Octree", True, "Bayer 8x8")
+    sequence(Image.fromarray(frames[0]))
+    indices = np.asarray(sequence(Image.fromarray(frames[1])))
+
+    full = np.asarray(palettize_rgb(Image.fromarray(frames[1]), palette, False, "Fast Octree", True, "Bayer 8x8"))
+    changed = (frames[1] != frames[0]).any(axis = -1)
+    assert np.array_equal(indices[changed], full[changed])
+
+def test_frame_sequence_restarts_on_new_size():
+    sequence = FrameSequence()
+    first = np.zeros((8, 8, 3), dtype = np.uint8)
+    sequence.map(first, lambda region, top: np.zeros(region.shape[:2], dtype = np.uint8))
+    other = np.full((4, 6, 3), 9, dtype = np.uint8)
+    indices = sequence.map(other, lambda region, top: np.ones(region.shape[:2], dtype = np.uint8))
+
+    assert indices.shape == (4, 6) and (indices == 1).all()
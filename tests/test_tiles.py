@@ -0,0 +1,68 @@
+''' Banded processing of large images against the whole-frame result of every tiled node.
+
+Tiling starts above RETROIZE_TILE_THRESHOLD_PIXELS, read at import, so the tests lower the values
+retro_tiles holds instead of building frames of many megapixels.
+'''
+from pathlib import Path
+import numpy as np
+import pytest
+from PIL import Image
+
+pytest.importorskip("invokeai")
+
+from retroize import retro_tiles
+from retroize.retro_bitize import bitize
+from retroize.retro_crt import crt
+from retroize.retro_palettes import palette_store
+from retroize.retro_palettize import palettize_rgb
+from retroize.retro_pixelize import pixelize
+from retroize.retro_scanlines import scanlines
+
+ROOT = Path(__file__).resolve().parents[1]
+
+#   Odd sizes, so the last band is short and pixel blocks are cut at the edges
+SIZES = [(97, 61), (64, 131)]
+
+def make_image(size):
+    width, height = size
+    y, x = np.mgrid[0:height, 0:width]
+    gradient = np.stack([x * 255 // width, y * 255 // height, (x + y) * 127 // (width + height)], axis = -1)
+    noise = np.random.default_rng(0).integers(-24, 25, gradient.shape)
+    return Image.fromarray(np.clip(gradient + noise, 0, 255).astype(np.uint8))
+
+def nes():
+    return palette_store.from_file(str(ROOT / "palettes" / "NES.png"))
+
+CASES = {
+    "palettize": lambda image: palettize_rgb(image, nes(), False, "Fast Octree", False),
+    "palettize_oklab": lambda image: palettize_rgb(image, nes(), False, "Fast Octree", False, metric = "OKLab"),
+    "palettize_bayer": lambda image: palettize_rgb(image, nes(), False, "Fast Octree", True, "Bayer 4x4"),
+    "palettize_blue_noise_parallel": lambda image: palettize_rgb(image, nes(), False, "Fast Octree", True, "Blue Noise", parallel = True),
+    "bitize": lambda image: bitize(image, False),
+    "bitize_bayer": lambda image: bitize(image, True, "Bayer 8x8"),
+    "pixelize_box": lambda image: pixelize(image, 4, True, "Box"),
+    "pixelize_median": lambda image: pixelize(image, 3, False, "Median"),
+    "pixelize_mode": lambda image: pixelize(image, 5, True, "Mode"),
+    "pixelize_mode_indexed": lambda image: pixelize(image.quantize(16), 4, True, "Mode"),
+    "scanlines": lambda image: scanlines(image, 2, 3, (0, 0, 0, 255), 0, 0, False),
+    "scanlines_jitter_vertical": lambda image: scanlines(image, 2, 4, (20, 40, 60, 128), 2, 3, True, seed = 7),
+    "scanlines_jitter": lambda image: scanlines(image, 1, 2, (255, 0, 0, 255), 1, 2, False, seed = 3),
+    "crt": lambda image: crt(image, 240, 160, 3.0, 1.0, 0.5, 5.0, 1.2),
+    "crt_low_memory": lambda image: crt(image, 100, 80, 6.0, 0.7, 1.2, 2.0, 1.5, low_memory = True),
+    "crt_parallel": lambda image: crt(image, 40, 30, 2.0, 0.5, 0.0, 5.0, 0.0, parallel = True),
+}
+
+@pytest.mark.parametrize("size", SIZES)
+@pytest.mark.parametrize("case", CASES)
+def test_tiled_matches_whole_frame(size, case, monkeypatch):
+    image = make_image(size)
+    expected = CASES[case](image)
+
+    #   Tile anything above 4096 pixels, in bands of a few rows
+    monkeypatch.setattr(retro_tiles, "TILE_THRESHOLD_PIXELS", 4096)
+    monkeypatch.setattr(retro_tiles, "TILE_PIXELS", 600)
+    assert retro_tiles.should_tile(image)
+    actual = CASES[case](image)
+
+    assert actual.size == expected.size
+    assert np.array_equal(np.asarray(actual.convert("RGB")), np.asarray(expected.convert("RGB")))